@@ -58,88 +58,42 @@ import matplotlib.pyplot as plt
 import numpy as np
 import time
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from bingo_backend.readout import SpectrumReader, PACKET_BUFFER_DTYPE
+from bingo_backend.registers import accumulation_plan, apply_plan
+from bingo_backend.parallel import raise_failures
+from bingo_backend.pps import sync_pps
+from bingo_backend.baseband import BasebandCapture, BramSource, POLARISATIONS, buffer_name
+from bingo_backend.channels import ChannelMap
+
 actual_channels_ddc_centre_freq = 0.0
 
+# x axis of the sample plot in microseconds, built once from the channel
+# map of the baseband mode (see __main__)
+sample_axis = None
+
 
 
 def get_data():
 	#get the data...    
-	#acc_n = skarabs[0].read_uint('acc_cnt')
-	#a_1=struct.unpack('>256Q',skarabs[0].read('mem1',256*8,0))
-	#a_2=struct.unpack('>256Q',skarabs[0].read('mem2',256*8,0))
-	#a_3=struct.unpack('>256Q',skarabs[0].read('mem3',256*8,0))
-	#a_4=struct.unpack('>256Q',skarabs[0].read('mem4',256*8,0))
-	#a_5=struct.unpack('>256Q',skarabs[0].read('mem5',256*8,0))
-	#a_6=struct.unpack('>256Q',skarabs[0].read('mem6',256*8,0))
-	#a_7=struct.unpack('>256Q',skarabs[0].read('mem7',256*8,0))
-	#a_8=struct.unpack('>256Q',skarabs[0].read('mem8',256*8,0))
-        #a_1=struct.unpack('>1024h',skarabs[0].read('sxr_re_0',1024*2,0))
-	a_1=struct.unpack('>256h',skarabs[0].read('packet_buffer_sxr_im_0',256*2,0))
-	#a_2=struct.unpack('>256h',skarabs[0].read('packet_buffer_sxl_re_3',256*2,0))
-	#a_3=struct.unpack('>256h',skarabs[0].read('packet_buffer_sxl_re_0',256*2,0))
-	#a_4=struct.unpack('>256h',skarabs[0].read('packet_buffer_sxl_re_1',256*2,0))
-	#a_5=struct.unpack('>256B',skarabs[0].read('mem_left_0_4',256*1,0))
-	#a_6=struct.unpack('>256B',skarabs[0].read('mem_left_0_5',256*1,0))
-	#a_7=struct.unpack('>256B',skarabs[0].read('mem_left_0_6',256*1,0))
-	#a_8=struct.unpack('>256B',skarabs[0].read('mem_left_0_7',256*1,0))
-	#a_1=struct.unpack('>2048L',skarabs[0].read('mem32',2048*4,0))
-	#a_1=struct.unpack('>2048L',skarabs[0].read('mem31',2048*4,0))
-	#a_2=struct.unpack('>256L',skarabs[0].read('mem26',256*4,0))
-	#a_3=struct.unpack('>256L',skarabs[0].read('mem27',256*4,0))
-	#a_4=struct.unpack('>256L',skarabs[0].read('mem28',256*4,0))
-	#a_5=struct.unpack('>256L',skarabs[0].read('mem29',256*4,0))
-	#a_6=struct.unpack('>256L',skarabs[0].read('mem30',256*4,0))
-	#a_7=struct.unpack('>256L',skarabs[0].read('mem31',256*4,0))
-	#a_8=struct.unpack('>256L',skarabs[0].read('mem32',256*4,0))
-
-	interleave_a=[]
-
-	#for i in range(256):
-	for i in range(256):
-		 interleave_a.append(a_1[i])
-		#interleave_a.append(a_2[i])
-		#interleave_a.append(a_3[i])
-		#interleave_a.append(a_4[i])
-		#interleave_a.append(a_5[i])
-		#interleave_a.append(a_6[i])
-		#interleave_a.append(a_7[i])
-		#interleave_a.append(a_8[i])
-	#return acc_n, numpy.array(interleave_a,dtype=numpy.float)
-	return numpy.array(interleave_a,dtype=numpy.float)
-
-
-
-
-        #for i in range(256):
-	#for i in range(2048):
-                #interleave_a.append(a_1[i])
-                #interleave_a.append(a_2[i])
-                #interleave_a.append(a_3[i])
-                #interleave_a.append(a_4[i])
-                #interleave_a.append(a_5[i])
-                #interleave_a.append(a_6[i])
-                #interleave_a.append(a_7[i])
-                #interleave_a.append(a_8[i])
-        #return acc_n, numpy.array(interleave_a,dtype=numpy.float)
-
-
+	acc_n, interleave_a = reader.read()
+	return interleave_a
 
 
 def plot_spectrum():
-        freq_range_mhz = [0,256]
         matplotlib.pyplot.clf()  # la funzione clf() di pyplot serve a ripulire la figura attuale/precedente
         interleave_a = get_data()
        # interleave_a = interleave_a[::-1]
         peak = np.amax(interleave_a)
         indx = np.argmax(interleave_a)
         print indx, peak
-        print(np.linspace(0,256.,256).shape,interleave_a.shape)
-        matplotlib.pylab.plot(np.linspace(0,256./2-1,256)*(175.*16.)/256.,interleave_a,'b')
+        print(sample_axis.shape,interleave_a.shape)
+        matplotlib.pylab.plot(sample_axis,interleave_a,'b')
         matplotlib.pylab.title('Campioni complessi')
         #matplotlib.pylab.ylabel('Power (dB)')
         matplotlib.pylab.grid()
-        matplotlib.pylab.xlabel('Numero del campione')
-        matplotlib.pylab.xlim(freq_range_mhz[0], freq_range_mhz[1])
+        matplotlib.pylab.xlabel('Tempo del campione (us)')
+        matplotlib.pylab.xlim(sample_axis[0], sample_axis[-1])
         fig.canvas.draw()
         fig.canvas.manager.window.after(100, plot_spectrum)
 
@@ -162,6 +116,10 @@ if __name__ == '__main__':
             help='Sampling rate in MHz [3000, 2560, 2048]')
     p.add_option('-f', '--centre_frequency', dest='centre_frequency', type='float', default=1000.0,
             help='centre frequency in MHz rate in MHz [default 1000.]')
+    p.add_option('-c', '--capture', dest='capture', type='str', default='',
+            help='Capture raw baseband to <CAPTURE>_<component>.raw instead of plotting')
+    p.add_option('-t', '--duration', dest='duration', type='float', default=0.0,
+            help='Seconds to capture, 0 to capture until Ctrl-C [default 0]')
     opts, args = p.parse_args(sys.argv[1:])
 
     opts, args = p.parse_args(sys.argv[1:])
@@ -337,32 +295,12 @@ try:
     # -----------------------------------------------------------------
     print("Synchronizing to PPS")
     software_pps = False   # True if self_generated PPS must be used
-    if software_pps: 
-        sw_pps_mask = 0x2
-    else:
-        sw_pps_mask = 0x0
-
-    frac_time = np.mod(time.time(),1.0) # ensure to be not too close to PPS
-    if frac_time > 0.8: 
-        time.sleep(1.1-frac_time)
-        frac_time = np.mod(time.time(),1.0)
-
-    utc_time = int(time.time()) + 1  # sync to next PPS
-    for i in range(skarab_num):
-	skarabs[i].write_int('utc_time', utc_time)
-        skarabs[i].write_int('sw_pps', sw_pps_mask) 
-
-    if software_pps: 		        # if PPS generated by SW wait for next UTC boundary
-        time.sleep(1.0-frac_time)
-
-    for i in range(skarab_num):	# Trigger PPS capture. 
-        skarabs[i].write_int('sw_pps', sw_pps_mask | 0x5) 
-    if not software_pps:                # For HW pps, wait for it to occur
-        time.sleep(1.0)
-    for i in range(skarab_num):     # deassert LOAD_PPS signal and check that time has been captured
-        skarabs[i].write_int('sw_pps', sw_pps_mask) 
-	# print(str("Skarab ")+str(i)+str(" time counter: ")+str(
-        #       skarabs[i].read_uint('utc_time_count')))
+    # All boards are armed in parallel inside a measured window of the
+    # second and utc_time_count is read back from every board; the sync
+    # is retried if any board latched a different second.
+    pps = sync_pps(skarabs[:skarab_num], software=software_pps)
+    print('PPS epoch %i on all boards (attempt %i, armed within %.1f ms)'
+          % (pps.epoch, pps.attempts, 1e3 * pps.arm_spread))
  
     # -----------------------------------------------------------------
     # 6. CONFIGURE SKARAB ADC BOARD
@@ -493,30 +431,14 @@ try:
     elif nyquist_zone == sd.SECOND_NYQ_ZONE:
         print("Nyquist zone optimisation: Second")
 
-    # Set registers.
-    print 'Configuring accumulation period...',
+    # Set registers: one plan of blind writes for all boards in parallel,
+    # read back once at the end (see bingo_backend.registers).
+    print 'Configuring accumulation period and resetting counters...',
     sys.stdout.flush()
-    for i in range(skarab_num):
-        skarabs[i].write_int('acc_len',opts.acc_len)
-        #skarabs[i].write_int('dest_ip1', DEST_IP)
-        #skarabs[i].write_int('dest_port1', DEST_PORT)
-    print 'done'
-
-    for i in range(skarab_num):
-        #skarabs[i].write_int('fft_shift', 0x00ff)
-        skarabs[i].write_int('fft_shift', 32768)
-
-    print 'Resetting counters...',
-    sys.stdout.flush()
-    for i in range(skarab_num):
-        
-        skarabs[i].write_int('rst_cpoge',1)
-        skarabs[i].write_int('rst_cpoge',0)
-        skarabs[i].write_int('cnt_rst',1)
-        skarabs[i].write_int('cnt_rst',0)
-        # skarabs[i].write_int('shift',20)
-        
-    print 'done'
+    plan = accumulation_plan(opts.acc_len, fft_shift=32768)
+    results = apply_plan(skarabs[:skarab_num], plan)
+    raise_failures(results, 'register configuration')
+    print 'done (%.3f s)' % max(r.elapsed for r in results)
 
     # Sync the ADC
     #   print 'Syncing the ADC...'
@@ -529,6 +451,32 @@ try:
     print("SKARAB ADC SYNCHRONISED SAMPLING AND SPECTROMETER TEST COMPLETE")
     print("---------------------------------------------------------------")
 
+    # Sample rate and axis of the 256-sample packet buffers
+    channel_map = ChannelMap.for_mode('baseband', actual_channels_ddc_centre_freq,
+                                      opts.sampling_rate*1e6, decimation)
+    sample_axis = np.arange(channel_map.nchan) / channel_map.sample_rate * 1e6
+
+    if opts.capture != '':
+        # One process (and board connection) per polarisation, reading its
+        # re and im packet buffers back to back and streaming them to disk
+        # in large writes.
+        pols = [pol for pol in POLARISATIONS
+                if all(buffer_name(c) in skarabs[0].memory_devices for c in pol)]
+        components = [c for pol in pols for c in pol]
+        capture = BasebandCapture([BramSource(skarab_ips[0], pol, 256, bitstream=bitstream)
+                                   for pol in pols], opts.capture,
+                                  sample_rate=channel_map.sample_rate,
+                                  meta={'bitstream': bitstream, 'decimation': decimation,
+                                        'sampling_rate_mhz': opts.sampling_rate,
+                                        'ddc_freq': actual_channels_ddc_centre_freq})
+        print 'Capturing %s, press Ctrl-C to stop.' % ', '.join(components)
+        capture.run(opts.duration or None)
+        exit()
+
+    # Complex sample readout: 256 int16 words, no accumulation counter
+    reader = SpectrumReader(skarabs[0], ['packet_buffer_sxr_im_0'], 256,
+                            dtype=PACKET_BUFFER_DTYPE, count_register=None)
+
     #set up the figure with a subplot to be plotted
     fig = matplotlib.pyplot.figure()
     ax = fig.add_subplot(1,1,1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark of the BRAM decode path used by get_data().
+
+Compares the original struct.unpack + list.append loop of the control
+scripts with the NumPy decode in bingo_backend.readout, on synthetic BRAM
+buffers for each of the designs in this repository.  No hardware needed:
+
+    python benchmarks/bench_decode.py [-n <repeats>]
+"""
+
+from __future__ import division, print_function
+
+import os
+import struct
+import sys
+import timeit
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.readout import (SpectrumReader, BRAM_WORD_DTYPE,
+                                   PACKET_BUFFER_DTYPE)
+
+# (name, BRAM count, words per BRAM, struct code, numpy dtype)
+LAYOUTS = [
+    ('bingo_dec16_32k', 1, 32768, 'L', BRAM_WORD_DTYPE),
+    ('decimation8_1k', 2, 512, 'L', BRAM_WORD_DTYPE),
+    ('pulsar_23mhz', 1, 256, 'h', PACKET_BUFFER_DTYPE),
+]
+
+
+def legacy_decode(raws, nwords, code):
+    """The decode loop of the original get_data() functions."""
+    words = [struct.unpack('>%i%s' % (nwords, code), raw) for raw in raws]
+    interleave_a = []
+    for i in range(nwords):
+        for a in words:
+            interleave_a.append(a[i])
+    return np.array(interleave_a, dtype=np.float64)
+
+
+def make_raws(nbrams, nwords, dtype):
+    """Random big-endian BRAM contents, as returned by CasperFpga.read()."""
+    info = np.iinfo(np.dtype(dtype))
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, info.max, nwords).astype(dtype).tobytes()
+            for _ in range(nbrams)]
+
+
+def main():
+    p = OptionParser()
+    p.set_usage('bench_decode.py [options]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--repeats', dest='repeats', type='int', default=50,
+                 help='Number of decodes timed per layout [default 50]')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    print('%-18s %8s %14s %14s %9s' % ('design', 'nchan', 'legacy (ms)',
+                                        'numpy (ms)', 'speed-up'))
+    for name, nbrams, nwords, code, dtype in LAYOUTS:
+        raws = make_raws(nbrams, nwords, dtype)
+        reader = SpectrumReader(None, ['mem_%i' % i for i in range(nbrams)],
+                                nwords, dtype=dtype)
+        old = legacy_decode(raws, nwords, code)
+        new = reader.decode(raws)
+        if not np.array_equal(old, new):
+            raise RuntimeError('%s: decoded spectra differ' % name)
+
+        t_old = min(timeit.repeat(lambda: legacy_decode(raws, nwords, code),
+                                  repeat=3, number=opts.repeats))
+        t_new = min(timeit.repeat(lambda: reader.decode(raws),
+                                  repeat=3, number=opts.repeats))
+        t_old = 1e3 * t_old / opts.repeats
+        t_new = 1e3 * t_new / opts.repeats
+        print('%-18s %8i %14.3f %14.3f %8.1fx' % (name, nbrams * nwords, t_old,
+                                                  t_new, t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Per-stage benchmark of the readout path against a simulated board.
+
+Times each stage a dump goes through, from the BRAM transactions to the
+plot, for the 1k (decimation8_1k), planned 8k and 32k (bingo_dec16_32k)
+designs, using bingo_backend.simulator.SimulatedSkarab with a configurable
+per-transaction latency and link bandwidth:
+
+    read        acc_cnt-bracketed BRAM reads (SpectrumReader.read_raw_consistent)
+    decode      big-endian words to arrays (decode_bram)
+    interleave  BRAM words into one spectrum (interleave)
+    reorder     BRAM to display order, [::-1] + fftshift (ChannelMap.reorder)
+    archive     append to a memory-mapped archive (SpectrumArchive.append)
+    plot        blitted redraw of the live plot (LiveSpectrumViewer.update)
+
+and writes the results as JSON, so runs of different releases can be
+compared; --compare flags the stages that got slower than a baseline:
+
+    python benchmarks/bench_readout.py -o results.json
+    python benchmarks/bench_readout.py --compare results.json
+"""
+
+from __future__ import division, print_function
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.archive import SpectrumArchive
+from bingo_backend.readout import SpectrumReader, decode_bram, interleave
+from bingo_backend.simulator import DESIGNS, SimulatedSkarab
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# (name in the results, simulator design)
+LAYOUTS = [
+    ('decimation8_1k', 'dec8_1k'),
+    ('planned_8k', 'dec8_8k'),
+    ('bingo_dec16_32k', 'dec16_32k'),
+]
+STAGES = ('read', 'decode', 'interleave', 'reorder', 'archive', 'plot')
+
+
+def summarise(samples):
+    """Mean, median, 95th percentile and minimum in milliseconds."""
+    ms = 1e3 * np.asarray(samples)
+    return {'n': len(ms), 'mean_ms': float(ms.mean()),
+            'median_ms': float(np.median(ms)),
+            'p95_ms': float(np.percentile(ms, 95)), 'min_ms': float(ms.min())}
+
+
+def timed(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = clock()
+        fn()
+        samples.append(clock() - start)
+    return samples
+
+
+def bench_layout(design, repeats, latency, bandwidth, directory, plot):
+    """Timings of every stage for one design, stage -> summary."""
+    board = SimulatedSkarab('bench', design, latency=latency, bandwidth=bandwidth)
+    board.upload_to_ram_and_program()
+    # one dump per second, so reads are not torn by a dump
+    channel_map = board.channel_map
+    board.write_int('acc_len', int(channel_map.sample_rate / channel_map.nchan))
+    board.transactions = 0
+    brams = DESIGNS[design]['brams']
+    nchan = channel_map.nchan
+    reader = SpectrumReader(board, brams, nchan // len(brams))
+    results = {}
+
+    results['read'] = timed(reader.read_raw_consistent, repeats)
+    results['transactions_per_read'] = board.transactions / repeats
+    acc_n, raws = reader.read_raw_consistent()
+
+    words = [decode_bram(raw, reader.dtype, reader.nwords) for raw in raws]
+    results['decode'] = timed(lambda: [decode_bram(raw, reader.dtype, reader.nwords)
+                                       for raw in raws], repeats)
+    spectrum = np.empty(nchan)
+    results['interleave'] = timed(lambda: interleave(words, out=spectrum), repeats)
+    shown = np.empty(nchan)
+    results['reorder'] = timed(lambda: channel_map.reorder(spectrum, out=shown), repeats)
+
+    archive = SpectrumArchive.create(os.path.join(directory, design), nchan,
+                                     capacity=max(64, repeats))
+    counter = iter(range(10 ** 9))
+    results['archive'] = timed(lambda: archive.append(spectrum, next(counter), time.time()),
+                               repeats)
+    archive.close()
+
+    if plot:
+        import matplotlib.pyplot as plt
+        from bingo_backend.viewer import LiveSpectrumViewer
+        rng = np.random.RandomState(0)
+        frames = [shown * (1 + 0.01 * rng.standard_normal(nchan)) for _ in range(4)]
+        state = {'n': 0}
+
+        def source():
+            state['n'] += 1
+            return state['n'], frames[state['n'] % len(frames)]
+        viewer = LiveSpectrumViewer(source, channel_map.freqs)
+        viewer.update()         # the first frame draws the background
+        results['plot'] = timed(viewer.update, repeats)
+        plt.close(viewer.fig)
+
+    summary = dict((stage, summarise(results[stage]))
+                   for stage in STAGES if stage in results)
+    summary['total'] = dict((key, sum(s[key] for s in summary.values()))
+                            for key in ('mean_ms', 'median_ms'))
+    summary['transactions_per_read'] = results['transactions_per_read']
+    return nchan, summary
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.STDOUT)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Lines for stages slower than the baseline by more than ``tolerance``."""
+    regressions = []
+    for name, layout in results['layouts'].items():
+        old = baseline.get('layouts', {}).get(name)
+        if old is None:
+            continue
+        for stage in STAGES:
+            if stage not in layout['stages'] or stage not in old['stages']:
+                continue
+            new_ms = layout['stages'][stage]['median_ms']
+            old_ms = old['stages'][stage]['median_ms']
+            if old_ms > 0 and new_ms > old_ms * (1 + tolerance):
+                regressions.append('%s %s: %.3f ms -> %.3f ms (+%.0f%%)'
+                                   % (name, stage, old_ms, new_ms,
+                                      100 * (new_ms / old_ms - 1)))
+    return regressions
+
+
+def main():
+    p = OptionParser()
+    p.set_usage('bench_readout.py [options]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--repeats', dest='repeats', type='int', default=50,
+                 help='Timed runs per stage [default 50]')
+    p.add_option('-L', '--latency', dest='latency', type='float', default=0.5,
+                 help='Milliseconds per board transaction [default 0.5]')
+    p.add_option('-B', '--bandwidth', dest='bandwidth', type='float', default=100.0,
+                 help='Control link bandwidth in MB/s, 0 for unlimited [default 100]')
+    p.add_option('-o', '--output', dest='output', type='str', default='',
+                 help='Write the results as JSON to this file')
+    p.add_option('--compare', dest='compare', type='str', default='',
+                 help='Baseline JSON to compare with; exit 1 on a regression')
+    p.add_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                 help='Slow-down of a stage median counted as a regression [default 0.2]')
+    p.add_option('--no-plot', dest='plot', action='store_false', default=True,
+                 help='Skip the plot stage (needs matplotlib)')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    if opts.plot:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+        except ImportError:
+            opts.plot = False
+    results = {
+        'benchmark': 'bench_readout',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'latency_ms': opts.latency,
+        'bandwidth_mb_s': opts.bandwidth,
+        'repeats': opts.repeats,
+        'layouts': {},
+    }
+    directory = tempfile.mkdtemp(prefix='bench_readout_')
+    try:
+        print('%-16s %6s' % ('design', 'nchan') +
+              ''.join('%11s' % stage for stage in STAGES + ('total',)) + '  (median ms)')
+        for name, design in LAYOUTS:
+            nchan, summary = bench_layout(design, opts.repeats, opts.latency / 1e3,
+                                          opts.bandwidth * 1e6 or None, directory,
+                                          opts.plot)
+            results['layouts'][name] = {'design': design, 'nchan': nchan,
+                                        'stages': summary}
+            cells = ['%11.3f' % summary[stage]['median_ms'] if stage in summary
+                     else '%11s' % '-' for stage in STAGES]
+            print('%-16s %6i' % (name, nchan) + ''.join(cells) +
+                  '%11.3f' % summary['total']['median_ms'])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('results written to %s' % opts.output)
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opts.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        if regressions:
+            sys.exit(1)
+        print('no stage slower than %s by more than %.0f%%'
+              % (opts.compare, 100 * opts.tolerance))
+
+
+if __name__ == '__main__':
+    main()
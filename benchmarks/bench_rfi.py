@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmark of the real-time RFI flagger.
+
+Feeds synthetic accumulated spectra (a rippled bandpass with radiometer
+noise, one intermittent and one CW interferer) through RfiFlagger for
+each detector and spectrum size, and reports the cost per spectrum, the
+share of a dump period it takes on this core, and how well the two
+interferers are caught against the noise channels flagged:
+
+    python benchmarks/bench_rfi.py [-n <spectra>] [-l <acc_len>]
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.rfi import RfiFlagger, METHODS
+from bingo_backend.scheduler import dump_period
+
+# (design, channels, complex sample rate)
+LAYOUTS = [
+    ('decimation8_1k', 1024, 3000e6 / 8),
+    ('bingo_dec16_32k', 32768, 3000e6 / 16),
+]
+
+
+def spectra(nchan, acc_len, seed=0):
+    """Endless spectra; channel nchan//4 bursts every 10th dump and
+    channel nchan//2 holds a steady carrier."""
+    rng = np.random.RandomState(seed)
+    bandpass = 1e6 * (1 + 0.5 * np.sin(np.arange(nchan) * 20.0 / nchan))
+    t = 0
+    while True:
+        y = bandpass * (1 + rng.standard_normal(nchan) / np.sqrt(acc_len))
+        if t % 10 == 0:
+            y[nchan // 4] *= 6
+        y[nchan // 2] = 3 * bandpass[nchan // 2]
+        t += 1
+        yield y
+
+
+def main():
+    p = OptionParser()
+    p.set_usage('bench_rfi.py [options]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--spectra', dest='spectra', type='int', default=300,
+                 help='Spectra flagged per detector and layout [default 300]')
+    p.add_option('-l', '--acc_len', dest='acc_len', type='int', default=5722,
+                 help='Spectra accumulated per dump [default 5722]')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    print('%-16s %6s %6s %10s %9s %8s %8s %10s' % (
+        'design', 'nchan', 'method', 'ms/spec', 'of dump', 'burst', 'carrier',
+        'noise'))
+    for name, nchan, rate in LAYOUTS:
+        period = dump_period(opts.acc_len, nchan, rate)
+        for method in METHODS:
+            flagger = RfiFlagger(nchan, method, acc_len=opts.acc_len)
+            source = spectra(nchan, opts.acc_len)
+            hits = np.zeros(nchan)
+            for _ in range(flagger.window):     # fill the window first
+                flagger.flag(next(source))
+            flagger.elapsed = 0.0
+            flagger.spectra = 0
+            for _ in range(opts.spectra):
+                hits += flagger.flag(next(source))
+            hits /= opts.spectra
+            ms = flagger.stats()['ms_per_spectrum']
+            noise = np.delete(hits, [nchan // 4, nchan // 2]).mean()
+            print('%-16s %6i %6s %10.3f %8.2f%% %8.2f %8.2f %9.3f%%' % (
+                name, nchan, method, ms, 100 * ms / 1e3 / period,
+                hits[nchan // 4], hits[nchan // 2], 100 * noise))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Benchmark of the live spectrum plot.
+
+Times the original clf() + plot() redraw of plot_spectrum() against the
+blitting LiveSpectrumViewer, on random 32768-channel spectra with one RFI
+spike, using the Agg backend so no display is needed:
+
+    python benchmarks/bench_viewer.py [-n <frames>] [-c <channels>]
+
+Agg draws off screen, so the figures are the redraw cost alone; an
+interactive backend adds the copy to the window.  The viewer shows at
+most one frame per timer interval, so the frame rate it can reach is the
+lower of its redraw rate and 1000 / interval; that is compared with the
+20 frames/s target.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.channels import frequency_axis
+from bingo_backend.viewer import DEFAULT_INTERVAL, TARGET_FPS, LiveSpectrumViewer
+
+
+def spectra(nchan, seed=0):
+    """Endless (acc_n, spectrum) pairs with a single-channel spike."""
+    rng = np.random.RandomState(seed)
+    acc_n = 0
+    while True:
+        acc_n += 1
+        y = 1e3 + 1e2 * rng.rand(nchan)
+        y[rng.randint(nchan)] = 5e3
+        yield acc_n, y
+
+
+def legacy_fps(nchan, frames):
+    """Frames per second of the original plot_spectrum() redraw."""
+    fig = plt.figure()
+    source = spectra(nchan)
+    start = time.time()
+    for _ in range(frames):
+        acc_n, y = next(source)
+        plt.clf()
+        plt.plot(np.linspace(-nchan / 2, nchan / 2 - 1, nchan) * (-93.75 / nchan) + 1e3, y)
+        plt.title('Integration number %i.' % acc_n)
+        plt.grid()
+        plt.xlabel('Freq (MHz)')
+        fig.canvas.draw()
+    plt.close(fig)
+    return frames / (time.time() - start)
+
+
+def viewer_fps(nchan, frames):
+    """Frames per second of LiveSpectrumViewer.update()."""
+    source = spectra(nchan)
+    viewer = LiveSpectrumViewer(lambda: next(source),
+                                frequency_axis(1e9, 187.5e6, nchan, -1))
+    viewer.update()     # first frame draws the background
+    start = time.time()
+    for _ in range(frames):
+        viewer.update()
+    plt.close(viewer.fig)
+    return frames / (time.time() - start)
+
+
+def main():
+    p = OptionParser()
+    p.set_usage('bench_viewer.py [options]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--frames', dest='frames', type='int', default=50,
+                 help='Number of frames drawn per method [default 50]')
+    p.add_option('-c', '--channels', dest='nchan', type='int', default=32768,
+                 help='Channels per spectrum [default 32768]')
+    opts, args = p.parse_args(sys.argv[1:])
+
+    old = legacy_fps(opts.nchan, opts.frames)
+    new = viewer_fps(opts.nchan, opts.frames)
+    print('%-10s %8s %12s' % ('method', 'nchan', 'frames/s'))
+    print('%-10s %8i %12.1f' % ('clf+plot', opts.nchan, old))
+    print('%-10s %8i %12.1f' % ('blit', opts.nchan, new))
+    print('speed-up %.1fx' % (new / old))
+    reached = min(new, 1000.0 / DEFAULT_INTERVAL)
+    print('live view %.1f frames/s (%i ms timer), target %i frames/s: %s'
+          % (reached, DEFAULT_INTERVAL, TARGET_FPS,
+             'met' if reached >= TARGET_FPS else 'NOT met'))
+
+
+if __name__ == '__main__':
+    main()
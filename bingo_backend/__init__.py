@@ -0,0 +1,32 @@
+"""
+Host-side back-end library for the BINGO SKARAB spectrometers.
+
+The control scripts in the firmware directories (bingo_dec16_32k_,
+decimation8_1k_, baseband_23mhz) import this package to talk to the
+boards and to move spectra from the FPGA to the host.  It is written to
+run under the same Python 2.7 + casperfpga environment as the scripts,
+and under Python 3.
+
+The modules that also run as programs (simulator, dedisperse and spead,
+``python -m bingo_backend.<module>``) are not imported here, or runpy
+would find them already loaded; import SimulatedSkarab, fold,
+SpeadReceiver and the rest from their modules.
+"""
+
+from .readout import SpectrumReader, TornReadError, decode_bram, interleave
+from .multiboard import MultiBoardReader, AlignmentError
+from .pps import PpsSync, PpsSyncError, sync_pps
+from .timing import Timestamper, DriftMonitor
+from .registers import RegisterPlan, RegisterMismatch, accumulation_plan, apply_plan
+from .scheduler import DumpScheduler, dump_period
+from .acquisition import Acquisition, Publisher, Spectrum
+from .metrics import Metrics, MetricsServer
+from .archive import SpectrumArchive, ArchiveSink
+from .rfi import RfiFlagger, pack_mask, unpack_mask
+from .integrate import Integrator, IntegrationSink
+from .fits import FitsSpectrumWriter, FitsSink
+from .sinks import Sink
+from .baseband import BasebandCapture, BramSource, UdpSource
+from .shmring import SpectrumRing, RingConsumer, RingSink
+from .waterfall import WaterfallPyramid, WaterfallSink
+from .channels import ChannelMap, frequency_axis
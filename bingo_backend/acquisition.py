@@ -0,0 +1,390 @@
+"""
+Headless acquisition loop for the SKARAB spectrometers.
+
+Acquisition waits for each new accumulation of one board (see
+bingo_backend.scheduler), reads it exactly once and publishes it to a set
+of sinks.  Each sink
+runs on its own thread behind a bounded queue: when a sink falls behind,
+its queue fills up and further spectra are dropped (and counted) for that
+sink only, so the readout itself never waits on a consumer.
+
+Publisher holds the sink threads; other spectrum sources (such as the
+SPEAD receiver in bingo_backend.spead) subclass it and feed the same sinks.
+Stages (such as bingo_backend.rfi.RfiFlagger) run on the producer thread
+before a spectrum is handed to the sinks, so they can annotate it.
+
+Every publisher keeps a bingo_backend.metrics.Metrics registry timing its
+stages (register and BRAM reads, decode, processing, each sink's writes),
+the interval and jitter between dumps, and the dumps missed, torn or
+dropped; serve it with bingo_backend.metrics.MetricsServer.
+"""
+
+from __future__ import division, print_function
+
+import logging
+import threading
+import time
+
+from .metrics import STAGE_HELP, Metrics, clock
+from .scheduler import DumpScheduler
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+INTERVAL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0, 1.1, 1.25,
+                    1.5, 2.0, 2.5, 5.0, 10.0)
+JITTER_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+                  0.1, 0.25, 0.5, 1.0)
+
+
+class Spectrum(object):
+    """One accumulation read from a board."""
+
+    __slots__ = ('acc_cnt', 'data', 'timestamp', 'board', 'ticks', 'mask',
+                 'time_error')
+
+    def __init__(self, acc_cnt, data, timestamp, board=0, ticks=None,
+                 mask=None, time_error=None):
+        self.acc_cnt = acc_cnt
+        self.data = data
+        self.timestamp = timestamp    # UTC unix time
+        self.board = board
+        self.ticks = ticks            # hardware timestamp, when the source has one
+        self.mask = mask              # packed RFI mask, see bingo_backend.rfi
+        self.time_error = time_error  # seconds, for hardware timestamps (bingo_backend.timing)
+
+    def __repr__(self):
+        return 'Spectrum(acc_cnt=%r, nchan=%i, board=%r)' % (
+            self.acc_cnt, len(self.data), self.board)
+
+
+class SinkWorker(threading.Thread):
+    """Feed one sink from a bounded queue on a dedicated thread."""
+
+    def __init__(self, sink, queue_size=16, metrics=None, name=None):
+        """:param name: thread name and ``sink`` label of the metrics, unique
+            per registry; by default ``sink-<class>``"""
+        threading.Thread.__init__(self, name=name or 'sink-%s' % type(sink).__name__)
+        self.daemon = True
+        self.sink = sink
+        self.queue = queue.Queue(queue_size)
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._halt = threading.Event()
+        self._write_time = None
+        if metrics is not None:
+            self._write_time = metrics.histogram(
+                'stage_seconds', STAGE_HELP, {'stage': 'sink_write', 'sink': self.name})
+
+    def offer(self, spectrum):
+        """Queue a spectrum without blocking; returns False if it was dropped."""
+        try:
+            self.queue.put_nowait(spectrum)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def start(self):
+        """Open the sink on the calling thread, so a sink that cannot be
+        opened fails the start instead of the worker, then feed it."""
+        self.sink.open()
+        threading.Thread.start(self)
+
+    def stop(self):
+        """Ask the worker to finish the queued spectra and close its sink."""
+        self._halt.set()
+
+    def samples(self):
+        """Counters of this worker, for a Metrics collector."""
+        labels = {'sink': self.name}
+        return [
+            ('sink_written_total', 'counter', 'Spectra written per sink.', labels,
+             self.written),
+            ('sink_dropped_total', 'counter',
+             'Spectra dropped because a sink queue was full.', labels, self.dropped),
+            ('sink_errors_total', 'counter', 'Failed sink writes.', labels, self.errors),
+            ('sink_queue_length', 'gauge', 'Spectra waiting per sink.', labels,
+             self.queue.qsize()),
+        ]
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    spectrum = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self._halt.is_set():
+                        break
+                    continue
+                try:
+                    start = clock()
+                    self.sink.write(spectrum)
+                    if self._write_time is not None:
+                        self._write_time.observe(clock() - start)
+                    self.written += 1
+                except Exception:
+                    self.errors += 1
+                    logger.exception('%s failed to write %r', self.name, spectrum)
+        finally:
+            self.sink.close()
+
+
+class Publisher(object):
+    """Run a producer thread that publishes spectra to sink workers.
+
+    Subclasses implement run(), which loops until ``self._halt`` is set and
+    calls publish() for every spectrum produced.
+    """
+
+    thread_name = 'publisher'
+
+    def __init__(self, sinks=(), queue_size=16, metrics=None):
+        """:param metrics: bingo_backend.metrics.Metrics registry to
+        report to, by default a new one (``self.metrics``)"""
+        self.queue_size = queue_size
+        self.workers = []
+        self.stages = []
+        self.spectra = 0
+        self.stage_errors = 0
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._processing_time = self.metrics.histogram(
+            'stage_seconds', STAGE_HELP, {'stage': 'processing'})
+        self.metrics.add_collector(self._collect)
+        self._halt = threading.Event()
+        self._thread = None
+        for sink in sinks:
+            self.add_sink(sink)
+
+    def add_sink(self, sink, queue_size=None):
+        """Attach a sink; must be called before start()."""
+        if queue_size is None:
+            queue_size = self.queue_size
+        # numbered, so two sinks of one class get their own metrics
+        worker = SinkWorker(sink, queue_size, self.metrics,
+                            'sink-%i-%s' % (len(self.workers), type(sink).__name__))
+        self.workers.append(worker)
+        return worker
+
+    def add_stage(self, stage):
+        """Run ``stage(spectrum)`` on every spectrum before the sinks see it.
+
+        Stages run in order on the producer thread and may set attributes
+        of the spectrum (its data is read-only); they must keep up with
+        the dump rate.
+        """
+        self.stages.append(stage)
+        return stage
+
+    def publish(self, spectrum):
+        """Run the stages, then hand a spectrum to every sink without blocking."""
+        if self.stages:
+            start = clock()
+            for stage in self.stages:
+                try:
+                    stage(spectrum)
+                except Exception:
+                    # publish the spectrum anyway, without the stage's annotation
+                    self.stage_errors += 1
+                    logger.exception('stage %r failed on %r', stage, spectrum)
+            self._processing_time.observe(clock() - start)
+        self.spectra += 1
+        for worker in self.workers:
+            worker.offer(spectrum)
+
+    def run(self):
+        raise NotImplementedError
+
+    def start(self):
+        """Start the sink workers and the producer thread."""
+        try:
+            for worker in self.workers:
+                worker.start()
+        except Exception:
+            self.stop()     # close the sinks already opened
+            raise
+        self._halt.clear()
+        self._thread = threading.Thread(target=self.run, name=self.thread_name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the producer, then let every sink drain its queue and close."""
+        self._halt.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            if worker.ident is not None:    # not started: nothing to drain
+                worker.join(timeout)
+
+    def run_forever(self):
+        """Run headless until interrupted with Ctrl-C."""
+        self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def sink_stats(self):
+        """Written/dropped/errors per sink."""
+        return dict((w.name, {'written': w.written, 'dropped': w.dropped,
+                              'errors': w.errors})
+                    for w in self.workers)
+
+    def _collect(self):
+        """Counters kept by the publisher and its sinks, for Metrics."""
+        samples = [
+            ('spectra_total', 'counter', 'Spectra published.', None, self.spectra),
+            ('stage_errors_total', 'counter', 'Spectra a stage failed on.', None,
+             self.stage_errors),
+        ]
+        for w in self.workers:
+            samples += w.samples()
+        return samples
+
+
+class Acquisition(Publisher):
+    """Read each new accumulation once and publish it to the sinks."""
+
+    thread_name = 'acquisition'
+
+    def __init__(self, reader, sinks=(), queue_size=16, scheduler=None,
+                 board=0, metrics=None):
+        """
+        :param reader: bingo_backend.readout.SpectrumReader of the board,
+            or a bingo_backend.multiboard.MultiBoardReader
+        :param sinks: bingo_backend.sinks.Sink objects to publish to
+        :param queue_size: spectra buffered per sink before dropping
+        :param scheduler: bingo_backend.scheduler.DumpScheduler deciding
+            when to read; by default acc_cnt is polled every 10 ms
+        :param board: board label stored in every Spectrum
+        :param metrics: bingo_backend.metrics.Metrics registry, see Publisher
+        """
+        Publisher.__init__(self, sinks, queue_size, metrics)
+        self.reader = reader
+        if scheduler is None:
+            scheduler = DumpScheduler(reader)
+        self.scheduler = scheduler
+        self.board = board
+        self.read_errors = 0
+        if hasattr(reader, 'instrument'):
+            reader.instrument(self.metrics)
+        m = self.metrics
+        self._decode_time = m.histogram('stage_seconds', STAGE_HELP, {'stage': 'decode'})
+        self._dump_time = m.histogram('dump_seconds',
+                                      'Seconds from the start of a dump read to its publication.')
+        self._interval = m.histogram('dump_interval_seconds',
+                                     'Host time between dumps read, per accumulation.',
+                                     buckets=INTERVAL_BUCKETS)
+        self._jitter = m.histogram('dump_jitter_seconds',
+                                   'Deviation of the dump interval from the acc_len period.',
+                                   buckets=JITTER_BUCKETS)
+        self._last_read = None
+
+    @property
+    def last_acc_cnt(self):
+        return self.scheduler.last_acc_cnt
+
+    def read_dump(self):
+        """Read the accumulation the scheduler found and publish it."""
+        start = clock()
+        acc_n, raws = self.reader.read_raw_consistent()
+        if acc_n is None:
+            acc_n = self.scheduler.last_acc_cnt
+        elif acc_n != self.scheduler.last_acc_cnt:
+            # a dump landed between the poll and the read
+            self.scheduler.observe(acc_n)
+        decode_start = clock()
+        data = self.reader.decode(raws)
+        self._decode_time.observe(clock() - decode_start)
+        data.flags.writeable = False  # shared by all sinks
+        spectrum = Spectrum(acc_n, data, time.time(), self.board)
+        self._observe_interval(spectrum)
+        self.publish(spectrum)
+        self._dump_time.observe(clock() - start)
+        return spectrum
+
+    def _observe_interval(self, spectrum):
+        last = self._last_read
+        self._last_read = spectrum
+        if last is None or spectrum.acc_cnt is None or last.acc_cnt is None:
+            return
+        advance = spectrum.acc_cnt - last.acc_cnt
+        if advance <= 0:
+            return      # counter reset
+        interval = (spectrum.timestamp - last.timestamp) / advance
+        self._interval.observe(interval)
+        if self.scheduler.period:
+            self._jitter.observe(abs(interval - self.scheduler.period))
+
+    def poll_once(self):
+        """Read the board if a new accumulation is ready.
+
+        Returns the published Spectrum, or None if acc_cnt has not moved.
+        """
+        if not self.scheduler.check():
+            return None
+        return self.read_dump()
+
+    def run(self):
+        """Read every dump until stop() is called."""
+        while not self._halt.is_set():
+            try:
+                if self.scheduler.wait(self._halt):
+                    self.read_dump()
+            except Exception:
+                # a failed transaction must not end a long run
+                self.read_errors += 1
+                logger.exception('board %r: readout failed', self.board)
+                self._halt.wait(self.scheduler.poll_interval)
+
+    def _collect(self):
+        samples = Publisher._collect(self)
+        dumps = self.scheduler.stats()
+        samples += [
+            ('read_errors_total', 'counter', 'Dump reads that raised.', None, self.read_errors),
+            ('missed_dumps_total', 'counter',
+             'Accumulations skipped between two dumps read (acc_cnt gaps).', None,
+             dumps['skipped']),
+            ('late_dumps_total', 'counter', 'Dumps not ready when predicted.', None,
+             dumps['late']),
+            ('counter_resets_total', 'counter', 'acc_cnt resets seen.', None, dumps['resets']),
+            ('register_polls_total', 'counter', 'acc_cnt polls.', None, dumps['polls']),
+            ('last_acc_cnt', 'gauge', 'acc_cnt of the last dump read.', None,
+             self.scheduler.last_acc_cnt or 0),
+        ]
+        reads = self.reader.stats()
+        for board, board_reads in enumerate(reads.get('boards', [reads])):
+            labels = {'board': board}
+            samples += [
+                ('torn_reads_total', 'counter',
+                 'BRAM reads repeated because a dump landed during them.', labels,
+                 board_reads['torn']),
+                ('read_failures_total', 'counter', 'Reads given up as torn.', labels,
+                 board_reads['failures']),
+            ]
+        if self.scheduler.period:
+            samples.append(('dump_period_seconds', 'gauge',
+                            'Expected seconds between dumps.', None, self.scheduler.period))
+        return samples
+
+    def stats(self):
+        """Spectra read, read errors, dump counters and per-sink counters."""
+        return {
+            'spectra': self.spectra,
+            'last_acc_cnt': self.last_acc_cnt,
+            'read_errors': self.read_errors,
+            'stage_errors': self.stage_errors,
+            'dumps': self.scheduler.stats(),
+            'reads': self.reader.stats(),
+            'sinks': self.sink_stats(),
+        }
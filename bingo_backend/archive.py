@@ -0,0 +1,339 @@
+"""
+Append-only, memory-mapped spectrum archive.
+
+An archive is three files sharing a base name:
+
+    <base>.json   nchan, sample dtype and free-form metadata
+    <base>.spec   the spectra, one fixed-size row per accumulation and
+                  board, little-endian float32 or uint32
+    <base>.idx    a 16-byte header (magic, version, row count) followed by
+                  one record per row: acc_cnt, UTC timestamp, board, flags
+    <base>.mask   optional: the packed RFI mask of every row (see
+                  bingo_backend.rfi), ceil(nchan / 8) bytes per row
+
+Both binary files are pre-allocated in blocks of ``capacity`` rows and
+written through np.memmap, so appending a spectrum is a single copy into
+the page cache.  The row count in the index header is bumped only after
+the row and its record are written, so a reader opening the same archive
+while acquisition is running always sees complete rows, and can slice
+time and channel ranges without copying (see SpectrumArchive.select).
+An existing archive is never truncated: create() refuses it, and
+resume() reopens it to append after the rows it already holds, as
+ArchiveSink does when a run is restarted on the same base name with the
+same metadata (acc_len, channel mode, ...).
+Masks live in their own file, so averaging code can find the bad samples
+of a range (select_mask) without reading the spectra a second time; rows
+with any channel flagged also have FLAG_RFI set in their index flags.
+"""
+
+from __future__ import division, print_function
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from .rfi import unpack_mask
+from .sinks import Sink
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'BSPI'
+INDEX_VERSION = 1
+INDEX_HEADER_BYTES = 16
+INDEX_DTYPE = np.dtype([('acc_cnt', '<u8'), ('timestamp', '<f8'),
+                        ('board', '<u4'), ('flags', '<u4')])
+SAMPLE_DTYPES = ('float32', 'uint32')
+FLAG_RFI = 0x1              # index flag: some channels of the row are masked
+
+
+def check_meta(name, stored, meta):
+    """Raise ValueError if ``meta`` differs from the ``stored`` metadata
+    in any of its keys."""
+    # compare as stored: JSON turns tuples into lists, ...
+    meta = json.loads(json.dumps(dict(meta or {})))
+    changed = sorted(key for key in meta if stored.get(key) != meta[key])
+    if changed:
+        raise ValueError('%s was written with %s' % (name, ', '.join(
+            '%s=%r, not %r' % (key, stored.get(key), meta[key]) for key in changed)))
+
+
+def _preallocate(path, nbytes):
+    """Extend a file to ``nbytes``, reserving the blocks where supported."""
+    with open(path, 'r+b') as f:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, nbytes)
+        else:
+            f.truncate(nbytes)
+
+
+class SpectrumArchive(object):
+    """Writer or live reader of one archive."""
+
+    def __init__(self, base, mode='r'):
+        """Open an existing archive; use SpectrumArchive.create() for new ones.
+
+        :param base: path without extension
+        :param mode: 'r' to read, 'r+' to append
+        """
+        self.base = base
+        self.mode = mode
+        with open(base + '.json') as f:
+            self.meta = json.load(f)
+        self.nchan = int(self.meta['nchan'])
+        self.sample_dtype = np.dtype(self.meta['dtype']).newbyteorder('<')
+        self.capacity = int(self.meta['capacity'])
+        self.masked = bool(self.meta.get('masks', False))
+        self.mask_bytes = (self.nchan + 7) // 8
+        self.flush_every = 64
+        self._unflushed = 0
+        with open(base + '.idx', 'rb') as f:
+            header = f.read(INDEX_HEADER_BYTES)
+        if header[:4] != INDEX_MAGIC:
+            raise ValueError('%s.idx is not a spectrum archive index' % base)
+        self._map()
+
+    @classmethod
+    def create(cls, base, nchan, dtype='float32', capacity=4096, meta=None,
+               masks=False):
+        """Create a new archive and open it for appending.
+
+        :raises OSError: if ``base`` already exists (see resume())
+        :param nchan: channels per spectrum
+        :param dtype: 'float32' or 'uint32'
+        :param capacity: rows pre-allocated at a time
+        :param meta: extra JSON-serialisable metadata (acc_len, ...)
+        :param masks: also keep a packed RFI mask per row
+        """
+        if str(dtype) not in SAMPLE_DTYPES:
+            raise ValueError('dtype must be one of %s' % (SAMPLE_DTYPES,))
+        directory = os.path.dirname(base)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        info = dict(meta or {})
+        info.update(nchan=int(nchan), dtype=str(dtype), capacity=int(capacity),
+                    masks=bool(masks))
+        # the metadata file claims the base name: never clobber an archive
+        fd = os.open(base + '.json', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        header = np.zeros(1, dtype=[('magic', 'S4'), ('version', '<u4'),
+                                    ('count', '<u8')])
+        header['magic'] = INDEX_MAGIC
+        header['version'] = INDEX_VERSION
+        with open(base + '.idx', 'wb') as f:
+            f.write(header.tobytes())
+        open(base + '.spec', 'wb').close()
+        if masks:
+            open(base + '.mask', 'wb').close()
+        archive = cls(base, mode='r+')
+        archive._grow(capacity)
+        return archive
+
+    @classmethod
+    def resume(cls, base, nchan, dtype='float32', masks=False, meta=None):
+        """Reopen an existing archive to append after its stored rows.
+
+        :param nchan, dtype, masks: what the caller will append; checked
+            against the archive's metadata
+        :param meta: metadata the caller would create the archive with;
+            every key must match the stored value
+        :raises ValueError: if the archive holds different spectra
+        """
+        archive = cls(base, mode='r+')
+        try:
+            check_meta(base, archive.meta, meta)
+        except ValueError:
+            archive.close()
+            raise
+        wanted = (int(nchan), np.dtype(str(dtype)).newbyteorder('<'))
+        if (archive.nchan, archive.sample_dtype) != wanted:
+            archive.close()
+            raise ValueError('%s holds %i-channel %s spectra, not %i-channel %s'
+                             % (base, archive.nchan, archive.meta['dtype'], nchan, dtype))
+        if masks and not archive.masked:
+            archive.close()
+            raise ValueError('%s keeps no RFI masks' % base)
+        return archive
+
+    @staticmethod
+    def exists(base):
+        """Whether an archive was created under ``base``."""
+        return os.path.exists(base + '.json')
+
+    # -- mapping -------------------------------------------------------
+
+    def _rows_allocated(self):
+        # a writer grows the files one after the other: map the rows all
+        # of them already hold
+        rows = min(os.path.getsize(self.base + '.spec') // (self.nchan * self.sample_dtype.itemsize),
+                   (os.path.getsize(self.base + '.idx') - INDEX_HEADER_BYTES) // INDEX_DTYPE.itemsize)
+        if self.masked:
+            rows = min(rows, os.path.getsize(self.base + '.mask') // self.mask_bytes)
+        return rows
+
+    def _map(self):
+        """(Re)map the files at their current size."""
+        rows = self._rows_allocated()
+        self._count = np.memmap(self.base + '.idx', dtype='<u8', mode=self.mode,
+                                offset=8, shape=(1,))
+        if rows:
+            self._data = np.memmap(self.base + '.spec', dtype=self.sample_dtype,
+                                   mode=self.mode, shape=(rows, self.nchan))
+            self._index = np.memmap(self.base + '.idx', dtype=INDEX_DTYPE,
+                                    mode=self.mode, offset=INDEX_HEADER_BYTES,
+                                    shape=(rows,))
+        else:
+            self._data = np.zeros((0, self.nchan), dtype=self.sample_dtype)
+            self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        self._mask = None
+        if self.masked:
+            self._mask = (np.memmap(self.base + '.mask', dtype=np.uint8, mode=self.mode,
+                                    shape=(rows, self.mask_bytes)) if rows else
+                          np.zeros((0, self.mask_bytes), dtype=np.uint8))
+        self.allocated = rows
+
+    def _grow(self, rows):
+        """Pre-allocate ``rows`` more rows in both files."""
+        total = self.allocated + rows
+        _preallocate(self.base + '.spec', total * self.nchan * self.sample_dtype.itemsize)
+        _preallocate(self.base + '.idx', INDEX_HEADER_BYTES + total * INDEX_DTYPE.itemsize)
+        if self.masked:
+            _preallocate(self.base + '.mask', total * self.mask_bytes)
+        self._map()
+
+    # -- writing -------------------------------------------------------
+
+    def append(self, data, acc_cnt, timestamp, board=0, flags=0, mask=None):
+        """Append one spectrum (or one row per board of a 2-D array).
+
+        ``board`` is the label of the first row; the rows of a 2-D array
+        get consecutive board numbers.  ``mask`` is the packed RFI mask
+        of the rows (bingo_backend.rfi.pack_mask); it is stored if the
+        archive keeps masks, and sets FLAG_RFI on rows with a channel
+        flagged.
+        """
+        rows = np.atleast_2d(data)
+        count = int(self._count[0])
+        if count + len(rows) > self.allocated:
+            self._grow(max(self.capacity, len(rows)))
+        self._data[count:count + len(rows)] = rows
+        records = self._index[count:count + len(rows)]
+        records['acc_cnt'] = acc_cnt
+        records['timestamp'] = timestamp
+        records['board'] = board + np.arange(len(rows))
+        records['flags'] = flags
+        if mask is not None:
+            mask = np.atleast_2d(mask)
+            records['flags'] |= np.where(mask.any(axis=-1), FLAG_RFI, 0).astype('<u4')
+            if self.masked:
+                self._mask[count:count + len(rows)] = mask
+        # publish the rows only once they are complete
+        self._count[0] = count + len(rows)
+        self._unflushed += len(rows)
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write dirty pages of both files back to disk."""
+        if self.mode != 'r':
+            for m in (self._data, self._index, self._count, self._mask):
+                if isinstance(m, np.memmap):
+                    m.flush()
+        self._unflushed = 0
+
+    def close(self):
+        self.flush()
+        self._data = self._index = self._count = self._mask = None
+
+    # -- reading -------------------------------------------------------
+
+    def __len__(self):
+        return int(self._count[0])
+
+    def refresh(self):
+        """Pick up rows appended by a writer since the archive was opened."""
+        if len(self) > self.allocated:
+            self._map()
+        return len(self)
+
+    @property
+    def data(self):
+        """(rows x nchan) memory-mapped view of the complete rows."""
+        return self._data[:len(self)]
+
+    @property
+    def index(self):
+        """Memory-mapped index records of the complete rows."""
+        return self._index[:len(self)]
+
+    def time_range(self, start=None, stop=None):
+        """Row slice covering timestamps in [start, stop)."""
+        timestamps = self.index['timestamp']
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, 'left'))
+        last = len(timestamps) if stop is None else int(np.searchsorted(timestamps, stop, 'left'))
+        return slice(first, last)
+
+    def select(self, start=None, stop=None, channels=slice(None)):
+        """Zero-copy view of spectra between two UTC times.
+
+        :param start, stop: unix times bounding the rows, None for open
+        :param channels: slice of channels to keep
+        :return: ``(index_records, spectra)`` views into the archive
+        """
+        rows = self.time_range(start, stop)
+        return self.index[rows], self.data[rows, channels]
+
+    @property
+    def masks(self):
+        """(rows x ceil(nchan / 8)) memory-mapped packed masks of the
+        complete rows."""
+        if not self.masked:
+            raise ValueError('%s keeps no RFI masks' % self.base)
+        return self._mask[:len(self)]
+
+    def select_mask(self, start=None, stop=None, channels=slice(None)):
+        """Boolean RFI mask (True = flagged) matching select().
+
+        Only the mask file is read, ``nchan / 8`` bytes per row.
+        """
+        rows = self.time_range(start, stop)
+        return unpack_mask(self.masks[rows], self.nchan)[:, channels]
+
+
+class ArchiveSink(Sink):
+    """Append every spectrum to a SpectrumArchive, continuing an existing one."""
+
+    def __init__(self, base, nchan, dtype='float32', capacity=4096, meta=None,
+                 masks=False):
+        """
+        :param meta: metadata of a new archive; an existing one is only
+            continued if it was written with the same
+        :param masks: store the RFI mask attached to each spectrum
+        """
+        self.base = base
+        self.nchan = nchan
+        self.dtype = dtype
+        self.capacity = capacity
+        self.meta = meta
+        self.masks = masks
+        self.archive = None
+
+    def open(self):
+        if SpectrumArchive.exists(self.base):
+            self.archive = SpectrumArchive.resume(self.base, self.nchan, self.dtype,
+                                                  self.masks, self.meta)
+            logger.info('appending to %s after its %i rows', self.base, len(self.archive))
+        else:
+            self.archive = SpectrumArchive.create(self.base, self.nchan, self.dtype,
+                                                  self.capacity, self.meta, self.masks)
+
+    def write(self, spectrum):
+        self.archive.append(spectrum.data, spectrum.acc_cnt or 0,
+                            spectrum.timestamp, spectrum.board,
+                            mask=spectrum.mask)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
@@ -0,0 +1,456 @@
+"""
+Continuous raw-baseband capture to disk, one process per component.
+
+The baseband design exposes its complex voltages in four packet buffers,
+packet_buffer_sxr_re_0, _sxr_im_0, _sxl_re_0 and _sxl_im_0 (real and
+imaginary parts of the two polarisations), or streams them over UDP.
+BasebandCapture starts one worker process per source.  Each worker has
+its own connection to the board (or its own socket), so the reads of the
+sources overlap and none of them shares a GIL with the others or with the
+parent, and drains its source into ``<prefix>_<component>.raw`` as fast as
+the source allows.  A BramSource reads the real and imaginary buffers of
+one polarisation back to back in the same process, so the two files of a
+polarisation hold the same refills, row for row, as BasebandFile
+(bingo_backend.dedisperse) pairs them.
+
+A packet buffer is refilled by the firmware every ``nwords`` samples
+whether or not it was read.  With a refill counter register
+(``count_register``), BramSource reads the counter around every buffer
+read: a buffer not refilled since the last read is not written again, a
+read the firmware refilled under is discarded, and refills missed between
+two reads are counted as dropped samples.  Without one a read cannot tell
+a fresh buffer from a stale one, so the capture is recorded as not
+contiguous (``contiguous`` in the sidecar) and its dropped samples are
+estimated from the sample rate.
+
+Samples are collected in a page-aligned buffer of ``block_bytes`` and
+written to disk a whole block at a time, with O_DIRECT where the file
+system supports it, so a long capture streams to disk in large
+sequential writes without filling the page cache.  A JSON sidecar,
+``<prefix>.json``, records the components, sample type, sample rate and
+start time.  A capture never overwrites another: the sidecar and voltage
+files are created with O_EXCL, and if a file of the prefix exists,
+``_1``, ``_2``, ... are appended to the prefix until none does.
+
+Every second each worker reports the bytes and samples it wrote and the
+samples it knows it dropped: refills missed by a BramSource with a
+counter, or datagrams the kernel dropped on a UDP socket.  Given the
+sample rate, BasebandCapture also reports how far each source fell short
+of real time, which is the drop count of a source without a counter.
+"""
+
+from __future__ import division, print_function
+
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import socket
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from .readout import PACKET_BUFFER_DTYPE
+
+logger = logging.getLogger(__name__)
+
+COMPONENTS = ('sxr_re', 'sxr_im', 'sxl_re', 'sxl_im')
+POLARISATIONS = (('sxr_re', 'sxr_im'), ('sxl_re', 'sxl_im'))
+SAMPLE_BYTES = 2                    # PACKET_BUFFER_DTYPE, '>i2'
+DEFAULT_BLOCK_BYTES = 4 * 1024 ** 2
+
+
+def buffer_name(component):
+    """Packet buffer BRAM holding one component, e.g. packet_buffer_sxr_re_0."""
+    return 'packet_buffer_%s_0' % component
+
+
+class BramSource(object):
+    """Packet-buffer reads over the control bus of one board."""
+
+    def __init__(self, host, components, nwords=256, fpg_info=None,
+                 bitstream=None, count_register=None):
+        """
+        :param host: SKARAB hostname or IP, already programmed
+        :param components: one of COMPONENTS, or the pair of a
+            polarisation (see POLARISATIONS), read back to back
+        :param nwords: int16 samples per buffer read
+        :param fpg_info: parsed .fpg header to attach with (see
+            bingo_backend.devices.FpgCache.fpg_info), or
+        :param bitstream: .fpg file to attach with
+        :param count_register: register counting buffer refills, if the
+            design has one; reads are gated on it (see the module
+            docstring), otherwise the capture is not contiguous
+        """
+        if isinstance(components, str):
+            components = (components,)
+        self.host = host
+        self.components = tuple(components)
+        self.component = '+'.join(self.components)     # label of the reports
+        self.nwords = nwords
+        self.nbytes = nwords * SAMPLE_BYTES
+        self.fpg_info = fpg_info
+        self.bitstream = bitstream
+        self.count_register = count_register
+        self.contiguous = count_register is not None
+        self.names = [buffer_name(c) for c in self.components]
+        self._last = None
+
+    def open(self):
+        """Connect; called in the worker process."""
+        import casperfpga
+        self.fpga = casperfpga.CasperFpga(self.host)
+        if self.fpg_info is not None:
+            self.fpga.get_system_information(fpg_info=self.fpg_info)
+        else:
+            self.fpga.get_system_information(self.bitstream)
+
+    def read(self):
+        """Return ``(raw bytes per component, samples known to be
+        dropped)``; the raw bytes are None when there is no new refill."""
+        if self.count_register is None:
+            return [self.fpga.read(name, self.nbytes, 0) for name in self.names], 0
+        count = self.fpga.read_uint(self.count_register)
+        if count == self._last:
+            return None, 0              # still the refill written last time
+        raws = [self.fpga.read(name, self.nbytes, 0) for name in self.names]
+        if self.fpga.read_uint(self.count_register) != count:
+            return None, 0              # refilled mid-read: the parts may not match
+        dropped = 0
+        if self._last is not None:
+            dropped = (count - self._last - 1) % 2 ** 32 * self.nwords
+        self._last = count
+        return raws, dropped
+
+    def close(self):
+        pass
+
+
+class UdpSource(object):
+    """Datagrams of one component streamed to a UDP port."""
+
+    def __init__(self, port, component, bind='', header_bytes=0,
+                 max_packet=9000, rcvbuf=64 * 1024 ** 2):
+        """
+        :param port: UDP port the component is sent to
+        :param component: one of COMPONENTS
+        :param bind: local address to listen on ('' for all)
+        :param header_bytes: bytes at the start of each datagram that are
+            not samples
+        :param max_packet: largest datagram expected
+        :param rcvbuf: kernel receive buffer to ask for, in bytes
+        """
+        self.port = port
+        self.component = component
+        self.components = (component,)
+        self.contiguous = True          # up to the datagrams reported dropped
+        self.bind = bind
+        self.header_bytes = header_bytes
+        self.max_packet = max_packet
+        self.rcvbuf = rcvbuf
+        self._drops = None
+
+    def open(self):
+        """Bind; called in the worker process."""
+        from .spead import kernel_drops
+        self._kernel_drops = kernel_drops
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        self.sock.bind((self.bind, self.port))
+        self.sock.settimeout(0.1)
+        self._packet = bytearray(self.max_packet)
+        self._view = memoryview(self._packet)
+        self._drops = kernel_drops(self.port)
+        self._checked = time.time()
+
+    def read(self):
+        """Return ``([payload], samples known to be dropped)``; the
+        payload is None when nothing arrived."""
+        try:
+            nbytes = self.sock.recv_into(self._view)
+        except socket.timeout:
+            return None, 0
+        dropped = 0
+        now = time.time()
+        if now - self._checked >= 1.0:
+            drops = self._kernel_drops(self.port)
+            if drops is not None and self._drops is not None:
+                # datagrams are assumed to be the size of this one
+                dropped = (drops - self._drops) * (nbytes - self.header_bytes) // SAMPLE_BYTES
+            self._drops = drops
+            self._checked = now
+        return [self._view[self.header_bytes:nbytes]], dropped
+
+    def close(self):
+        self.sock.close()
+
+
+class BlockWriter(object):
+    """Write a stream to a file in whole, page-aligned blocks."""
+
+    def __init__(self, path, block_bytes=DEFAULT_BLOCK_BYTES, direct=True):
+        """
+        :param path: file to create; it must not exist
+        :param block_bytes: bytes per write, a multiple of the page size
+        :param direct: bypass the page cache with O_DIRECT if supported
+        """
+        if block_bytes % mmap.PAGESIZE:
+            raise ValueError('block_bytes must be a multiple of %i' % mmap.PAGESIZE)
+        self.path = path
+        self.block_bytes = block_bytes
+        self._buffer = mmap.mmap(-1, block_bytes)     # page-aligned
+        self._used = 0
+        self.written = 0
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self.direct = False
+        if direct and hasattr(os, 'O_DIRECT'):
+            # set after the exclusive create, which a file system without
+            # O_DIRECT (e.g. tmpfs) could otherwise fail after creating
+            try:
+                fcntl.fcntl(self._fd, fcntl.F_SETFL,
+                            fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_DIRECT)
+                self.direct = True
+            except (IOError, OSError):
+                pass
+
+    def write(self, data):
+        """Append bytes; full blocks go to disk immediately."""
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data), self.block_bytes - self._used)
+            self._buffer[self._used:self._used + n] = data[:n].tobytes()
+            self._used += n
+            data = data[n:]
+            if self._used == self.block_bytes:
+                os.write(self._fd, self._buffer)
+                self.written += self.block_bytes
+                self._used = 0
+
+    def close(self):
+        """Write the last partial block without O_DIRECT and close."""
+        os.close(self._fd)
+        if self._used:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, self._buffer[:self._used])
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.written += self._used
+            self._used = 0
+        self._buffer.close()
+
+
+def _capture(source, paths, block_bytes, halt, reports):
+    """Worker process: drain one source into one file per component
+    until ``halt``."""
+    source.open()
+    writers = [BlockWriter(path, block_bytes) for path in paths]
+    counts = dict(component=source.component, contiguous=source.contiguous,
+                  bytes=0, samples=0, reads=0, dropped=0, errors=0)
+    last = time.time()
+    try:
+        while not halt.is_set():
+            try:
+                raws, dropped = source.read()
+            except Exception as error:
+                counts['errors'] += 1
+                if counts['errors'] == 1:   # once per report
+                    logger.warning('%s: read failed: %s', source.component, error)
+                time.sleep(0.01)
+                continue
+            counts['dropped'] += dropped
+            if raws is not None:
+                for writer, raw in zip(writers, raws):
+                    writer.write(raw)
+                    counts['bytes'] += len(raw)
+                # samples of the stream, the same in every component
+                counts['samples'] += len(raws[0]) // SAMPLE_BYTES
+                counts['reads'] += 1
+            now = time.time()
+            if now - last >= 1.0:
+                counts['elapsed'] = now - last
+                reports.put(dict(counts))
+                for key in ('bytes', 'samples', 'reads', 'dropped', 'errors'):
+                    counts[key] = 0
+                last = now
+    finally:
+        for writer in writers:
+            writer.close()
+        source.close()
+        counts['elapsed'] = time.time() - last
+        counts['final'] = True
+        reports.put(counts)
+
+
+class BasebandCapture(object):
+    """Capture several baseband sources in parallel worker processes."""
+
+    def __init__(self, sources, prefix, sample_rate=None,
+                 block_bytes=DEFAULT_BLOCK_BYTES, meta=None):
+        """
+        :param sources: BramSource (one per polarisation or component) or
+            UdpSource (one per component) objects
+        :param prefix: path prefix; files are <prefix>_<component>.raw,
+            or <prefix>_1_<component>.raw, ... if the prefix is taken
+            (``prefix`` is the one used once started)
+        :param sample_rate: complex samples per second of each component,
+            to report how far the capture falls short of real time
+        :param block_bytes: bytes per disk write
+        :param meta: extra JSON-serialisable metadata for <prefix>.json
+        """
+        self.sources = list(sources)
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self.block_bytes = block_bytes
+        self.meta = dict(meta or {})
+        self.totals = dict((s.component, dict(bytes=0, samples=0, dropped=0,
+                                              errors=0))
+                           for s in self.sources)
+        self._halt = multiprocessing.Event()
+        self._reports = multiprocessing.Queue()
+        self._workers = []
+
+    def path(self, component):
+        return '%s_%s.raw' % (self.prefix, component)
+
+    def _claim(self):
+        """Create the sidecar of the first free prefix, adding _1, _2, ...
+        while a file of the prefix exists; returns its fd."""
+        base = self.prefix
+        components = [c for s in self.sources for c in s.components]
+        sequence = 0
+        while True:
+            prefix = '%s_%i' % (base, sequence) if sequence else base
+            sequence += 1
+            try:
+                fd = os.open(prefix + '.json', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            if not any(os.path.exists('%s_%s.raw' % (prefix, c)) for c in components):
+                break
+            os.close(fd)
+            os.remove(prefix + '.json')
+        if prefix != base:
+            logger.warning('%s is taken, capturing to %s', base, prefix)
+        self.prefix = prefix
+        return fd
+
+    def start(self):
+        """Write the sidecar and start one worker per source."""
+        directory = os.path.dirname(self.prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = self._claim()
+        self.started = time.time()
+        info = dict(self.meta)
+        components = [c for s in self.sources for c in s.components]
+        info.update(components=components,
+                    files=[os.path.basename(self.path(c)) for c in components],
+                    dtype=PACKET_BUFFER_DTYPE, sample_rate=self.sample_rate,
+                    contiguous=all(s.contiguous for s in self.sources),
+                    start=self.started)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        self._halt.clear()
+        for source in self.sources:
+            worker = multiprocessing.Process(
+                target=_capture, name='capture-%s' % source.component,
+                args=(source, [self.path(c) for c in source.components],
+                      self.block_bytes, self._halt, self._reports))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def poll(self, timeout=1.0):
+        """Collect the per-second reports of the workers.
+
+        :return: list of report dicts (component, contiguous, bytes,
+            samples, reads, dropped, errors, elapsed, and ``behind``, the
+            samples short of real time when the sample rate is known,
+            which are the dropped samples of a source that is not
+            contiguous)
+        """
+        reports = []
+        deadline = time.time() + timeout
+        while True:
+            try:
+                report = self._reports.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if self.sample_rate:
+                report['behind'] = max(0, int(self.sample_rate * report['elapsed'])
+                                       - report['samples'])
+                if not report['contiguous']:
+                    report['dropped'] = report['behind']
+            totals = self.totals[report['component']]
+            for key in ('bytes', 'samples', 'dropped', 'errors'):
+                totals[key] += report[key]
+            reports.append(report)
+        return reports
+
+    def stop(self, timeout=5.0):
+        """Stop the workers and collect their final reports."""
+        self._halt.set()
+        final = 0
+        deadline = time.time() + timeout
+        while final < len(self._workers) and time.time() < deadline:
+            final += sum(1 for r in self.poll(0.2) if r.get('final'))
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.time()))
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def run(self, duration=None, out=print):
+        """Capture until ``duration`` seconds pass or Ctrl-C, printing one
+        line per component every second."""
+        self.start()
+        try:
+            while duration is None or time.time() - self.started < duration:
+                for line in self.format(self.poll(1.0)):
+                    out(line)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        for line in self.summary():
+            out(line)
+
+    def format(self, reports):
+        """Printable lines for per-second reports."""
+        lines = []
+        for r in reports:
+            if r.get('final'):
+                continue
+            line = ('%-7s %8.2f MB/s %10i samples %8i dropped'
+                    % (r['component'], r['bytes'] / r['elapsed'] / 1e6,
+                       r['samples'], r['dropped']))
+            if not r['contiguous']:
+                line += ' (estimated, no refill counter)'
+            elif 'behind' in r:
+                line += ' %10i behind real time' % r['behind']
+            if r['errors']:
+                line += ' %i read errors' % r['errors']
+            lines.append(line)
+        return lines
+
+    def summary(self):
+        """Printable totals per source."""
+        elapsed = time.time() - self.started
+        lines = ['%-7s %.1f MB in %.1f s to %s, %i samples dropped'
+                 % (s.component, self.totals[s.component]['bytes'] / 1e6, elapsed,
+                    ', '.join(self.path(c) for c in s.components),
+                    self.totals[s.component]['dropped'])
+                 for s in self.sources]
+        if not all(s.contiguous for s in self.sources):
+            lines.append('not contiguous: the buffers were read without a refill counter')
+        return lines
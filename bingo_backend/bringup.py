@@ -0,0 +1,175 @@
+"""
+Parallel bring-up of the SKARABs at script start.
+
+Programming an .fpg (or just fetching the system information of a board
+that is already programmed) takes seconds per board and is almost all
+waiting on the board, so every board is brought up on its own thread.
+Each board's time and failure are reported, and nothing waits for the
+operator, so a restart after a power glitch runs unattended.
+
+In fast-start mode (program='auto') a board is only programmed when it
+is not known to run the requested image already.  The SHA-256 of the
+.fpg each board was last programmed with is kept in a local state file;
+if it matches and the board reports a running user image, the board is
+only attached to with get_system_information(), which takes about a
+second instead of tens of seconds.  Attaching uses the parsed .fpg
+header from bingo_backend.devices.FpgCache, so the file is not parsed
+again either.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .devices import FpgCache
+from .parallel import fan_out
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_FILE = os.path.join(os.path.expanduser('~'), '.bingo_backend',
+                                  'programmed.json')
+
+
+def fpg_fingerprint(path, chunk_size=1 << 20):
+    """SHA-256 hex digest of an .fpg file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ProgramState(object):
+    """Local record of the .fpg fingerprint each board was programmed with."""
+
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.boards = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.boards = {}
+
+    def get(self, host):
+        """Fingerprint last programmed into ``host``, or None."""
+        with self._lock:
+            return self.boards.get(host)
+
+    def set(self, host, fingerprint):
+        with self._lock:
+            self.boards[host] = fingerprint
+
+    def forget(self, host):
+        with self._lock:
+            self.boards.pop(host, None)
+
+    def save(self):
+        """Write the state file atomically."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump(self.boards, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.path)
+
+
+def _is_running(fpga):
+    """True if the board reports a running user image (not the golden one)."""
+    try:
+        return bool(fpga.is_running())
+    except Exception:
+        return False
+
+
+def bring_up(hosts, bitstream, program=True, board_class=None, pool=None,
+             state=None, cache=None, fingerprint=None):
+    """Connect to every board and program it, or only attach to it.
+
+    :param hosts: SKARAB hostnames or IPs, master first
+    :param bitstream: .fpg file to program, or whose metadata to attach
+        with
+    :param program: True to upload_to_ram_and_program() every board,
+        False to only get_system_information(), 'auto' to program only
+        the boards not already running ``bitstream``
+    :param board_class: board constructor, casperfpga.CasperFpga by
+        default
+    :param pool: thread pool to use (see bingo_backend.parallel.fan_out)
+    :param state: ProgramState to check and update, by default the one
+        in DEFAULT_STATE_FILE
+    :param cache: bingo_backend.devices.FpgCache holding the parsed .fpg
+        header used when attaching, by default the one in the user's home
+    :param fingerprint: fpg_fingerprint(bitstream), if already known
+    :return: one bingo_backend.parallel.BoardResult per host, in order,
+        holding the connected board object or the error; ``detail`` says
+        whether the board was 'programmed' or 'attached'
+    """
+    if board_class is None:
+        import casperfpga
+        board_class = casperfpga.CasperFpga
+    if state is None:
+        state = ProgramState()
+    if cache is None:
+        cache = FpgCache()
+    if fingerprint is None:
+        fingerprint = fpg_fingerprint(bitstream)
+    fpg_info = None
+    if program is not True:
+        try:
+            fpg_info = cache.fpg_info(bitstream, fingerprint)
+        except Exception as error:
+            logger.warning('no cached metadata for %s: %s', bitstream, error)
+    actions = {}
+
+    def system_information(fpga):
+        if fpg_info is not None:
+            fpga.get_system_information(fpg_info=fpg_info)
+        else:
+            fpga.get_system_information(bitstream)
+
+    def attach(host):
+        fpga = board_class(host)
+        if program == 'auto' and state.get(host) == fingerprint:
+            system_information(fpga)
+            if _is_running(fpga):
+                actions[host] = 'attached'
+                return fpga
+            logger.info('%s: not running %s, programming', host, bitstream)
+        if program:
+            state.forget(host)
+            fpga.upload_to_ram_and_program(bitstream)
+            state.set(host, fingerprint)
+            actions[host] = 'programmed'
+        else:
+            system_information(fpga)
+            actions[host] = 'attached'
+        return fpga
+
+    results = fan_out(attach, hosts, pool)
+    for host, result in zip(hosts, results):
+        result.detail = actions.get(host)
+    if program:
+        try:
+            state.save()
+        except (IOError, OSError) as error:
+            logger.warning('could not save %s: %s', state.path, error)
+    return results
+
+
+def report(hosts, results):
+    """One printable line per board with its bring-up time or error."""
+    lines = []
+    for host, result in zip(hosts, results):
+        if result.ok:
+            lines.append('%s: %s in %.1f s' % (host, result.detail or 'ready',
+                                                result.elapsed))
+        else:
+            lines.append('%s: FAILED after %.1f s: %s'
+                         % (host, result.elapsed, result.error))
+    return lines
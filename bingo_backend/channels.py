@@ -0,0 +1,158 @@
+"""
+Frequency axes and channel maps of the spectrometer designs.
+
+The accumulator BRAMs hold the channels in FFT order, and each design
+needs its own reordering ([::-1] and/or fftshift) and frequency axis.
+ChannelMap captures both for one firmware mode, decimation, sampling
+rate and DDC centre frequency: the axis in MHz, the reordering as one
+precomputed permutation (a single np.take per dump), and lookups between
+frequency and channel in either order.  Maps and axes only change with
+the configuration, so they are built once and shared read-only by every
+caller.
+
+    MODES      nchan  decimation  reorder
+    dec16_32k  32768  16          [::-1], fftshift
+    dec8_1k     1024   8          [::-1], fftshift
+    dec8_8k     8192   8          [::-1], fftshift
+    baseband    256  128          none
+
+The channels of every mode span the whole decimated band, sample_rate /
+decimation (187.5 MHz at 3 GSa/s / 16), the same rate that sets the
+spectrum and dump periods in bingo_backend.scheduler.dump_period.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+_axes = {}
+
+
+def frequency_axis(centre_freq, bandwidth, nchan, step=1):
+    """Centre frequency of every channel in MHz, cached per configuration.
+
+    Channel ``nchan // 2`` sits at the centre frequency and channels are
+    ``bandwidth / nchan`` apart, increasing with the channel index if
+    ``step`` is 1 and decreasing if it is -1.
+
+    :param centre_freq: DDC centre frequency, Hz
+    :param bandwidth: processed bandwidth, Hz
+    :param nchan: number of channels
+    :return: read-only float64 array shared between callers
+    """
+    key = (float(centre_freq), float(bandwidth), int(nchan), step)
+    axis = _axes.get(key)
+    if axis is None:
+        spacing = step * bandwidth / nchan / 1e6
+        axis = centre_freq / 1e6 + spacing * (np.arange(nchan) - nchan // 2)
+        axis.flags.writeable = False
+        _axes[key] = axis
+    return axis
+
+
+# nchan, default decimation, axis direction, and the reordering of the
+# BRAM contents
+MODES = {
+    'dec16_32k': dict(nchan=32768, decimation=16, step=-1,
+                      reverse=True, shift=True),
+    'dec8_1k': dict(nchan=1024, decimation=8, step=1,
+                    reverse=True, shift=True),
+    # planned 8192-bin version of decimation8_1k
+    'dec8_8k': dict(nchan=8192, decimation=8, step=1,
+                    reverse=True, shift=True),
+    'baseband': dict(nchan=256, decimation=128, step=1,
+                     reverse=False, shift=False),
+}
+
+_maps = {}
+
+
+class ChannelMap(object):
+    """Channel order and frequency axis of one firmware configuration."""
+
+    def __init__(self, nchan, bandwidth, centre_freq=0.0, step=1,
+                 reverse=False, shift=False):
+        """
+        :param nchan: number of channels
+        :param bandwidth: band spanned by the channels, Hz
+        :param centre_freq: DDC centre frequency, Hz
+        :param step: 1 if frequency increases along the displayed
+            channels, -1 if it decreases
+        :param reverse: the BRAM holds the channels in reverse order
+        :param shift: the BRAM holds the channels in FFT order (DC first)
+        """
+        self.nchan = nchan
+        self.bandwidth = bandwidth
+        self.centre_freq = centre_freq
+        self.step = step
+        self.channel_width = bandwidth / nchan
+        self.mode = None            # set by for_mode()
+        self.sample_rate = None     # complex samples per second, ditto
+        perm = np.arange(nchan)
+        if reverse:
+            perm = perm[::-1]
+        if shift:
+            perm = np.fft.fftshift(perm)
+        # display channel d is BRAM channel perm[d]
+        self.perm = np.ascontiguousarray(perm)
+        self.perm.flags.writeable = False
+        self.inverse = np.empty_like(self.perm)
+        self.inverse[self.perm] = np.arange(nchan)
+        self.inverse.flags.writeable = False
+        self.freqs = frequency_axis(centre_freq, bandwidth, nchan, step)
+
+    @classmethod
+    def for_mode(cls, mode, centre_freq=0.0, sample_rate=3000e6,
+                 decimation=None):
+        """Shared ChannelMap of a firmware mode, see MODES.
+
+        :param mode: 'dec16_32k', 'dec8_1k', 'dec8_8k' or 'baseband'
+        :param centre_freq: DDC centre frequency, Hz
+        :param sample_rate: ADC sampling rate, Hz (the scripts' -s)
+        :param decimation: DDC decimation, by default the mode's own
+        """
+        spec = MODES[mode]
+        if decimation is None:
+            decimation = spec['decimation']
+        key = (mode, float(centre_freq), float(sample_rate), int(decimation))
+        channel_map = _maps.get(key)
+        if channel_map is None:
+            channel_map = cls(spec['nchan'], sample_rate / decimation,
+                              centre_freq, spec['step'], spec['reverse'],
+                              spec['shift'])
+            channel_map.mode = mode
+            channel_map.sample_rate = sample_rate / decimation
+            _maps[key] = channel_map
+        return channel_map
+
+    def reorder(self, data, out=None):
+        """Spectra (..., nchan) from BRAM order into display order.
+
+        One gather through the precomputed permutation; pass ``out`` to
+        reuse a buffer instead of allocating one.
+        """
+        return np.take(data, self.perm, axis=-1, out=out)
+
+    def channel(self, freq, raw=False):
+        """Nearest channel to a frequency in MHz (scalar or array).
+
+        :param raw: return the BRAM channel instead of the display one
+        """
+        index = np.rint((np.asarray(freq) - self.centre_freq / 1e6) /
+                        (self.step * self.channel_width / 1e6)) + self.nchan // 2
+        index = np.clip(index, 0, self.nchan - 1).astype(np.intp)
+        if raw:
+            index = self.perm[index]
+        return index if index.ndim else int(index)
+
+    def frequency(self, channel, raw=False):
+        """Frequency in MHz of a display (or, with ``raw``, BRAM) channel."""
+        channel = np.asarray(channel)
+        if raw:
+            channel = self.inverse[channel]
+        return self.freqs[channel]
+
+    def channels(self, lo, hi):
+        """Slice of display channels covering frequencies lo..hi MHz."""
+        a, b = sorted((self.channel(lo), self.channel(hi)))
+        return slice(a, b + 1)
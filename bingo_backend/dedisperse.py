@@ -0,0 +1,308 @@
+"""
+Offline coherent dedispersion and folding of captured baseband.
+
+Works on the files written by bingo_backend.baseband: a ``<prefix>.json``
+sidecar and one big-endian int16 file per component, which pair up into
+the complex voltages of each polarisation (sxr_re + i sxr_im, sxl_re +
+i sxl_im).  The files are memory-mapped, so a multi-hour capture is never
+loaded as a whole.
+
+Coherent dedispersion uses overlap-save: the stream is cut into blocks of
+``nfft`` samples that overlap by the dispersive smearing across the band,
+each block is transformed, multiplied by the inverse interstellar chirp
+
+    H(f) = exp(-2 pi i K_DM DM f^2 / (f0^2 (f0 + f)))   (f, f0 in MHz)
+
+(its group delay advances every frequency by its dispersion_delay()), and
+transformed back, and the samples the circular convolution wrapped around
+are discarded.  The detected power of both polarisations is then
+folded at the pulsar period into a profile of ``nbins`` phase bins.
+
+Blocks are independent, so they are spread over a process pool; each
+worker maps the files itself and returns only a partial profile, which
+keeps memory bounded by a few blocks per worker whatever the capture
+length.
+
+    python -m bingo_backend.dedisperse <prefix> --dm 26.76 --period 0.7145
+"""
+
+from __future__ import division, print_function
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from .baseband import POLARISATIONS
+
+logger = logging.getLogger(__name__)
+
+K_DM = 4.148808e3          # dispersion constant, s MHz^2 / (pc cm^-3)
+
+
+def dispersion_delay(dm, f_lo, f_hi):
+    """Delay in seconds of f_lo relative to f_hi (MHz) at a given DM."""
+    return K_DM * dm * (f_lo ** -2 - f_hi ** -2)
+
+
+def chirp(nfft, sample_rate, centre_freq, dm, sideband=1):
+    """Inverse dispersion filter for the FFT bins of a complex block.
+
+    :param nfft: block length
+    :param sample_rate: complex samples per second
+    :param centre_freq: sky frequency of the band centre, Hz
+    :param dm: dispersion measure, pc cm^-3
+    :param sideband: 1 if the band is upper sideband, -1 if inverted
+    """
+    f = sideband * np.fft.fftfreq(nfft, 1.0 / sample_rate) / 1e6   # MHz
+    f0 = centre_freq / 1e6
+    phase = 2 * np.pi * 1e6 * K_DM * dm * f ** 2 / (f0 ** 2 * (f0 + f))
+    # the conjugate of the interstellar response: its group delay,
+    # -d(phase)/(2 pi df), advances each frequency by dispersion_delay()
+    return np.exp(-1j * phase).astype(np.complex64)
+
+
+class BasebandFile(object):
+    """Memory-mapped complex voltages of a baseband capture."""
+
+    def __init__(self, prefix):
+        """:param prefix: path prefix given to BasebandCapture"""
+        self.prefix = prefix
+        with open(prefix + '.json') as f:
+            self.meta = json.load(f)
+        dtype = np.dtype(str(self.meta.get('dtype', '>i2')))
+        directory = os.path.dirname(prefix)
+        files = dict(zip(self.meta['components'], self.meta['files']))
+        self.pols = []
+        for re, im in POLARISATIONS:
+            if re in files and im in files:
+                self.pols.append((np.memmap(os.path.join(directory, files[re]), dtype, 'r'),
+                                  np.memmap(os.path.join(directory, files[im]), dtype, 'r')))
+        if not self.pols:
+            raise ValueError('%s holds no complete polarisation' % prefix)
+        self.nsamples = min(min(len(re), len(im)) for re, im in self.pols)
+        self.sample_rate = self.meta.get('sample_rate')
+        # captures that do not record it predate the refill check
+        self.contiguous = bool(self.meta.get('contiguous', False))
+
+    def read(self, start, count):
+        """(polarisations x count) complex64 samples, zero past the end."""
+        out = np.zeros((len(self.pols), count), dtype=np.complex64)
+        stop = min(start + count, self.nsamples)
+        if stop > start:
+            for p, (re, im) in enumerate(self.pols):
+                out[p, :stop - start].real = re[start:stop]
+                out[p, :stop - start].imag = im[start:stop]
+        return out
+
+
+class DedispersionPlan(object):
+    """Block size, overlap and filter of an overlap-save dedispersion."""
+
+    def __init__(self, sample_rate, centre_freq, dm, nfft=None, sideband=1):
+        """
+        :param sample_rate: complex samples per second
+        :param centre_freq: sky frequency of the band centre, Hz
+        :param dm: dispersion measure, pc cm^-3
+        :param nfft: block length; by default the smallest power of two
+            at least four times the overlap (and at least 4096)
+        :param sideband: 1 for an upper, -1 for an inverted band
+        """
+        self.sample_rate = sample_rate
+        self.centre_freq = centre_freq
+        self.dm = dm
+        half = sample_rate / 2 / 1e6
+        f0 = centre_freq / 1e6
+        smear = dispersion_delay(dm, f0 - half, f0 + half)
+        # an even overlap, split between the two ends of a block
+        self.overlap = 2 * int(np.ceil(smear * sample_rate / 2))
+        if nfft is None:
+            nfft = max(4096, 1 << int(np.ceil(np.log2(4 * max(self.overlap, 1)))))
+        if nfft <= self.overlap:
+            raise ValueError('nfft=%i is not longer than the dispersive '
+                             'overlap of %i samples' % (nfft, self.overlap))
+        self.nfft = nfft
+        self.step = nfft - self.overlap
+        self.sideband = sideband
+
+    def nblocks(self, nsamples):
+        """Blocks needed to cover ``nsamples`` dedispersed samples."""
+        return max(0, int(np.ceil((nsamples - self.overlap) / self.step)))
+
+    def filter(self):
+        return chirp(self.nfft, self.sample_rate, self.centre_freq, self.dm,
+                     self.sideband)
+
+    def dedisperse(self, block, response):
+        """Dedisperse a (pols x nfft) block; returns the valid samples."""
+        spectrum = np.fft.fft(block, axis=-1)
+        spectrum *= response
+        half = self.overlap // 2
+        return np.fft.ifft(spectrum, axis=-1)[:, half:half + self.step]
+
+
+def fold_samples(power, first, sample_rate, period, nbins, sums, counts):
+    """Add detected power to a folded profile.
+
+    :param power: detected power of consecutive samples
+    :param first: index of the first sample in the capture
+    :return: nothing; ``sums`` and ``counts`` are updated in place
+    """
+    t = (first + np.arange(len(power), dtype=np.float64)) / sample_rate
+    bins = (np.mod(t / period, 1.0) * nbins).astype(np.intp) % nbins
+    sums += np.bincount(bins, weights=power, minlength=nbins)
+    counts += np.bincount(bins, minlength=nbins)
+
+
+_worker = {}
+
+
+def _init_worker(prefix, plan, period, nbins):
+    _worker.update(data=BasebandFile(prefix), plan=plan, period=period,
+                   nbins=nbins, response=plan.filter())
+
+
+def _fold_block(k):
+    """Dedisperse and fold block ``k`` in a worker process."""
+    data, plan = _worker['data'], _worker['plan']
+    nbins = _worker['nbins']
+    start = k * plan.step
+    voltages = plan.dedisperse(data.read(start, plan.nfft), _worker['response'])
+    first = start + plan.overlap // 2
+    valid = min(plan.step, data.nsamples - plan.overlap // 2 - first)
+    power = (voltages.real ** 2 + voltages.imag ** 2).sum(axis=0)[:valid]
+    sums = np.zeros(nbins)
+    counts = np.zeros(nbins, dtype=np.int64)
+    fold_samples(power, first, plan.sample_rate, _worker['period'], nbins,
+                 sums, counts)
+    return sums, counts, valid
+
+
+class Profile(object):
+    """A folded pulse profile."""
+
+    def __init__(self, sums, counts, period, dm, samples, nbytes, elapsed):
+        self.sums = sums
+        self.counts = counts
+        self.period = period
+        self.dm = dm
+        self.samples = samples      # dedispersed samples folded
+        self.nbytes = nbytes        # bytes of capture they came from
+        self.elapsed = elapsed      # wall-clock seconds spent
+
+    @property
+    def intensity(self):
+        """Mean detected power per phase bin."""
+        return self.sums / np.maximum(self.counts, 1)
+
+    @property
+    def phase(self):
+        return np.arange(len(self.sums)) / len(self.sums)
+
+    def save(self, path):
+        """Write phase, mean power and sample count per bin as text."""
+        np.savetxt(path, np.column_stack([self.phase, self.intensity, self.counts]),
+                   fmt=['%.6f', '%.8e', '%i'],
+                   header='period %.12g s, DM %.6g pc cm^-3\nphase power count'
+                   % (self.period, self.dm))
+
+
+def fold(prefix, dm, period, nbins=256, centre_freq=None, sample_rate=None,
+         nfft=None, sideband=1, processes=None, progress=None):
+    """Coherently dedisperse a baseband capture and fold it.
+
+    :param prefix: path prefix of the capture
+    :param dm: dispersion measure, pc cm^-3
+    :param period: folding period, s
+    :param nbins: phase bins of the profile
+    :param centre_freq: sky frequency of the band centre in Hz; by
+        default the DDC frequency recorded in the capture
+    :param sample_rate: complex samples per second; by default the rate
+        recorded in the capture
+    :param nfft: block length, see DedispersionPlan
+    :param sideband: 1 for an upper, -1 for an inverted band
+    :param processes: worker processes, by default one per core
+    :param progress: optional callable(blocks_done, blocks_total)
+    :return: Profile
+    """
+    data = BasebandFile(prefix)
+    if not data.contiguous:
+        logger.warning('%s is not a contiguous capture: the buffers were read without '
+                       'a refill counter, so the profile is not coherent', prefix)
+    if sample_rate is None:
+        sample_rate = data.sample_rate
+    if centre_freq is None:
+        centre_freq = data.meta.get('ddc_freq')
+    if not sample_rate or not centre_freq:
+        raise ValueError('the capture does not record its sample rate and '
+                         'centre frequency; pass them explicitly')
+    plan = DedispersionPlan(sample_rate, centre_freq, dm, nfft, sideband)
+    nblocks = plan.nblocks(data.nsamples)
+    sums = np.zeros(nbins)
+    counts = np.zeros(nbins, dtype=np.int64)
+    samples = 0
+    start = time.time()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (prefix, plan, period, nbins))
+    try:
+        chunksize = max(1, nblocks // (8 * (processes or multiprocessing.cpu_count())))
+        for done, (s, c, n) in enumerate(pool.imap_unordered(_fold_block, range(nblocks),
+                                                             chunksize), 1):
+            sums += s
+            counts += c
+            samples += n
+            if progress is not None:
+                progress(done, nblocks)
+    finally:
+        pool.close()
+        pool.join()
+    nbytes = samples * len(data.pols) * 2 * data.pols[0][0].dtype.itemsize
+    return Profile(sums, counts, period, dm, samples, nbytes, time.time() - start)
+
+
+def main():
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('python -m bingo_backend.dedisperse <capture prefix> [options]')
+    p.set_description(__doc__)
+    p.add_option('--dm', dest='dm', type='float', default=0.0,
+                 help='Dispersion measure in pc cm^-3. Default 0.')
+    p.add_option('--period', dest='period', type='float',
+                 help='Folding period in seconds.')
+    p.add_option('-n', '--nbins', dest='nbins', type='int', default=256,
+                 help='Phase bins. Default 256.')
+    p.add_option('-f', '--freq', dest='freq', type='float', default=0.0,
+                 help='Sky frequency of the band centre in MHz. Default: from the capture.')
+    p.add_option('-s', '--sample_rate', dest='sample_rate', type='float', default=0.0,
+                 help='Complex sample rate in MHz. Default: from the capture.')
+    p.add_option('--nfft', dest='nfft', type='int', default=0,
+                 help='FFT block length. Default: 4x the dispersive overlap.')
+    p.add_option('--lsb', dest='sideband', action='store_const', const=-1, default=1,
+                 help='The band is inverted (lower sideband).')
+    p.add_option('-j', '--processes', dest='processes', type='int', default=0,
+                 help='Worker processes. Default: one per core.')
+    p.add_option('-o', '--output', dest='output', type='str', default='',
+                 help='Profile file. Default <prefix>.profile.txt')
+    opts, args = p.parse_args()
+    if len(args) != 1 or opts.period is None:
+        p.error('give a capture prefix and --period')
+    prefix = args[0]
+    profile = fold(prefix, opts.dm, opts.period, opts.nbins,
+                   centre_freq=opts.freq * 1e6 or None,
+                   sample_rate=opts.sample_rate * 1e6 or None,
+                   nfft=opts.nfft or None, sideband=opts.sideband,
+                   processes=opts.processes or None)
+    output = opts.output or prefix + '.profile.txt'
+    profile.save(output)
+    print('folded %i samples in %.1f s (%.1f MB/s of capture) into %s'
+          % (profile.samples, profile.elapsed,
+             profile.nbytes / profile.elapsed / 1e6, output))
+    print('peak at phase %.4f' % profile.phase[np.argmax(profile.intensity)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Device discovery for an attached design, cached per .fpg file.
+
+discover_devices() classifies every device of a board (SKARAB ADC yellow
+blocks, BRAMs, software registers, snapshots) in a single sweep over
+memory_devices, and keeps the ADC yellow blocks in the order the scripts
+need them: Master first, then the Slaves.
+
+FpgCache keeps, per .fpg SHA-256, both the parsed .fpg header that
+casperfpga's get_system_information() builds its devices from and the
+resulting DeviceMap.  Attaching to a board that already runs the design
+can then skip parsing the .fpg file altogether.
+"""
+
+from __future__ import division, print_function
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+ADC_TAGS = ('xps:skarab_adc4x3g_14', 'xps:skarab_adc4x3g_14_byp')
+BRAM_TAGS = ('xps:bram',)
+REGISTER_TAGS = ('xps:sw_reg',)
+SNAPSHOT_TAGS = ('xps:snapshot',)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.bingo_backend',
+                                 'fpg_cache')
+
+
+class DeviceMap(object):
+    """The devices of one design, by kind."""
+
+    KINDS = ('adcs', 'brams', 'registers', 'snapshots', 'other')
+
+    def __init__(self, adcs=(), adc_sites=(), adc_tag='', brams=(),
+                 registers=(), snapshots=(), other=()):
+        self.adcs = list(adcs)              # ADC yellow blocks, Master first
+        self.adc_sites = list(adc_sites)    # mezzanine site of each ADC
+        self.adc_tag = adc_tag              # tag of the Master ADC
+        self.brams = list(brams)
+        self.registers = list(registers)
+        self.snapshots = list(snapshots)
+        self.other = list(other)
+
+    def to_dict(self):
+        d = dict((kind, getattr(self, kind)) for kind in self.KINDS)
+        d['adc_sites'] = self.adc_sites
+        d['adc_tag'] = self.adc_tag
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**_native(d))
+
+    def __repr__(self):
+        return 'DeviceMap(%s)' % ', '.join('%s=%i' % (kind, len(getattr(self, kind)))
+                                           for kind in self.KINDS)
+
+
+def discover_devices(fpga):
+    """Classify every memory device of an attached board in one pass."""
+    masters, slaves = [], []
+    found = dict((kind, []) for kind in DeviceMap.KINDS)
+    for name, device in fpga.memory_devices.items():
+        info = getattr(device, 'device_info', None)
+        tag = info.get('tag') if info else None
+        if tag in ADC_TAGS:
+            entry = (name, device.mezzanine_site, tag)
+            if device.master_slave == 'Master':
+                masters.append(entry)
+            else:
+                slaves.append(entry)
+        elif tag in BRAM_TAGS:
+            found['brams'].append(name)
+        elif tag in REGISTER_TAGS:
+            found['registers'].append(name)
+        elif tag in SNAPSHOT_TAGS:
+            found['snapshots'].append(name)
+        else:
+            found['other'].append(name)
+    adcs = sorted(masters) + sorted(slaves)
+    return DeviceMap(adcs=[name for name, site, tag in adcs],
+                     adc_sites=[site for name, site, tag in adcs],
+                     adc_tag=masters[0][2] if masters else '',
+                     brams=sorted(found['brams']),
+                     registers=sorted(found['registers']),
+                     snapshots=sorted(found['snapshots']),
+                     other=sorted(found['other']))
+
+
+def _native(obj):
+    """Turn the unicode strings json gives on Python 2 back into str."""
+    if isinstance(obj, dict):
+        return dict((_native(k), _native(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_native(v) for v in obj]
+    if str is bytes and isinstance(obj, type(u'')):
+        return obj.encode('utf-8')
+    return obj
+
+
+class FpgCache(object):
+    """Parsed .fpg metadata and device maps on disk, keyed by .fpg hash."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, fingerprint):
+        return os.path.join(self.directory, fingerprint + '.json')
+
+    def load(self, fingerprint):
+        """The cache entry of an .fpg, or an empty dict."""
+        try:
+            with open(self._path(fingerprint)) as f:
+                return _native(json.load(f))
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def update(self, fingerprint, **fields):
+        """Add fields to the cache entry of an .fpg (atomic write)."""
+        entry = self.load(fingerprint)
+        entry.update(fields)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(fingerprint)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as error:
+            logger.warning('could not write %s: %s', path, error)
+
+    def fpg_info(self, bitstream, fingerprint):
+        """(device_dict, memorymap_dict) of an .fpg, as parse_fpg() returns.
+
+        Pass it to CasperFpga.get_system_information(fpg_info=...) to
+        attach without parsing the file.
+        """
+        entry = self.load(fingerprint)
+        if 'fpg_info' in entry:
+            return tuple(entry['fpg_info'])
+        from casperfpga.utils import parse_fpg
+        fpg_info = parse_fpg(bitstream)
+        self.update(fingerprint, fpg_info=list(fpg_info))
+        return fpg_info
+
+    def device_map(self, fpga, fingerprint):
+        """DeviceMap of the design, discovered from ``fpga`` on a miss."""
+        entry = self.load(fingerprint)
+        if 'devices' in entry:
+            return DeviceMap.from_dict(entry['devices'])
+        devices = discover_devices(fpga)
+        self.update(fingerprint, devices=devices.to_dict())
+        return devices
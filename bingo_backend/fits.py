@@ -0,0 +1,239 @@
+"""
+Streaming FITS writer for time-ordered spectra.
+
+Each file holds an empty primary HDU whose header carries the instrument
+configuration (acc_len, fft_shift, DDC centre frequency, gains, ...) and
+one binary-table extension, SPECTRA, with one row per accumulation and
+board:
+
+    ACC_CNT  K   accumulation counter
+    TIME     D   UTC unix time of the dump [s]
+    BOARD    J   board number
+    DATA     nE  spectrum, float32
+
+Rows are collected in a pre-allocated big-endian buffer and written in
+chunks of ``rows_per_chunk``, or every ``flush_seconds`` by FitsSink.
+After every chunk the data unit is padded to a whole block and the
+NAXIS2 card is rewritten in place, so the file on disk is a valid FITS
+file up to the last chunk even if acquisition stops abruptly; the next
+chunk overwrites the padding.  A new file is started
+once the current one reaches ``max_bytes`` or ``max_seconds``.  Files are
+named ``<prefix>_<UTC of the first spectrum>.fits``; the name is claimed
+with O_EXCL, and ``_1``, ``_2``, ... are appended while it is taken, so
+two files started in one second, or a restarted run, never overwrite
+one another.
+
+The format is written directly (2880-byte blocks, 80-character cards),
+so no FITS library is needed on the acquisition host; the files read
+back with astropy.io.fits or any other FITS reader.
+"""
+
+from __future__ import division, print_function
+
+import errno
+import os
+import time
+
+import numpy as np
+
+from .sinks import Sink
+
+BLOCK = 2880
+CARD = 80
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '%20s' % ('T' if value else 'F')
+    if isinstance(value, (int, np.integer)):
+        return '%20d' % value
+    if isinstance(value, (float, np.floating)):
+        text = '%.16G' % value
+        if '.' not in text and 'E' not in text:
+            text += '.0'
+        return '%20s' % text
+    text = "'%-8s'" % str(value).replace("'", "''")
+    return '%-20s' % text
+
+
+def card(keyword, value=None, comment=''):
+    """One 80-character FITS header card."""
+    if value is None:
+        text = '%-8s' % keyword
+    else:
+        text = '%-8s= %s' % (keyword.upper()[:8], _format_value(value))
+    if comment:
+        text += ' / ' + comment
+    return ('%-80s' % text)[:CARD]
+
+
+def header_block(cards):
+    """Header bytes (cards + END), padded to whole FITS blocks."""
+    text = ''.join(cards) + '%-80s' % 'END'
+    text += ' ' * (-len(text) % BLOCK)
+    return text.encode('ascii')
+
+
+def row_dtype(nchan):
+    """Big-endian record layout of one SPECTRA table row."""
+    return np.dtype([('ACC_CNT', '>i8'), ('TIME', '>f8'), ('BOARD', '>i4'),
+                     ('DATA', '>f4', (nchan,))])
+
+
+class FitsSpectrumWriter(object):
+    """Append spectra to a sequence of rolling FITS files."""
+
+    def __init__(self, prefix, nchan, meta=None, rows_per_chunk=64,
+                 max_bytes=2 * 1024 ** 3, max_seconds=3600.0):
+        """
+        :param prefix: path prefix; files are <prefix>_<UTC start>.fits
+        :param nchan: channels per spectrum
+        :param meta: ordered (keyword, value[, comment]) tuples or a dict
+            of primary header cards, e.g. ACC_LEN, FFTSHIFT, DDC_FREQ
+        :param rows_per_chunk: rows buffered between writes
+        :param max_bytes: start a new file past this size
+        :param max_seconds: start a new file after this long
+        """
+        self.prefix = prefix
+        self.nchan = nchan
+        if isinstance(meta, dict):
+            meta = sorted(meta.items())
+        self.meta = list(meta or [])
+        self.rows_per_chunk = rows_per_chunk
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.dtype = row_dtype(nchan)
+        self._buffer = np.zeros(rows_per_chunk, dtype=self.dtype)
+        self._buffered = 0
+        self._file = None
+        self.path = None
+        self.files = []
+
+    # -- file handling -------------------------------------------------
+
+    def _primary_cards(self, start):
+        cards = [card('SIMPLE', True, 'conforms to FITS standard'),
+                 card('BITPIX', 8), card('NAXIS', 0), card('EXTEND', True),
+                 card('ORIGIN', 'BINGO SKARAB backend'),
+                 card('DATE', time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(start)),
+                      'UTC of first spectrum')]
+        for item in self.meta:
+            cards.append(card(*item))
+        return cards
+
+    def _table_cards(self, rows):
+        return [card('XTENSION', 'BINTABLE', 'binary table extension'),
+                card('BITPIX', 8), card('NAXIS', 2),
+                card('NAXIS1', self.dtype.itemsize, 'bytes per row'),
+                card('NAXIS2', rows, 'number of rows'),
+                card('PCOUNT', 0), card('GCOUNT', 1), card('TFIELDS', 4),
+                card('TTYPE1', 'ACC_CNT'), card('TFORM1', 'K'),
+                card('TTYPE2', 'TIME'), card('TFORM2', 'D'), card('TUNIT2', 's'),
+                card('TTYPE3', 'BOARD'), card('TFORM3', 'J'),
+                card('TTYPE4', 'DATA'), card('TFORM4', '%iE' % self.nchan),
+                card('EXTNAME', 'SPECTRA')]
+
+    def _create(self, start):
+        """Create a new file named after ``start``; returns its path and fd."""
+        stem = '%s_%s' % (self.prefix, time.strftime('%Y%m%d_%H%M%S', time.gmtime(start)))
+        directory = os.path.dirname(stem)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        sequence = 0
+        while True:
+            path = '%s_%i.fits' % (stem, sequence) if sequence else stem + '.fits'
+            try:
+                return path, os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            sequence += 1
+
+    def _open(self, start):
+        self.path, fd = self._create(start)
+        self._file = os.fdopen(fd, 'wb')
+        self._file.write(header_block(self._primary_cards(start)))
+        self._table_offset = self._file.tell()
+        self._file.write(header_block(self._table_cards(0)))
+        self._data_offset = self._size = self._file.tell()
+        self._rows = 0
+        self._opened = time.time()
+        self.files.append(self.path)
+
+    def _update_rows(self):
+        """Rewrite the NAXIS2 card (the fifth card of the table header)."""
+        self._file.seek(self._table_offset + 4 * CARD)
+        self._file.write(card('NAXIS2', self._rows, 'number of rows').encode('ascii'))
+
+    def _close_file(self):
+        self._write_chunk()
+        self._file.close()
+        self._file = None
+
+    def _write_chunk(self):
+        if not self._buffered:
+            return
+        # over the padding of the previous chunk
+        self._file.seek(self._data_offset + self._rows * self.dtype.itemsize)
+        self._file.write(self._buffer[:self._buffered].tobytes())
+        self._rows += self._buffered
+        self._buffered = 0
+        self._file.write(b'\0' * (-self._rows * self.dtype.itemsize % BLOCK))
+        self._size = self._file.tell()
+        self._update_rows()
+        self._file.flush()
+
+    # -- public --------------------------------------------------------
+
+    def append(self, data, acc_cnt, timestamp, board=0):
+        """Add one spectrum (or one row per board of a 2-D array)."""
+        if self._file is not None and (
+                self._size >= self.max_bytes or
+                time.time() - self._opened >= self.max_seconds):
+            self._close_file()
+        if self._file is None:
+            self._open(timestamp)
+        for i, row in enumerate(np.atleast_2d(data)):
+            record = self._buffer[self._buffered]
+            record['ACC_CNT'] = acc_cnt
+            record['TIME'] = timestamp
+            record['BOARD'] = board + i
+            record['DATA'] = row
+            self._buffered += 1
+            if self._buffered == self.rows_per_chunk:
+                self._write_chunk()
+
+    def flush(self):
+        """Write buffered rows and update the row count on disk."""
+        if self._file is not None:
+            self._write_chunk()
+
+    def close(self):
+        """Write buffered rows and close the last file."""
+        if self._file is not None:
+            self._close_file()
+
+
+class FitsSink(Sink):
+    """Write every spectrum to rolling FITS files."""
+
+    def __init__(self, prefix, nchan, meta=None, flush_seconds=10.0, **kwargs):
+        """
+        :param flush_seconds: write buffered rows at least this often, so
+            slow dumps do not wait a whole chunk to reach the disk
+        :param kwargs: passed to FitsSpectrumWriter
+        """
+        self.writer = FitsSpectrumWriter(prefix, nchan, meta, **kwargs)
+        self.flush_seconds = flush_seconds
+        self._flushed = time.time()
+
+    def write(self, spectrum):
+        self.writer.append(spectrum.data, spectrum.acc_cnt or 0,
+                           spectrum.timestamp, spectrum.board)
+        now = time.time()
+        if now - self._flushed >= self.flush_seconds:
+            self.writer.flush()
+            self._flushed = now
+
+    def close(self):
+        self.writer.close()
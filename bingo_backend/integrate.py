@@ -0,0 +1,253 @@
+"""
+Software post-integration of the spectrum stream.
+
+The hardware acc_len sets the dump period, and changing it means a
+register write and a counter reset.  Integrator adds a second, software
+integration on top: it combines N consecutive dumps into one product, so
+the stream can stay fast for RFI work while longer integrations go to
+storage.  Three modes:
+
+    boxcar     the sum of N dumps, in uint64 for integer spectra (exact,
+               no overflow) and float64 otherwise
+    exp        an exponential average with weight ``alpha`` (1/N by
+               default) on the newest dump, emitted every N dumps
+    masked     boxcar or exp with ``masked=True``: samples flagged in
+               Spectrum.mask (bingo_backend.rfi) are left out, and boxcar
+               sums are rescaled to N dumps per channel so the product
+               stays comparable between channels
+
+Boxcar windows are aligned on acc_cnt (window k holds the dumps with
+acc_cnt // N == k), so products of several streams or of several
+integration times line up; a window missing dumps, because the board
+skipped one or a sink queue overflowed, is dropped and counted (or, when
+masked, rescaled like flagged samples).  A product's timestamp, acc_cnt
+ticks and time_error are those of the first dump in the window.
+
+IntegrationSink runs an Integrator as a sink and publishes its products to
+sinks of its own, so several products can be taken from one stream at
+once:
+
+    acquisition.add_sink(IntegrationSink(10, [ArchiveSink('tod_10s', 32768)]))
+    acquisition.add_sink(IntegrationSink(60, [ArchiveSink('tod_60s', 32768)]))
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from .acquisition import SinkWorker, Spectrum
+from .rfi import pack_mask, unpack_mask
+from .sinks import Sink
+
+MODES = ('boxcar', 'exp')
+
+
+def dumps_for(seconds, period):
+    """Dumps in an integration of ``seconds``, at least one."""
+    return max(1, int(round(seconds / period)))
+
+
+class Integrator(object):
+    """Combine consecutive dumps into one integrated spectrum."""
+
+    def __init__(self, ndumps, mode='boxcar', alpha=None, masked=False,
+                 dtype=None):
+        """
+        :param ndumps: dumps per product
+        :param mode: 'boxcar' or 'exp'
+        :param alpha: weight of the newest dump in 'exp', 1/ndumps by
+            default
+        :param masked: leave out samples flagged in Spectrum.mask
+        :param dtype: accumulator dtype; by default uint64 (int64) for
+            unsigned (signed) integer spectra in an unmasked boxcar, and
+            float64 otherwise
+        """
+        if mode not in MODES:
+            raise ValueError('mode must be one of %s' % (MODES,))
+        self.ndumps = ndumps
+        self.mode = mode
+        self.alpha = alpha if alpha is not None else 1.0 / ndumps
+        self.masked = masked
+        self.dtype = dtype
+        self._acc = None
+        self._counts = None         # unflagged samples per channel
+        self._first = None          # first Spectrum of the window
+        self._window = None
+        self._received = 0
+        self._seen = 0
+        self.products = 0
+        self.incomplete = 0         # boxcar windows dropped for missing dumps
+
+    def _accumulator(self, data):
+        dtype = self.dtype
+        if dtype is None:
+            kind = data.dtype.kind
+            if self.mode == 'boxcar' and not self.masked and kind in 'ui':
+                dtype = np.uint64 if kind == 'u' else np.int64
+            else:
+                dtype = np.float64
+        return np.zeros(data.shape, dtype=dtype)
+
+    def _valid(self, spectrum):
+        """Unflagged samples of a spectrum, or None if none are flagged."""
+        if not self.masked or spectrum.mask is None:
+            return None
+        return ~unpack_mask(spectrum.mask, spectrum.data.shape[-1])
+
+    def _start(self, spectrum, window):
+        if self._acc is None:
+            self._acc = self._accumulator(spectrum.data)
+            if self.masked:
+                self._counts = np.zeros(spectrum.data.shape, dtype=np.int64)
+        self._first = spectrum
+        self._window = window
+        self._received = 0
+
+    def add(self, spectrum):
+        """Add a dump; returns the product it completes, or None."""
+        seen = self._seen
+        self._seen += 1
+        if self.mode == 'exp':
+            return self._add_exp(spectrum)
+        acc_cnt = spectrum.acc_cnt
+        window = (acc_cnt if acc_cnt is not None else seen) // self.ndumps
+        if self._received and window != self._window:
+            # the previous window ended without all of its dumps
+            if self.masked:
+                product = self._emit()
+                self._start(spectrum, window)
+                self._add_boxcar(spectrum)
+                return product
+            self.incomplete += 1
+            self._acc[...] = 0
+            self._received = 0
+        if not self._received:
+            self._start(spectrum, window)
+        self._add_boxcar(spectrum)
+        if self._received == self.ndumps:
+            return self._emit()
+        return None
+
+    def _add_boxcar(self, spectrum):
+        valid = self._valid(spectrum)
+        if self.masked:
+            if valid is None:
+                self._acc += spectrum.data
+                self._counts += 1
+            else:
+                np.add(self._acc, spectrum.data, out=self._acc, where=valid)
+                self._counts += valid
+        else:
+            self._acc += spectrum.data
+        self._received += 1
+
+    def _add_exp(self, spectrum):
+        data = spectrum.data
+        if self._acc is None:
+            self._start(spectrum, None)
+            self._acc[...] = data
+            if self.masked:
+                self._counts[...] = 1
+        else:
+            if not self._received:
+                self._first = spectrum
+            valid = self._valid(spectrum)
+            step = data - self._acc
+            step *= self.alpha
+            if valid is None:
+                self._acc += step
+                if self.masked:
+                    self._counts += 1
+            else:
+                np.add(self._acc, step, out=self._acc, where=valid)
+                self._counts += valid
+        self._received += 1
+        if self._received == self.ndumps:
+            return self._emit()
+        return None
+
+    def _emit(self):
+        """Product of the current window; the accumulator starts over."""
+        first = self._first
+        mask = None
+        if self.mode == 'exp':
+            data = self._acc.copy()
+        elif self.masked:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                data = self._acc * (self.ndumps / self._counts)
+            self._acc[...] = 0
+        else:
+            data = self._acc
+            self._acc = self._accumulator(data)     # hand the sum over
+        if self.masked:
+            empty = self._counts == 0
+            if self.mode == 'boxcar':
+                data[empty] = np.nan
+            mask = pack_mask(empty)
+            self._counts[...] = 0
+        self._received = 0
+        self.products += 1
+        data.flags.writeable = False  # shared by all sinks
+        return Spectrum(first.acc_cnt, data, first.timestamp, first.board,
+                        first.ticks, mask, first.time_error)
+
+
+class IntegrationSink(Sink):
+    """Post-integrate the stream and publish the products to more sinks."""
+
+    def __init__(self, ndumps, sinks=(), mode='boxcar', alpha=None,
+                 masked=False, dtype=None, queue_size=16, metrics=None, name=None):
+        """
+        :param ndumps: dumps per product, see dumps_for()
+        :param sinks: bingo_backend.sinks.Sink objects fed the products
+        :param mode, alpha, masked, dtype: see Integrator
+        :param queue_size: products buffered per sink before dropping
+        :param metrics: bingo_backend.metrics.Metrics registry the sinks
+            report to, usually the acquisition's
+        :param name: prefix of the sinks' metrics labels, by default
+            ``integrate-<ndumps>``
+        """
+        self.integrator = Integrator(ndumps, mode, alpha, masked, dtype)
+        name = name or 'integrate-%i' % ndumps
+        self.workers = [SinkWorker(sink, queue_size, metrics,
+                                   '%s-%i-%s' % (name, i, type(sink).__name__))
+                        for i, sink in enumerate(sinks)]
+        if metrics is not None:
+            metrics.add_collector(self._collect)
+
+    def open(self):
+        try:
+            for worker in self.workers:
+                worker.start()
+        except Exception:
+            self.close()
+            raise
+
+    def write(self, spectrum):
+        product = self.integrator.add(spectrum)
+        if product is not None:
+            for worker in self.workers:
+                worker.offer(product)
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            if worker.ident is not None:
+                worker.join(5.0)
+
+    def _collect(self):
+        samples = []
+        for worker in self.workers:
+            samples += worker.samples()
+        return samples
+
+    def stats(self):
+        """Products, dropped windows and written/dropped/errors per sink."""
+        return {
+            'products': self.integrator.products,
+            'incomplete': self.integrator.incomplete,
+            'sinks': dict((w.name, {'written': w.written, 'dropped': w.dropped,
+                                    'errors': w.errors})
+                          for w in self.workers),
+        }
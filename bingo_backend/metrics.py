@@ -0,0 +1,289 @@
+"""
+Lightweight metrics of the acquisition loop, with a Prometheus endpoint.
+
+Metrics holds counters, gauges and histograms keyed by name and labels.
+The instrumented code (SpectrumReader, Publisher, Acquisition, the sink
+workers) looks its metric objects up once when it is attached and then
+only calls Histogram.observe() or Counter.inc(): a bisect and two
+additions, a microsecond or so per stage and dump.  Counters the
+components already keep (skipped dumps, torn reads, dropped spectra) are
+not counted twice; collectors registered with add_collector() read them
+when the metrics are rendered.
+
+MetricsServer serves the metrics over HTTP on a local port:
+
+    /metrics        Prometheus text exposition format
+    /metrics.json   the same values as JSON
+
+Every stage timing goes into ``bingo_stage_seconds`` with a ``stage``
+label (register_read, bram_read, decode, processing, sink_write), so a
+slow night can be put down to the network (register_read, bram_read),
+the CPU (decode, processing) or the disk (sink_write of the archive),
+next to the dump interval and jitter histograms and the missed-dump
+counters.
+"""
+
+from __future__ import division, print_function
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# seconds, from a fast register read to a slow multi-board dump
+DEFAULT_BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+                   5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PREFIX = 'bingo_'
+STAGE_HELP = 'Seconds spent per dump in each acquisition stage.'
+
+
+class Counter(object):
+    """A monotonically increasing count."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(object):
+    """A value that goes up and down."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """Counts of observations per bucket, Prometheus style."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = sorted(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)     # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Upper bucket bound below which a fraction ``q`` of the
+        observations fall (inf if in the overflow bucket)."""
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            seen += count
+            if seen >= target and seen:
+                return bound
+        return float('nan')
+
+
+class _Timer(object):
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(clock() - self.start)
+
+
+def _label_key(labels):
+    return tuple(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """Registry of the counters, gauges and histograms of one process."""
+
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = {}          # name -> (kind, help, {label key: metric})
+        self._collectors = []
+
+    def _get(self, kind, factory, name, help, labels):
+        key = _label_key(labels)
+        with self._lock:
+            entry = self._metrics.get(name)
+            if entry is None:
+                entry = self._metrics[name] = (kind, help, {})
+            elif entry[0] != kind:
+                raise ValueError('%s is a %s, not a %s' % (name, entry[0], kind))
+            metric = entry[2].get(key)
+            if metric is None:
+                metric = entry[2][key] = factory()
+            return metric
+
+    def counter(self, name, help='', labels=None):
+        return self._get('counter', Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=None):
+        return self._get('gauge', Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get('histogram', lambda: Histogram(buckets), name, help, labels)
+
+    def add_collector(self, collector):
+        """Register ``collector()``, called at every render, returning
+        ``(name, kind, help, labels, value)`` tuples of counters or gauges
+        kept elsewhere."""
+        self._collectors.append(collector)
+
+    def _collected(self):
+        samples = []
+        for collector in self._collectors:
+            try:
+                samples.extend(collector())
+            except Exception:
+                logger.exception('metrics collector %r failed', collector)
+        return samples
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            entries = sorted((name, kind, help, sorted(metrics.items()))
+                             for name, (kind, help, metrics) in self._metrics.items())
+        grouped = {}
+        for name, kind, help, labels, value in self._collected():
+            grouped.setdefault((name, kind, help), []).append((_label_key(labels), value))
+        for (name, kind, help), values in sorted(grouped.items()):
+            entries.append((name, kind, help, values))
+        for name, kind, help, metrics in entries:
+            full = self.prefix + name
+            if help:
+                lines.append('# HELP %s %s' % (full, help))
+            lines.append('# TYPE %s %s' % (full, kind))
+            for key, metric in metrics:
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.bounds + [float('inf')], metric.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %i' % (full, _format_labels(
+                            key, [('le', _format_value(bound))]), cumulative))
+                    lines.append('%s_sum%s %r' % (full, _format_labels(key), metric.sum))
+                    lines.append('%s_count%s %i' % (full, _format_labels(key), metric.count))
+                else:
+                    value = metric.value if hasattr(metric, 'value') else metric
+                    lines.append('%s%s %s' % (full, _format_labels(key), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dict."""
+        out = {}
+        with self._lock:
+            items = [(name, kind, list(metrics.items()))
+                     for name, (kind, help, metrics) in self._metrics.items()]
+        for name, kind, metrics in items:
+            for key, metric in metrics:
+                entry = {'labels': dict(key)}
+                if kind == 'histogram':
+                    entry.update(count=metric.count, sum=metric.sum,
+                                 buckets=[[b, c] for b, c in zip(metric.bounds + ['+Inf'],
+                                                                 metric.counts)])
+                else:
+                    entry['value'] = metric.value
+                out.setdefault(self.prefix + name, []).append(entry)
+        for name, kind, help, labels, value in self._collected():
+            out.setdefault(self.prefix + name, []).append(
+                {'labels': dict(_label_key(labels)), 'value': value})
+        return out
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == '/metrics':
+            body = metrics.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.snapshot(), sort_keys=True).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+class MetricsServer(object):
+    """Serve a Metrics registry over HTTP from a background thread."""
+
+    def __init__(self, metrics, port=9109, host='127.0.0.1'):
+        """
+        :param port: TCP port, 0 for any free one (see ``port`` after start())
+        :param host: address to listen on; the default only accepts local
+            connections
+        """
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = HTTPServer((self.host, self.port), _Handler)
+        self._server.metrics = self.metrics
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics-http')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,122 @@
+"""
+Parallel readout of the same accumulation from several SKARABs.
+
+MultiBoardReader wraps one SpectrumReader per board and reads all of them
+concurrently, so the latency of a read stays close to that of a single
+board as boards are added.  The boards are reset together (cnt_rst) and
+share a PPS, so they should report the same acc_cnt; a board that lags
+behind is re-read until the counts agree, and the spectra are stacked
+into one (boards x channels) array.
+
+MultiBoardReader has the same read interface as SpectrumReader, so it can
+be given to DumpScheduler and Acquisition in its place.  The scheduler
+then watches the acc_cnt of the first (master) board.
+"""
+
+from __future__ import division, print_function
+
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class AlignmentError(RuntimeError):
+    """The boards did not agree on acc_cnt after re-reading."""
+    pass
+
+
+def _read(reader):
+    return reader.read_raw_consistent()
+
+
+class MultiBoardReader(object):
+    """Read one accumulation from every board, aligned on acc_cnt."""
+
+    def __init__(self, readers, max_realign=3, realign_delay=0.002):
+        """
+        :param readers: one bingo_backend.readout.SpectrumReader per
+            board, master first, all for the same design
+        :param max_realign: re-reads of lagging boards before giving up
+        :param realign_delay: seconds to wait before re-reading a board
+            whose dump has not arrived yet
+        """
+        self.readers = list(readers)
+        nchans = set(r.nchan for r in self.readers)
+        if len(nchans) != 1:
+            raise ValueError('boards have different channel counts: %s'
+                             % sorted(nchans))
+        self.nchan = nchans.pop()
+        self.nboards = len(self.readers)
+        self.out_dtype = self.readers[0].out_dtype
+        self.max_realign = max_realign
+        self.realign_delay = realign_delay
+        self.realigned = 0      # reads that needed a re-read to align
+        self.misaligned = 0     # reads given up as misaligned
+        self._pool = ThreadPool(self.nboards)
+
+    def instrument(self, metrics):
+        """Time every board's transactions, labelled by board index."""
+        for board, reader in enumerate(self.readers):
+            reader.instrument(metrics, board)
+
+    def read_count(self):
+        """acc_cnt of the master board."""
+        return self.readers[0].read_count()
+
+    def read_counts(self):
+        """acc_cnt of every board, read in parallel."""
+        return self._pool.map(lambda r: r.read_count(), self.readers)
+
+    def read_raw_consistent(self):
+        """Read every board in parallel and align them on acc_cnt.
+
+        Returns ``(acc_n, raws)`` with one list of raw BRAM buffers per
+        board, or raises AlignmentError.
+        """
+        results = self._pool.map(_read, self.readers)
+        for attempt in range(self.max_realign + 1):
+            counts = [acc_n for acc_n, raws in results]
+            if None in counts or len(set(counts)) == 1:
+                if attempt:
+                    self.realigned += 1
+                return counts[0], [raws for acc_n, raws in results]
+            if attempt == self.max_realign:
+                break
+            target = max(counts)
+            lagging = [i for i, acc_n in enumerate(counts) if acc_n < target]
+            time.sleep(self.realign_delay)
+            reread = self._pool.map(_read, [self.readers[i] for i in lagging])
+            for i, result in zip(lagging, reread):
+                results[i] = result
+        self.misaligned += 1
+        raise AlignmentError('boards report different acc_cnt: %s' % counts)
+
+    def decode(self, raws, out=None):
+        """Decode every board's buffers into rows of a (boards x nchan) array."""
+        if out is None:
+            out = np.empty((self.nboards, self.nchan), dtype=self.out_dtype)
+        for reader, board_raws, row in zip(self.readers, raws, out):
+            reader.decode(board_raws, out=row)
+        return out
+
+    def read(self, out=None):
+        """Read one aligned accumulation; returns ``(acc_n, spectra)``."""
+        acc_n, raws = self.read_raw_consistent()
+        return acc_n, self.decode(raws, out=out)
+
+    def stats(self):
+        """Alignment counters and the read counters of every board."""
+        return {
+            'realigned': self.realigned,
+            'misaligned': self.misaligned,
+            'boards': [r.stats() for r in self.readers],
+        }
+
+    def close(self):
+        """Stop the reader threads."""
+        self._pool.close()
+        self._pool.join()
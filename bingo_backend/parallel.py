@@ -0,0 +1,75 @@
+"""
+Run one operation on many boards at once.
+
+Control-bus transactions spend nearly all their time waiting on the
+network, so a thread per board is enough to overlap them: N boards take
+about as long as the slowest one instead of N times one.  multiprocessing's
+ThreadPool is used because it ships with both Python 2.7 and Python 3.
+"""
+
+from __future__ import division, print_function
+
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class BoardResult(object):
+    """Outcome of one call made by fan_out()."""
+
+    __slots__ = ('index', 'value', 'error', 'elapsed', 'detail')
+
+    def __init__(self, index, value=None, error=None, elapsed=0.0):
+        self.index = index
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+        self.detail = None      # what was done, filled in by the caller
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return 'BoardResult(%i, ok, %.3f s)' % (self.index, self.elapsed)
+        return 'BoardResult(%i, %r, %.3f s)' % (self.index, self.error, self.elapsed)
+
+
+def _timed_call(args):
+    func, index, item = args
+    start = time.time()
+    try:
+        value = func(item)
+    except Exception as error:
+        return BoardResult(index, error=error, elapsed=time.time() - start)
+    return BoardResult(index, value=value, elapsed=time.time() - start)
+
+
+def fan_out(func, items, pool=None):
+    """Call ``func(item)`` for every item concurrently.
+
+    Exceptions are caught per item.  Returns a list of BoardResult in the
+    order of ``items``, each with the value or the error and the time the
+    call took.  A temporary pool with one thread per item is used when
+    ``pool`` is not given.
+    """
+    items = list(items)
+    if not items:
+        return []
+    calls = [(func, i, item) for i, item in enumerate(items)]
+    if pool is not None:
+        return pool.map(_timed_call, calls)
+    pool = ThreadPool(len(items))
+    try:
+        return pool.map(_timed_call, calls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def raise_failures(results, what='operation'):
+    """Raise RuntimeError naming every failed board in ``results``."""
+    failed = [r for r in results if not r.ok]
+    if failed:
+        raise RuntimeError('%s failed on board(s) %s' % (what, ', '.join(
+            '%i (%s)' % (r.index, r.error) for r in failed)))
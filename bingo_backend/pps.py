@@ -0,0 +1,237 @@
+"""
+Deterministic PPS synchronisation of several boards.
+
+Each board latches ``utc_time`` into its ``utc_time_count`` second counter
+(and restarts its accumulators) on the first PPS edge after LOAD_PPS (bit
+2 of ``sw_pps``) is raised.  The scripts have always armed it as
+``mask | 0x5``, LOAD_PPS with the trigger bit, and so does PpsSync in
+both modes: with the hardware PPS selected (bit 1 clear) the load still
+waits for the edge.  The boards share one epoch only if all of
+them are armed inside the same second, far enough from both PPS edges
+that host clock error and network latency cannot push one of them across.
+Arming board after board with fixed sleeps stops guaranteeing that as the
+number of boards grows, and nothing checked the outcome.
+
+PpsSync arms every board in parallel once the host clock is inside a
+window of the second (``window``, fractions of a second, 0.2-0.6 by
+default), and times each board's arming.  If any board finishes arming
+outside the window, LOAD_PPS is dropped on every board before the edge and
+the attempt is repeated the next second.  After the edge, LOAD_PPS is
+dropped and ``utc_time_count`` is read back from every board in parallel,
+again inside the window.  The attempt succeeds only if every board reports
+the same second and that second matches the host's (NTP) clock.  Otherwise
+it is retried up to ``retries`` times, then PpsSyncError is raised with
+the per-board counts.
+
+With ``software=True`` the boards make their own PPS (sw_pps bits 0 and
+1): the trigger loads at once, so it is sent to all boards in parallel
+just after the host's second boundary, and the spread of the trigger
+times is the skew between the boards' epochs (at most ``max_skew``).
+"""
+
+from __future__ import division, print_function
+
+import logging
+import math
+import time
+from multiprocessing.pool import ThreadPool
+
+from .parallel import fan_out, raise_failures
+
+logger = logging.getLogger(__name__)
+
+LOAD_PPS = 0x4
+SOFTWARE_PPS = 0x2
+SOFTWARE_TRIGGER = 0x1
+
+
+class PpsSyncError(RuntimeError):
+    """The boards could not be brought to one PPS epoch."""
+
+
+class SyncResult(object):
+    """Outcome of a PpsSync.sync() call."""
+
+    def __init__(self, epoch, attempts, arm_window, arm_spread, counts, offsets):
+        self.epoch = epoch              # UTC second latched on the PPS edge
+        self.attempts = attempts
+        self.arm_window = arm_window    # (first start, last end) of arming,
+                                        # as fractions of the epoch's second
+        self.arm_spread = arm_spread    # seconds from first to last arming
+        self.counts = counts            # utc_time_count read per board
+        self.offsets = offsets          # count minus host second per board
+
+    def __repr__(self):
+        return ('SyncResult(epoch=%i, attempts=%i, armed %.3f-%.3f s, spread %.1f ms)'
+                % (self.epoch, self.attempts, self.arm_window[0], self.arm_window[1],
+                   1e3 * self.arm_spread))
+
+
+class PpsSync(object):
+    """Arm the PPS load of many boards at once and verify the epoch."""
+
+    def __init__(self, boards, software=False, window=(0.2, 0.6), retries=3,
+                 settle=0.2, max_skew=0.01, clock=time.time, sleep=time.sleep):
+        """
+        :param boards: connected board objects
+        :param software: use the boards' software PPS instead of the
+            hardware PPS input
+        :param window: (start, end) fractions of a second within which
+            every board must be armed and read back
+        :param retries: attempts after the first before giving up
+        :param settle: seconds to wait after the PPS edge before dropping
+            LOAD_PPS
+        :param max_skew: seconds the software PPS triggers of the boards
+            may spread over
+        :param clock: host time source, NTP-disciplined UTC
+        """
+        if not 0.0 <= window[0] < window[1] <= 1.0:
+            raise ValueError('window must be (start, end) within one second')
+        self.boards = list(boards)
+        self.software = software
+        self.mask = SOFTWARE_PPS if software else 0x0
+        self.window = window
+        self.retries = retries
+        self.settle = settle
+        self.max_skew = max_skew
+        self.clock = clock
+        self.sleep = sleep
+        self.last = None
+
+    def _wait_for_window(self):
+        """Sleep until the clock is inside the window of a second;
+        returns that second."""
+        while True:
+            now = self.clock()
+            second = math.floor(now)
+            frac = now - second
+            if frac < self.window[0]:
+                self.sleep(self.window[0] - frac)
+            elif frac > self.window[1] - 0.05:
+                # too close to the end to fit the work in; take the next one
+                self.sleep(1.0 - frac + self.window[0])
+            else:
+                return int(second)
+
+    def _wait_until(self, when):
+        delay = when - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+    def _write_all(self, name, value, pool):
+        results = fan_out(lambda fpga: fpga.write_int(name, value, blindwrite=True),
+                          self.boards, pool)
+        raise_failures(results, 'writing %s' % name)
+
+    def _arm(self, pool):
+        """Arm every board; returns the latched second and the host times
+        each board's arming started and finished."""
+        mask = self.mask
+        trigger = mask | LOAD_PPS | SOFTWARE_TRIGGER
+        if self.software:
+            # the trigger loads at once: send it just after the boundary
+            second = int(math.floor(self.clock())) + 1
+            self._write_all('utc_time', second, pool)
+            self._write_all('sw_pps', mask, pool)
+            self._wait_until(second)
+        else:
+            # armed in second S, loaded on the edge that starts S + 1
+            second = self._wait_for_window() + 1
+
+        def arm(fpga):
+            start = self.clock()
+            if not self.software:
+                fpga.write_int('utc_time', second, blindwrite=True)
+                fpga.write_int('sw_pps', mask, blindwrite=True)
+            fpga.write_int('sw_pps', trigger, blindwrite=True)
+            return start, self.clock()
+
+        results = fan_out(arm, self.boards, pool)
+        raise_failures(results, 'arming the PPS load')
+        return second, [r.value for r in results]
+
+    def _read_counts(self, pool):
+        """utc_time_count of every board, read inside the window of one
+        second; returns the counts and that second."""
+        for _ in range(3):
+            second = self._wait_for_window()
+            results = fan_out(lambda fpga: (fpga.read_uint('utc_time_count'), self.clock()),
+                              self.boards, pool)
+            raise_failures(results, 'reading utc_time_count')
+            if all(math.floor(t) == second and t - second <= self.window[1]
+                   for _, t in (r.value for r in results)):
+                return [count for count, _ in (r.value for r in results)], second
+        raise PpsSyncError('could not read utc_time_count inside the window')
+
+    def attempt(self, pool=None):
+        """One synchronisation attempt; raises PpsSyncError on failure."""
+        second, times = self._arm(pool)
+        first = min(start for start, _ in times)
+        last = max(end for _, end in times)
+        # fractions of the second the boards were armed in
+        base = second if self.software else second - 1
+        arm_window = (first - base, last - base)
+        if self.software:
+            if last - first > self.max_skew:
+                self._write_all('sw_pps', self.mask, pool)
+                raise PpsSyncError('software PPS triggers spread over %.1f ms'
+                                   % (1e3 * (last - first)))
+        elif arm_window[0] < 0.0 or arm_window[1] > self.window[1]:
+            self._write_all('sw_pps', self.mask, pool)   # cancel before the edge
+            raise PpsSyncError('arming took %.3f-%.3f s of the second, outside %s'
+                               % (arm_window[0], arm_window[1], self.window))
+        if not self.software:
+            self._wait_until(second + self.settle)
+        self._write_all('sw_pps', self.mask, pool)
+        counts, read_second = self._read_counts(pool)
+        offsets = [count - read_second for count in counts]
+        if len(set(counts)) != 1 or offsets[0] != 0:
+            raise PpsSyncError('utc_time_count differs: %s at host second %i'
+                               % (', '.join('board %i: %i' % (i, c) for i, c in enumerate(counts)),
+                                  read_second))
+        return SyncResult(second, 1, arm_window, last - first, counts, offsets)
+
+    def sync(self):
+        """Synchronise all boards, retrying failed attempts.
+
+        :raises PpsSyncError: if every attempt failed
+        :raises RuntimeError: if a board transaction failed (not retried)
+        :returns: SyncResult
+        """
+        pool = ThreadPool(len(self.boards))     # no thread start-up while arming
+        try:
+            error = None
+            for attempt in range(1, self.retries + 2):
+                try:
+                    result = self.attempt(pool)
+                except PpsSyncError as e:
+                    error = e
+                    logger.warning('PPS sync attempt %i failed: %s', attempt, e)
+                    continue
+                result.attempts = attempt
+                self.last = result
+                return result
+            raise PpsSyncError('PPS sync failed after %i attempts: %s' % (attempt, error))
+        finally:
+            pool.close()
+            pool.join()
+
+    def verify(self):
+        """Read utc_time_count from every board and check that they still
+        agree with each other and with the host clock; returns the
+        offsets (board second minus host second)."""
+        pool = ThreadPool(len(self.boards))
+        try:
+            counts, second = self._read_counts(pool)
+        finally:
+            pool.close()
+            pool.join()
+        offsets = [count - second for count in counts]
+        if any(offsets):
+            raise PpsSyncError('boards are off the host second by %s' % offsets)
+        return offsets
+
+
+def sync_pps(boards, software=False, **kwargs):
+    """Synchronise ``boards`` to one PPS epoch; see PpsSync."""
+    return PpsSync(boards, software, **kwargs).sync()
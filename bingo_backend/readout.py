@@ -0,0 +1,170 @@
+"""
+BRAM readout for the SKARAB spectrometer designs.
+
+The accumulators write their output to shared BRAMs (mem_left_0_0,
+mem_left_0_1, ...) which are read over the control bus as raw big-endian
+byte strings.  These are decoded straight into NumPy arrays with
+np.frombuffer and interleaved with a strided copy, so no per-word Python
+work is done on the readout path.
+
+A BRAM read takes several control-bus transactions, and an accumulator
+dump landing in the middle of them would give a spectrum mixing two
+integrations.  SpectrumReader therefore brackets every read with two
+acc_cnt reads and retries until they agree.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+from .metrics import STAGE_HELP, clock
+
+# Word layout of the BRAMs used by the designs in this repository
+BRAM_WORD_DTYPE = '>u4'        # mem_left_* accumulator outputs
+PACKET_BUFFER_DTYPE = '>i2'    # packet_buffer_sx* complex sample buffers
+
+
+class TornReadError(RuntimeError):
+    """acc_cnt changed during every attempt to read a spectrum."""
+    pass
+
+
+def decode_bram(raw, dtype=BRAM_WORD_DTYPE, count=-1):
+    """Return a read-only view of a raw BRAM buffer as a NumPy array.
+
+    No data is copied: the array shares memory with ``raw``.
+    """
+    return np.frombuffer(raw, dtype=dtype, count=count)
+
+
+def interleave(arrays, out=None, dtype=None):
+    """Interleave equally long 1-D arrays word by word.
+
+    ``interleave([a, b])`` gives ``[a[0], b[0], a[1], b[1], ...]``, the
+    order the two-BRAM designs split their channels in.  The result is
+    written into ``out`` (or a new array of ``dtype``) in one strided copy
+    per input array, which also does any dtype conversion.
+    """
+    arrays = list(arrays)
+    nwords = len(arrays[0])
+    for a in arrays[1:]:
+        if len(a) != nwords:
+            raise ValueError('cannot interleave arrays of different lengths')
+    if out is None:
+        if dtype is None:
+            dtype = np.result_type(*arrays)
+        out = np.empty(nwords * len(arrays), dtype=dtype)
+    elif out.shape != (nwords * len(arrays),):
+        raise ValueError('output array has shape %s, expected (%i,)'
+                         % (out.shape, nwords * len(arrays)))
+    columns = out.reshape(nwords, len(arrays))
+    for k, a in enumerate(arrays):
+        columns[:, k] = a
+    return out
+
+
+class SpectrumReader(object):
+    """Read one accumulated spectrum from a set of interleaved BRAMs."""
+
+    def __init__(self, fpga, brams, nwords, dtype=BRAM_WORD_DTYPE,
+                 out_dtype=np.float64, count_register='acc_cnt',
+                 max_retries=3):
+        """
+        :param fpga: connected casperfpga.CasperFpga object
+        :param brams: BRAM names, in interleave order
+        :param nwords: number of words to read from each BRAM
+        :param dtype: big-endian word type stored in the BRAMs
+        :param out_dtype: dtype of the returned spectrum
+        :param count_register: accumulation counter register, or None
+            for designs without one
+        :param max_retries: extra attempts when a dump tears a read
+        """
+        self.fpga = fpga
+        self.brams = list(brams)
+        self.nwords = nwords
+        self.dtype = np.dtype(dtype)
+        self.out_dtype = out_dtype
+        self.count_register = count_register
+        self.nchan = nwords * len(self.brams)
+        self.nbytes = nwords * self.dtype.itemsize
+        self.max_retries = max_retries
+        self.reads = 0          # bracketed read attempts
+        self.torn = 0           # attempts during which acc_cnt moved
+        self.failures = 0       # reads given up after max_retries
+        self.read_time = 0.0    # seconds spent in BRAM transactions
+        self.max_read_time = 0.0
+        self._register_time = None  # histograms, see instrument()
+        self._bram_time = None
+
+    def instrument(self, metrics, board=0):
+        """Time register and BRAM transactions into a
+        bingo_backend.metrics.Metrics registry."""
+        self._register_time = metrics.histogram('stage_seconds', STAGE_HELP,
+                                                {'stage': 'register_read', 'board': board})
+        self._bram_time = metrics.histogram('stage_seconds', STAGE_HELP,
+                                            {'stage': 'bram_read', 'board': board})
+
+    def read_count(self):
+        """Read the accumulation counter (None if the design has none)."""
+        if self.count_register is None:
+            return None
+        if self._register_time is None:
+            return self.fpga.read_uint(self.count_register)
+        start = clock()
+        value = self.fpga.read_uint(self.count_register)
+        self._register_time.observe(clock() - start)
+        return value
+
+    def read_raw(self):
+        """Read the raw bytes of every BRAM, one transaction each."""
+        return [self.fpga.read(name, self.nbytes, 0) for name in self.brams]
+
+    def read_raw_consistent(self):
+        """Read every BRAM between two equal acc_cnt reads.
+
+        Returns ``(acc_n, raws)``.  When the counter moves during the read
+        the BRAMs are read again, up to max_retries times, after which
+        TornReadError is raised.  Designs without a counter are read once.
+        """
+        if self.count_register is None:
+            return None, self.read_raw()
+        before = self.read_count()
+        for attempt in range(self.max_retries + 1):
+            start = clock()
+            raws = self.read_raw()
+            elapsed = clock() - start
+            after = self.read_count()
+            self.reads += 1
+            self.read_time += elapsed
+            self.max_read_time = max(self.max_read_time, elapsed)
+            if self._bram_time is not None:
+                self._bram_time.observe(elapsed)
+            if after == before:
+                return after, raws
+            self.torn += 1
+            # the closing read opens the next attempt
+            before = after
+        self.failures += 1
+        raise TornReadError('acc_cnt changed during %i consecutive reads of %s'
+                            % (self.max_retries + 1, ', '.join(self.brams)))
+
+    def stats(self):
+        """Torn-read counters and BRAM read latency, for sizing acc_len."""
+        return {
+            'reads': self.reads,
+            'torn': self.torn,
+            'failures': self.failures,
+            'torn_fraction': self.torn / self.reads if self.reads else 0.0,
+            'mean_read_time': self.read_time / self.reads if self.reads else 0.0,
+            'max_read_time': self.max_read_time,
+        }
+
+    def decode(self, raws, out=None):
+        """Decode and interleave raw BRAM buffers into one spectrum."""
+        words = [decode_bram(raw, self.dtype, self.nwords) for raw in raws]
+        return interleave(words, out=out, dtype=self.out_dtype)
+
+    def read(self, out=None):
+        """Read one untorn spectrum; returns ``(acc_n, spectrum)``."""
+        acc_n, raws = self.read_raw_consistent()
+        return acc_n, self.decode(raws, out=out)
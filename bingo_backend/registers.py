@@ -0,0 +1,173 @@
+"""
+Register configuration plans, applied to many boards at once.
+
+The scripts configure a board with a run of single write_int() calls
+(acc_len, fft_shift, the rst_cpoge and cnt_rst pulses, shift), and
+casperfpga's write_int() reads every register back after writing it:
+two round trips per write, board after board.  A RegisterPlan declares
+the sequence once, pulses included:
+
+    plan = RegisterPlan().write('acc_len', 5722).write('fft_shift', 32768)
+    plan.pulse('rst_cpoge').pulse('cnt_rst').write('shift', 0)
+    raise_failures(apply_plan(skarabs, plan), 'configuration')
+
+and applying it costs one blind write per step plus one read per
+verified register at the end, compared with the value the plan leaves it
+at.  Pulse registers (1 then 0) are not read back: they read 0 whether or
+not the pulse got through.  apply_plan() runs the plan on every board in
+parallel (bingo_backend.parallel.fan_out), so N boards take as long as
+one.
+
+A ``state`` dict per board remembers what was last written; plain writes
+of the value a register already holds are then skipped, so re-applying
+accumulation_plan() with a new acc_len mid-run costs the acc_len write,
+the counter-reset pulses and one read-back.
+"""
+
+from __future__ import division, print_function
+
+import logging
+
+from .parallel import fan_out
+
+logger = logging.getLogger(__name__)
+
+WRITE = 'write'
+PULSE = 'pulse'
+
+
+class RegisterMismatch(RuntimeError):
+    """A register read back a different value than the plan wrote."""
+
+    def __init__(self, mismatches):
+        self.mismatches = mismatches    # [(name, expected, read)]
+        RuntimeError.__init__(self, 'register read-back mismatch: %s' % ', '.join(
+            '%s wrote %i read %i' % m for m in mismatches))
+
+
+class RegisterPlan(object):
+    """An ordered sequence of register writes and pulses."""
+
+    def __init__(self):
+        self.steps = []     # (kind, name, value, verify)
+
+    def write(self, name, value, verify=True):
+        """Write ``value``; verified by reading back unless ``verify`` is
+        False (registers the firmware changes itself).  Returns the plan."""
+        value = int(value) & 0xffffffff
+        last = self.steps[-1] if self.steps else None
+        if last is not None and last[0] == WRITE and last[1] == name:
+            # only the second of two back-to-back writes matters
+            self.steps[-1] = (WRITE, name, value, verify)
+        else:
+            self.steps.append((WRITE, name, value, verify))
+        return self
+
+    def pulse(self, name, high=1, low=0):
+        """Write ``high`` then ``low``, e.g. a counter reset.  Returns the plan."""
+        self.steps.append((PULSE, name, int(high) & 0xffffffff, False))
+        self.steps.append((PULSE, name, int(low) & 0xffffffff, False))
+        return self
+
+    def extend(self, other):
+        """Append the steps of another plan.  Returns the plan."""
+        for kind, name, value, verify in other.steps:
+            if kind == WRITE:
+                self.write(name, value, verify)
+            else:
+                self.steps.append((kind, name, value, verify))
+        return self
+
+    def expected(self):
+        """Final value of every verified register, in plan order."""
+        final = {}
+        order = []
+        for kind, name, value, verify in self.steps:
+            if name not in final:
+                order.append(name)
+            final[name] = (value, verify and kind == WRITE)
+        return [(name, final[name][0]) for name in order if final[name][1]]
+
+    def apply(self, fpga, verify=True, state=None):
+        """Run the plan on one board.
+
+        :param fpga: casperfpga.CasperFpga (or SimulatedSkarab)
+        :param verify: read the verified registers back at the end
+        :param state: dict of the values last written to this board,
+            updated here; plain writes it already records are skipped
+        :raises RegisterMismatch: if a register read back differently
+        :returns: dict of the writes, reads and skipped writes done
+        """
+        writes = skipped = 0
+        for kind, name, value, _ in self.steps:
+            if kind == WRITE and state is not None and state.get(name) == value:
+                skipped += 1
+                continue
+            fpga.write_int(name, value, blindwrite=True)
+            writes += 1
+            if state is not None:
+                if kind == WRITE:
+                    state[name] = value
+                else:
+                    state.pop(name, None)
+        reads = 0
+        if verify:
+            mismatches = []
+            for name, value in self.expected():
+                read = fpga.read_uint(name)
+                reads += 1
+                if read != value:
+                    mismatches.append((name, value, read))
+                    if state is not None:
+                        state.pop(name, None)
+            if mismatches:
+                raise RegisterMismatch(mismatches)
+        return {'writes': writes, 'reads': reads, 'skipped': skipped}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return 'RegisterPlan(%s)' % ', '.join(
+            '%s=%i' % (name, value) for _, name, value, _ in self.steps)
+
+
+def accumulation_plan(acc_len, fft_shift=None, shift=None):
+    """The scripts' accumulator configuration: acc_len, fft_shift, the
+    rst_cpoge and cnt_rst pulses, then shift (each optional but acc_len)."""
+    plan = RegisterPlan().write('acc_len', acc_len)
+    if fft_shift is not None:
+        plan.write('fft_shift', fft_shift)
+    plan.pulse('rst_cpoge').pulse('cnt_rst')
+    if shift is not None:
+        plan.write('shift', shift)
+    return plan
+
+
+def apply_plan(boards, plan, verify=True, states=None, pool=None):
+    """Apply a plan to every board in parallel.
+
+    :param boards: connected board objects
+    :param plan: RegisterPlan, or one per board
+    :param states: per-board state dicts (see RegisterPlan.apply)
+    :param pool: thread pool to use (see bingo_backend.parallel.fan_out)
+    :returns: list of bingo_backend.parallel.BoardResult, in board order,
+        whose value is the count of writes, reads and skipped writes
+    """
+    boards = list(boards)
+    plans = plan if isinstance(plan, (list, tuple)) else [plan] * len(boards)
+    if states is None:
+        states = [None] * len(boards)
+
+    def run(args):
+        fpga, board_plan, state = args
+        return board_plan.apply(fpga, verify, state)
+
+    results = fan_out(run, zip(boards, plans, states), pool)
+    for result in results:
+        if result.ok:
+            result.detail = '%(writes)i writes, %(reads)i reads' % result.value
+        else:
+            logger.warning('configuration of board %i failed: %s', result.index,
+                           result.error)
+    return results
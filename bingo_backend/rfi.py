@@ -0,0 +1,222 @@
+"""
+Real-time RFI flagging of the spectrum stream.
+
+RfiFlagger keeps the last ``window`` spectra of every channel in a NumPy
+ring array and flags, in each new spectrum, the channels that are
+inconsistent with that window.  It runs as a Publisher stage (see
+bingo_backend.acquisition.Publisher.add_stage), so every sink receives
+the spectrum together with its mask.  Two detectors are available:
+
+    sk    spectral kurtosis of the window.  For M spectra each summing
+          N = acc_len detected powers, with S1 and S2 the per-channel
+          sums of the values and of their squares,
+
+              SK = (M N d + 1) / (M - 1) * (M S2 / S1**2 - 1)
+
+          is 1 for noise-like signals; CW and intermittent RFI push it
+          below and above.  SK describes the whole window, so it stays
+          out of range for ``window`` spectra after a single burst; only
+          the samples driving it there are flagged.  Above the upper
+          limit those are the samples more than ``threshold`` radiometer
+          sigmas (mean / sqrt(N d)) above the window mean, so one burst
+          flags one spectrum.  Below the lower limit (CW, which is there
+          in every spectrum) the whole channel is flagged.  S1 and S2 are
+          updated as spectra enter and leave the ring, so a spectrum
+          costs a few passes over nchan values whatever the window
+          length.
+    mad   sigma clipping of each channel against the median and the
+          median absolute deviation of the window.  The medians are
+          refreshed every ``refresh`` spectra rather than every one,
+          which keeps the cost per spectrum down to a subtraction and a
+          comparison.
+
+A flagged spectrum carries its mask as ``Spectrum.mask``, packed with
+np.packbits along the channel axis (nchan / 8 bytes, channel 0 in the
+most significant bit of byte 0); ArchiveSink stores it in the
+``<base>.mask`` file next to the archive, see
+bingo_backend.archive.SpectrumArchive.select_mask.
+"""
+
+from __future__ import division, print_function
+
+import time
+
+import numpy as np
+
+METHODS = ('sk', 'mad')
+MAD_TO_SIGMA = 1.4826
+
+
+def pack_mask(mask):
+    """Pack a boolean (..., nchan) mask into (..., ceil(nchan / 8)) bytes."""
+    return np.packbits(mask, axis=-1)
+
+
+def unpack_mask(packed, nchan):
+    """Inverse of pack_mask()."""
+    return np.unpackbits(packed, axis=-1)[..., :nchan].astype(bool)
+
+
+def sk_variance(m, n, d=1.0):
+    """Variance of the SK estimator of noise for M spectra of N powers."""
+    nd = n * d
+    return 2 * nd * (nd + 1) * m ** 2 / ((m - 1) * (m * nd + 2) * (m * nd + 3))
+
+
+class RfiFlagger(object):
+    """Flag RFI in each spectrum against a sliding window of the last ones."""
+
+    def __init__(self, shape, method='sk', window=64, threshold=None,
+                 acc_len=1, d=1.0, refresh=None, warmup=None):
+        """
+        :param shape: shape of the spectra, nchan or (boards, nchan)
+        :param method: 'sk' or 'mad'
+        :param window: spectra held per channel
+        :param threshold: flag beyond this many standard deviations;
+            3 for 'sk' and 5 for 'mad' by default
+        :param acc_len: detected powers summed into each spectrum (N)
+        :param d: shape factor of the summed powers (1 for complex
+            voltages), used by 'sk'
+        :param refresh: spectra between median updates, used by 'mad';
+            by default an eighth of the window
+        :param warmup: spectra needed before anything is flagged; by
+            default a quarter of the window (at least 4)
+        """
+        if method not in METHODS:
+            raise ValueError('method must be one of %s' % (METHODS,))
+        self.shape = tuple(np.atleast_1d(shape))
+        self.method = method
+        self.window = window
+        self.threshold = threshold if threshold is not None else (3.0 if method == 'sk' else 5.0)
+        self.acc_len = acc_len
+        self.d = d
+        self.refresh = refresh or max(1, window // 8)
+        self.warmup = max(2, warmup if warmup is not None else max(4, window // 4))
+        self.count = 0              # spectra in the ring
+        self.head = 0               # next slot to write
+        self._ring = np.zeros((window,) + self.shape)
+        if method == 'sk':
+            self._s1 = np.zeros(self.shape)
+            self._s2 = np.zeros(self.shape)
+            self._sk = np.empty(self.shape)
+            self._high = np.empty(self.shape, dtype=bool)
+            self._limits = {}
+        else:
+            self._median = None
+            self._sigma = None
+            self._since_refresh = 0
+        self._tmp = np.empty(self.shape)
+        self._mask = np.empty(self.shape, dtype=bool)
+        self.spectra = 0
+        self.flagged = 0            # channel samples flagged in total
+        self.last_fraction = 0.0
+        self.elapsed = 0.0
+
+    # -- detectors -----------------------------------------------------
+
+    def _sk_limits(self, m):
+        """Lower and upper SK limits for a window of ``m`` spectra."""
+        limits = self._limits.get(m)
+        if limits is None:
+            sigma = np.sqrt(sk_variance(m, self.acc_len, self.d))
+            limits = self._limits[m] = (1 - self.threshold * sigma,
+                                        1 + self.threshold * sigma)
+        return limits
+
+    def _push_sk(self, x):
+        tmp = self._tmp
+        if self.count == self.window:
+            old = self._ring[self.head]
+            self._s1 -= old
+            np.multiply(old, old, out=tmp)
+            self._s2 -= tmp
+        self._ring[self.head] = x
+        if self.head == self.window - 1:
+            # resum once per turn of the ring so rounding cannot build up
+            # (the ring is full once the last slot has been written)
+            np.sum(self._ring, axis=0, out=self._s1)
+            np.einsum('i...,i...->...', self._ring, self._ring, out=self._s2)
+        else:
+            self._s1 += x
+            np.multiply(x, x, out=tmp)
+            self._s2 += tmp
+
+    def _flag_sk(self, x):
+        m = self.count
+        s1, sk, tmp = self._s1, self._sk, self._tmp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.multiply(s1, s1, out=tmp)
+            np.divide(self._s2, tmp, out=sk)
+            sk *= m
+            sk -= 1
+            sk *= (m * self.acc_len * self.d + 1) / (m - 1)
+        lo, hi = self._sk_limits(m)
+        mask = np.less(sk, lo, out=self._mask)
+        high = np.greater(sk, hi, out=self._high)
+        if high.any():
+            # of the channels with bursts in the window, flag those with
+            # one in this spectrum: x > mean * (1 + threshold / sqrt(N d))
+            np.multiply(s1, (1 + self.threshold / np.sqrt(self.acc_len * self.d)) / m,
+                        out=tmp)
+            high &= x > tmp
+            mask |= high
+        return mask
+
+    def _flag_mad(self, x):
+        if self._median is None or self._since_refresh >= self.refresh:
+            filled = self._ring[:self.count]
+            self._median = np.median(filled, axis=0)
+            self._sigma = MAD_TO_SIGMA * np.median(np.abs(filled - self._median), axis=0)
+            self._since_refresh = 0
+        self._since_refresh += 1
+        tmp = self._tmp
+        np.subtract(x, self._median, out=tmp)
+        np.abs(tmp, out=tmp)
+        return np.greater(tmp, self.threshold * self._sigma, out=self._mask)
+
+    # -- stage ---------------------------------------------------------
+
+    def flag(self, data):
+        """Add a spectrum to the window and return its boolean mask.
+
+        The mask is a buffer reused by the next call; copy it to keep it.
+        """
+        start = time.time()
+        x = np.asarray(data, dtype=np.float64).reshape(self.shape)
+        mask = None
+        if self.method == 'sk':
+            self._push_sk(x)
+            self.count = min(self.count + 1, self.window)
+            if self.count >= self.warmup:
+                mask = self._flag_sk(x)
+        else:
+            if self.count >= self.warmup:
+                mask = self._flag_mad(x)
+            # x enters the window after being tested against it
+            self._ring[self.head] = x
+            self.count = min(self.count + 1, self.window)
+        if mask is None:
+            mask = self._mask
+            mask[...] = False
+        self.head = (self.head + 1) % self.window
+        flagged = int(np.count_nonzero(mask))
+        self.flagged += flagged
+        self.spectra += 1
+        self.last_fraction = flagged / mask.size
+        self.elapsed += time.time() - start
+        return mask
+
+    def __call__(self, spectrum):
+        """Publisher stage: attach the packed mask to the spectrum."""
+        spectrum.mask = pack_mask(self.flag(spectrum.data))
+
+    def stats(self):
+        """Spectra seen, overall and last flagged fractions, mean cost."""
+        size = int(np.prod(self.shape))
+        return {
+            'method': self.method,
+            'spectra': self.spectra,
+            'flagged_fraction': self.flagged / (self.spectra * size) if self.spectra else 0.0,
+            'last_fraction': self.last_fraction,
+            'ms_per_spectrum': 1e3 * self.elapsed / self.spectra if self.spectra else 0.0,
+        }
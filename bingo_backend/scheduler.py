@@ -0,0 +1,162 @@
+"""
+acc_cnt-driven dump detection.
+
+The vector accumulators dump every acc_len spectra, i.e. every
+acc_len * nchan / sample_rate seconds, and bump the acc_cnt register when
+they do.  DumpScheduler predicts the next dump from that period, sleeps
+until just after it and confirms it with a single acc_cnt read, so each
+accumulation is read exactly once instead of re-reading the BRAM on a
+fixed timer.  Skipped accumulations, counter resets and polls that found
+an already-read accumulation are counted.
+
+Without a known period the scheduler falls back to polling acc_cnt every
+poll_interval seconds, which still reads each dump only once.
+"""
+
+from __future__ import division, print_function
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def dump_period(acc_len, nchan, sample_rate):
+    """Seconds between accumulator dumps.
+
+    :param acc_len: spectra accumulated per dump (the acc_len register)
+    :param nchan: FFT length in channels
+    :param sample_rate: complex sample rate into the FFT in Hz, e.g.
+        3000e6 / 16 for bingo_dec16_32k
+    """
+    return acc_len * nchan / float(sample_rate)
+
+
+class DumpScheduler(object):
+    """Wait for new accumulations of one board."""
+
+    def __init__(self, reader, period=None, guard=0.005, poll_interval=0.01,
+                 relock_every=64, clock=time.time):
+        """
+        :param reader: bingo_backend.readout.SpectrumReader of the board
+        :param period: seconds between dumps (see dump_period), or None to
+            poll every poll_interval
+        :param guard: seconds to wake up after the predicted dump
+        :param poll_interval: seconds between acc_cnt polls while waiting
+            for a late dump
+        :param relock_every: every this many dumps, wake up *before* the
+            predicted dump to re-measure the dump phase, so drift between
+            the host and FPGA clocks is tracked
+        :param clock: host time source; waits go through the ``halt``
+            event given to wait()
+        """
+        self.reader = reader
+        self.period = period
+        self.guard = guard
+        self.poll_interval = poll_interval
+        self.relock_every = relock_every
+        self.clock = clock
+        self.anchor = None          # host time of the last measured dump
+        self.last_acc_cnt = None
+        self.polls = 0
+        self.dumps = 0
+        self.skipped = 0
+        self.repeats = 0
+        self.resets = 0
+        self.late = 0
+        self._never = threading.Event()
+
+    def check(self):
+        """Read acc_cnt once.
+
+        Returns how many accumulations happened since the last one read
+        (0 if none; always 1 for designs without a counter).
+        """
+        acc_n = self.reader.read_count()
+        self.polls += 1
+        if acc_n is None:
+            self.dumps += 1
+            return 1
+        return self.observe(acc_n)
+
+    def observe(self, acc_n):
+        """Account for an acc_cnt value read elsewhere, e.g. by a
+        bracketed BRAM read that saw a later dump than the poll.
+
+        Returns the number of accumulations since the last one seen.
+        """
+        last = self.last_acc_cnt
+        if acc_n == last:
+            self.repeats += 1
+            return 0
+        advance = 1
+        if last is not None:
+            if acc_n < last:
+                self.resets += 1
+                logger.info('acc_cnt reset from %i to %i', last, acc_n)
+            else:
+                advance = acc_n - last
+                if advance > 1:
+                    self.skipped += advance - 1
+                    logger.warning('skipped %i accumulation(s) before acc_cnt %i',
+                                   advance - 1, acc_n)
+        self.last_acc_cnt = acc_n
+        self.dumps += 1
+        return advance
+
+    def wait(self, halt=None):
+        """Block until a new accumulation is ready to be read.
+
+        Returns True when one is, False if ``halt`` (a threading.Event)
+        was set first.
+        """
+        if halt is None:
+            halt = self._never
+        if self.period is not None and self.anchor is not None:
+            relock = self.relock_every and self.dumps % self.relock_every == 0
+            if relock:
+                # the anchor can be up to one poll interval late
+                target = self.anchor + self.period - self.guard - self.poll_interval
+            else:
+                target = self.anchor + self.period + self.guard
+            delay = target - self.clock()
+            if delay > 0 and halt.wait(delay):
+                return False
+            resets = self.resets
+            advance = self.check()
+            if advance:
+                if self.resets != resets or relock:
+                    # counter restarted, or the dumps drifted earlier than
+                    # the guard: measure the phase again on the next dump
+                    self.anchor = None
+                else:
+                    self.anchor += advance * self.period
+                return True
+            if not relock:
+                self.late += 1
+        # poll until acc_cnt moves, which pins the dump time to one interval
+        stalled = self.clock() + (2 * self.period if self.period else 0) + 1.0
+        while not halt.is_set():
+            known = self.last_acc_cnt is not None
+            resets = self.resets
+            if self.check():
+                if known and self.resets == resets:
+                    self.anchor = self.clock()
+                return True
+            if stalled is not None and self.clock() > stalled:
+                logger.warning('acc_cnt has not changed from %r', self.last_acc_cnt)
+                stalled = None
+            halt.wait(self.poll_interval)
+        return False
+
+    def stats(self):
+        """Counters of polls, dumps read and dump anomalies."""
+        return {
+            'polls': self.polls,
+            'dumps': self.dumps,
+            'skipped': self.skipped,
+            'repeats': self.repeats,
+            'resets': self.resets,
+            'late': self.late,
+        }
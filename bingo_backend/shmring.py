@@ -0,0 +1,354 @@
+"""
+Shared-memory ring of spectra between processes.
+
+One producer (the BRAM acquisition or the SPEAD receiver, through
+RingSink) writes fixed-size slots into a block of shared memory; any
+number of consumer processes (archive, RFI flagging, live view) attach to
+the block by name and read every slot at their own pace.  Spectra cross
+the process boundary as a single memory copy, without pickling and
+without sharing a GIL.
+
+The block holds a control header, one cursor record per consumer and
+``nslots`` slots:
+
+    control    magic, layout, write_seq (number of slots ever written)
+    cursors    per consumer: next sequence number to read, overruns,
+               spectra read, attached flag
+    slots      per slot: seq, acc_cnt, timestamp, ticks, board, flags,
+               followed by the spectrum
+
+There are no locks.  The producer marks a slot as being written (seq -1),
+fills it, stores its sequence number and only then advances write_seq.
+A consumer that falls more than ``nslots`` behind skips to the oldest slot
+still in the ring and counts the spectra it missed as overruns; a slot
+overwritten while it was being copied is detected by its seq changing and
+counted the same way.  The producer never waits for a consumer.
+
+Consumers are identified by a small index chosen when they are started,
+so no process has to allocate cursors at run time.
+
+The block is a multiprocessing.shared_memory segment on Python 3.13+ and
+a memory-mapped file in /dev/shm (or the temporary directory) otherwise,
+which on Linux is the same thing without the resource tracker.
+"""
+
+from __future__ import division, print_function
+
+import mmap
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from .acquisition import Spectrum
+from .sinks import Sink
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python 2
+    shared_memory = None
+
+RING_MAGIC = b'BSRG'
+RING_VERSION = 1
+CONTROL_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'),
+                          ('nslots', '<u4'), ('consumers', '<u4'),
+                          ('dtype', 'S8'), ('ndim', '<u4'), ('pad', '<u4'),
+                          ('shape', '<u8', (2,)), ('write_seq', '<i8'),
+                          ('reserved', '<u8', (2,))])
+CURSOR_DTYPE = np.dtype([('cursor', '<i8'), ('overruns', '<i8'),
+                         ('read', '<i8'), ('attached', '<u8')])
+SLOT_HEADER_DTYPE = np.dtype([('seq', '<i8'), ('acc_cnt', '<i8'),
+                              ('timestamp', '<f8'), ('ticks', '<i8'),
+                              ('board', '<u4'), ('flags', '<u4'),
+                              ('reserved', '<u8', (3,))])
+NO_TICKS = -1
+
+
+class _Block(object):
+    """A named block of shared memory."""
+
+    def __init__(self, name, size=None):
+        self.name = name
+        self.created = size is not None
+        self._shm = self._open_shm(name, size)
+        if self._shm is not None:
+            self.buf = self._shm.buf
+            return
+        self.path = os.path.join('/dev/shm' if os.path.isdir('/dev/shm')
+                                 else tempfile.gettempdir(), name)
+        flags = os.O_RDWR | (os.O_CREAT | os.O_EXCL if self.created else 0)
+        fd = os.open(self.path, flags, 0o600)
+        try:
+            if self.created:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        self.buf = self._mmap
+
+    @staticmethod
+    def _open_shm(name, size):
+        """An untracked shared_memory segment, or None where unsupported.
+
+        Before Python 3.13 the resource tracker of every attaching process
+        unlinks the segment when that process exits, so the file-backed
+        block is used there instead.
+        """
+        if shared_memory is None:
+            return None
+        try:
+            return shared_memory.SharedMemory(name, create=size is not None,
+                                              size=size or 0, track=False)
+        except TypeError:
+            return None
+
+    def close(self):
+        if self._shm is not None:
+            self.buf = None
+            self._shm.close()
+        else:
+            self._mmap.close()
+
+    def unlink(self):
+        if self._shm is not None:
+            self._shm.unlink()
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class SpectrumRing(object):
+    """Fixed-size spectrum slots in shared memory."""
+
+    def __init__(self, block):
+        """Use SpectrumRing.create() or SpectrumRing.attach()."""
+        self._block = block
+        self.name = block.name
+        buf = block.buf
+        self._control = np.ndarray(1, CONTROL_DTYPE, buf)
+        control = self._control[0]
+        if control['magic'] != RING_MAGIC:
+            raise ValueError('%s is not a spectrum ring' % self.name)
+        self.nslots = int(control['nslots'])
+        self.dtype = np.dtype(control['dtype'].decode('ascii'))
+        self.shape = tuple(int(n) for n in control['shape'][:control['ndim']])
+        self.nconsumers = int(control['consumers'])
+        offset = CONTROL_DTYPE.itemsize
+        self.cursors = np.ndarray(self.nconsumers, CURSOR_DTYPE, buf, offset)
+        offset += self.nconsumers * CURSOR_DTYPE.itemsize
+        self.slot_dtype = np.dtype([('header', SLOT_HEADER_DTYPE),
+                                    ('data', self.dtype, self.shape)])
+        self.slots = np.ndarray(self.nslots, self.slot_dtype, buf, offset)
+        self.headers = self.slots['header']
+        self.data = self.slots['data']
+
+    @staticmethod
+    def nbytes(shape, dtype, nslots, consumers):
+        slot = SLOT_HEADER_DTYPE.itemsize + int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return (CONTROL_DTYPE.itemsize + consumers * CURSOR_DTYPE.itemsize +
+                nslots * slot)
+
+    @classmethod
+    def create(cls, name, shape, dtype='float64', nslots=64, consumers=4):
+        """Create a ring; the creating process owns it and unlinks it.
+
+        :param name: name other processes attach with
+        :param shape: shape of one spectrum, nchan or (boards, nchan)
+        :param dtype: sample type of the slots
+        :param nslots: spectra held before the oldest is overwritten
+        :param consumers: number of consumer cursors
+        """
+        shape = tuple(np.atleast_1d(shape).tolist())
+        if len(shape) > 2:
+            raise ValueError('spectra must have 1 or 2 dimensions')
+        block = _Block(name, cls.nbytes(shape, dtype, nslots, consumers))
+        control = np.ndarray(1, CONTROL_DTYPE, block.buf)
+        control[0] = 0
+        control['magic'] = RING_MAGIC
+        control['version'] = RING_VERSION
+        control['nslots'] = nslots
+        control['consumers'] = consumers
+        control['dtype'] = np.dtype(dtype).str.encode('ascii')
+        control['ndim'] = len(shape)
+        control['shape'][0, :len(shape)] = shape
+        ring = cls(block)
+        ring.cursors[:] = 0
+        ring.headers['seq'] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a ring created by another process."""
+        return cls(_Block(name))
+
+    @property
+    def write_seq(self):
+        """Number of spectra written so far."""
+        return int(self._control['write_seq'][0])
+
+    # -- producer ------------------------------------------------------
+
+    def write(self, data, acc_cnt=0, timestamp=0.0, board=0, flags=0,
+              ticks=None):
+        """Write one spectrum into the next slot, overwriting the oldest."""
+        seq = self.write_seq
+        i = seq % self.nslots
+        header = self.headers[i:i + 1]
+        header['seq'] = -1                  # being written
+        self.data[i] = data
+        header['acc_cnt'] = acc_cnt
+        header['timestamp'] = timestamp
+        header['ticks'] = NO_TICKS if ticks is None else ticks
+        header['board'] = board
+        header['flags'] = flags
+        header['seq'] = seq
+        self._control['write_seq'] = seq + 1   # publish
+        return seq
+
+    # -- consumers -----------------------------------------------------
+
+    def consumer(self, index, from_start=False):
+        """Read cursor ``index``; see RingConsumer."""
+        return RingConsumer(self, index, from_start)
+
+    def stats(self):
+        """Spectra written, and read/overruns per attached consumer."""
+        return {
+            'written': self.write_seq,
+            'consumers': dict((i, {'read': int(c['read']),
+                                   'overruns': int(c['overruns']),
+                                   'lag': self.write_seq - int(c['cursor'])})
+                              for i, c in enumerate(self.cursors)
+                              if c['attached']),
+        }
+
+    def close(self):
+        """Detach; the creator also removes the block."""
+        self._control = self.cursors = self.slots = None
+        self.headers = self.data = None
+        self._block.close()
+        if self._block.created:
+            self._block.unlink()
+
+
+class RingConsumer(object):
+    """One reader of a SpectrumRing, with its cursor in shared memory."""
+
+    def __init__(self, ring, index, from_start=False):
+        """
+        :param ring: SpectrumRing attached in this process
+        :param index: cursor number, below the ring's ``consumers``
+        :param from_start: begin at the oldest spectrum still in the ring
+            instead of the next one written
+        """
+        if not 0 <= index < ring.nconsumers:
+            raise ValueError('ring %s has %i consumer cursors'
+                             % (ring.name, ring.nconsumers))
+        self.ring = ring
+        self.index = index
+        self._cursor = ring.cursors[index:index + 1]
+        start = ring.write_seq
+        if from_start:
+            start = max(0, start - ring.nslots)
+        self._cursor['cursor'] = start
+        self._cursor['attached'] = 1
+        self.poll_interval = 0.001
+
+    @property
+    def cursor(self):
+        return int(self._cursor['cursor'][0])
+
+    @property
+    def overruns(self):
+        return int(self._cursor['overruns'][0])
+
+    def _skip(self, to):
+        self._cursor['overruns'] += to - self.cursor
+        self._cursor['cursor'] = to
+
+    def available(self):
+        """Spectra written but not read yet."""
+        return self.ring.write_seq - self.cursor
+
+    def read(self, timeout=None, out=None):
+        """Copy out the next spectrum as a Spectrum, or None on timeout.
+
+        :param timeout: seconds to wait, None to wait indefinitely
+        :param out: optional array to copy the spectrum into
+        """
+        ring = self.ring
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            seq = self.cursor
+            written = ring.write_seq
+            if written - seq > ring.nslots:
+                self._skip(written - ring.nslots)
+                continue
+            if seq < written:
+                i = seq % ring.nslots
+                if out is None:
+                    data = ring.data[i].copy()
+                else:
+                    data = out
+                    data[...] = ring.data[i]
+                header = ring.headers[i].copy()
+                if ring.headers[i]['seq'] != seq or header['seq'] != seq:
+                    self._skip(seq + 1)     # lapped while copying
+                    continue
+                self._cursor['cursor'] = seq + 1
+                self._cursor['read'] += 1
+                ticks = int(header['ticks'])
+                return Spectrum(int(header['acc_cnt']), data,
+                                float(header['timestamp']), int(header['board']),
+                                ticks=None if ticks == NO_TICKS else ticks)
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def run(self, sink, halt=None):
+        """Feed every spectrum to a bingo_backend.sinks.Sink until ``halt``
+        (a threading or multiprocessing Event) is set."""
+        sink.open()
+        try:
+            while halt is None or not halt.is_set():
+                spectrum = self.read(timeout=0.1)
+                if spectrum is not None:
+                    sink.write(spectrum)
+        finally:
+            sink.close()
+
+    def close(self):
+        """Release the cursor."""
+        self._cursor['attached'] = 0
+        self._cursor = None
+
+
+class RingSink(Sink):
+    """Write every published spectrum into a SpectrumRing.
+
+    The ring is created in open(), when acquisition starts, so a run that
+    fails before then leaves no segment behind, and removed in close().
+    Consumer processes attach once it exists.
+    """
+
+    def __init__(self, name, shape, dtype='float64', nslots=64, consumers=4):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.nslots = nslots
+        self.consumers = consumers
+        self.ring = None
+
+    def open(self):
+        self.ring = SpectrumRing.create(self.name, self.shape, self.dtype,
+                                        self.nslots, self.consumers)
+
+    def write(self, spectrum):
+        self.ring.write(spectrum.data, spectrum.acc_cnt or 0,
+                        spectrum.timestamp, spectrum.board,
+                        ticks=spectrum.ticks)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
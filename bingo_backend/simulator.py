@@ -0,0 +1,456 @@
+"""
+Simulated SKARAB standing in for casperfpga.CasperFpga.
+
+SimulatedSkarab answers the calls the scripts and this package make on a
+board (read, read_uint, write_int, upload_to_ram_and_program,
+get_system_information, is_running, memory_devices, system_info) for one
+of the designs in DESIGNS, so the readout, storage and plotting paths can
+be benchmarked and regression-tested on any Linux box:
+
+    board = SimulatedSkarab('sim0', 'dec16_32k', latency=0.5e-3)
+    board.upload_to_ram_and_program('bingo.fpg')
+    board.write_int('acc_len', 5722)
+    reader = SpectrumReader(board, ['mem_left_0_0'], 32768)
+
+or, for the scripts and bring_up(), ``board_class=SimulatedSkarab.factory(
+'dec16_32k')``.
+
+The accumulator behaves like the firmware's: acc_cnt advances once per
+dump period, acc_len * nchan / (sample_rate / decimation), from the last
+counter reset (cnt_rst), ADC sync or PPS load, and the BRAMs hold the
+spectrum of the latest dump in BRAM order (see bingo_backend.channels).
+Spectra are a rippled bandpass with radiometer noise for the current
+acc_len plus a few tones, generated once per dump and reproducible from
+``seed`` and acc_cnt.  The packet buffers of the baseband design hold
+complex noise with a tone, refilled at the sample rate.
+
+Every transaction takes ``latency`` seconds plus the payload over
+``bandwidth`` bytes/s and transactions on one board are serialised, as on
+the board's single control connection.  As in casperfpga, write_int()
+reads the register back (a second transaction) unless ``blindwrite`` is
+set.  Register writes with side effects:
+
+    cnt_rst   a rising edge restarts acc_cnt at 0
+    acc_len   takes effect at once and restarts acc_cnt
+    sw_pps    bit 2 (LOAD_PPS) arms a PPS load; at the next whole second
+              of the clock (or at once with bit 1, software PPS, and bit
+              0 set) utc_time is latched into utc_time_count, which then
+              counts seconds, and acc_cnt restarts on the PPS edge;
+              clearing bit 2 before the edge cancels the load
+
+The ADC yellow blocks (SimulatedAdc) accept the configuration calls of the
+scripts; sync_skarab_adc() restarts the accumulators of the master's and
+the slaves' boards on a common edge.
+"""
+
+from __future__ import division, print_function
+
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from .baseband import COMPONENTS, buffer_name
+from .channels import ChannelMap
+
+ADC_TAG = 'xps:skarab_adc4x3g_14'
+ADC_SAMPLE_RATE = 3000e6
+
+# channel mode (bingo_backend.channels) and BRAMs of each design; spectra
+# are interleaved over the BRAMs like bingo_backend.readout.interleave()
+DESIGNS = {
+    'dec16_32k': dict(mode='dec16_32k', brams=['mem_left_0_0']),
+    'dec8_1k': dict(mode='dec8_1k', brams=['mem_left_0_0', 'mem_left_0_1']),
+    'dec8_8k': dict(mode='dec8_8k', brams=['mem_left_0_0', 'mem_left_0_1']),
+    'baseband': dict(mode='baseband', brams=[], buffers=[buffer_name(c) for c in COMPONENTS],
+                     buffer_words=256),
+}
+REGISTERS = ('acc_len', 'acc_cnt', 'fft_shift', 'shift', 'cnt_rst', 'rst_cpoge',
+             'utc_time', 'sw_pps', 'utc_time_count', 'center_freq')
+DEFAULT_ACC_LEN = 1024
+# (offset from the band centre in units of the band, power relative to
+# the noise) of the default tones
+DEFAULT_TONES = ((0.125, 20.0), (-0.3, 5.0))
+
+
+class SkarabDefinitions(object):
+    """The casperfpga.skarab_definitions constants the scripts use, for
+    running them against simulated boards without casperfpga."""
+
+    FIRST_NYQ_ZONE = 0
+    SECOND_NYQ_ZONE = 1
+    ADC_DATA_MODE = 0
+    RAMP_DATA_MODE = 1
+    YB_SKARAB_ADC4X3G_14 = 0
+    YB_SKARAB_ADC4X3G_14_BYP = 1
+
+
+def skarab_definitions():
+    """casperfpga.skarab_definitions when installed, else SkarabDefinitions."""
+    try:
+        from casperfpga import skarab_definitions as sd
+        return sd
+    except ImportError:
+        return SkarabDefinitions
+
+
+def _yb_type():
+    """The DDC-mode yellow block type of the simulated ADCs."""
+    return skarab_definitions().YB_SKARAB_ADC4X3G_14
+
+
+class SimulatedDevice(object):
+    """A memory device (register, BRAM) of the simulated design."""
+
+    def __init__(self, name, tag):
+        self.name = name
+        self.device_info = {'tag': tag}
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.name)
+
+
+class SimulatedAdc(SimulatedDevice):
+    """A SKARAB ADC yellow block accepting the scripts' configuration calls."""
+
+    def __init__(self, board, name, mezzanine_site=0, master_slave='Master'):
+        SimulatedDevice.__init__(self, name, ADC_TAG)
+        self.board = board
+        self.mezzanine_site = mezzanine_site
+        self.master_slave = master_slave
+        self.yb_type = _yb_type()
+        self.dout = False
+        self.gains = [0, 0, 0, 0]
+        self.ddc_freqs = [1e9] * 4
+        self.data_mode = None
+
+    def enable_skarab_adc_dout(self, enable):
+        self.dout = bool(enable)
+
+    def configure_skarab_adc(self, nyquist_zone, decimation=None, *args):
+        if decimation:
+            self.board.decimation = decimation
+
+    def set_skarab_adc_data_mode(self, data_mode):
+        self.data_mode = data_mode
+
+    def set_skarab_adc_channel_gain(self, channel, gain):
+        self.gains[channel] = gain
+
+    def configure_skarab_adc_ddcs(self, channel, freq):
+        """Tune a DDC; returns ``(actual frequency, register value)``."""
+        # 16-bit tuning word over the ADC sample rate, as on the board
+        step = ADC_SAMPLE_RATE / 2 ** 16
+        word = int(round(freq / step))
+        self.ddc_freqs[channel] = word * step
+        self.board.ddc_freq = word * step
+        return self.ddc_freqs[channel], word
+
+    def reset_skarab_adc(self):
+        pass
+
+    def sync_skarab_adc(self, slaves=()):
+        """Restart the accumulators of every board involved together."""
+        boards = [self.board] + [adc.board for adc in slaves]
+        now = self.board.clock()
+        for board in set(boards):
+            board.restart(now)
+
+
+class SimulatedSkarab(object):
+    """A SKARAB running one of DESIGNS, without the hardware."""
+
+    def __init__(self, host, design='dec16_32k', latency=0.0, bandwidth=None,
+                 seed=0, tones=DEFAULT_TONES, level=100.0, program_time=0.0,
+                 nadcs=1, clock=time.time):
+        """
+        :param host: name of the board, used in reprs and as seed salt
+        :param design: key of DESIGNS
+        :param latency: seconds per transaction
+        :param bandwidth: bytes/s of the control link, None for no limit
+        :param seed: seed of the synthetic spectra
+        :param tones: ``(offset, power)`` pairs: offset from the band
+            centre as a fraction of the band, power relative to the noise
+        :param level: mean of a spectrum channel at acc_len 1; the
+            default keeps 32-bit accumulators clear of overflow up to an
+            acc_len of about 10**6
+        :param program_time: seconds upload_to_ram_and_program() takes
+        :param nadcs: ADC yellow blocks in the design, the first Master
+        :param clock: time source, time.time by default
+        """
+        if design not in DESIGNS:
+            raise ValueError('unknown design %r, not one of %s' % (design, sorted(DESIGNS)))
+        self.host = host
+        self.design = design
+        self.spec = DESIGNS[design]
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.seed = seed
+        self.tones = tones
+        self.level = level
+        self.program_time = program_time
+        self.nadcs = nadcs
+        self.clock = clock
+        self.decimation = None      # set by configure_skarab_adc()
+        self.ddc_freq = 1e9
+        self.programmed = False
+        self.memory_devices = {}
+        self.snapshots = []
+        self.system_info = {}
+        self.registers = dict((name, 0) for name in REGISTERS)
+        self.registers['acc_len'] = DEFAULT_ACC_LEN
+        self.transactions = 0
+        self.bytes_read = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+        self._epoch = clock()
+        self._pps_armed = False
+        self._pps_time = None
+        self._cache = (None, None)   # (acc_cnt, {bram: bytes})
+        self._salt = zlib.crc32(host.encode('utf-8')) & 0xffffffff
+
+    @classmethod
+    def factory(cls, design, **kwargs):
+        """Board constructor taking only a host, for bring_up(board_class=...)."""
+        def make(host):
+            return cls(host, design, **kwargs)
+        return make
+
+    def __repr__(self):
+        return 'SimulatedSkarab(%r, %r)' % (self.host, self.design)
+
+    # -- design --------------------------------------------------------
+
+    @property
+    def channel_map(self):
+        return ChannelMap.for_mode(self.spec['mode'], 0.0, ADC_SAMPLE_RATE,
+                                   self.decimation)
+
+    def dump_period(self):
+        """Seconds between dumps at the current acc_len and decimation."""
+        channel_map = self.channel_map
+        return max(1, self.registers['acc_len']) * channel_map.nchan / channel_map.sample_rate
+
+    def _load_design(self):
+        devices = {}
+        for name in REGISTERS:
+            devices[name] = SimulatedDevice(name, 'xps:sw_reg')
+        for name in self.spec['brams'] + self.spec.get('buffers', []):
+            devices[name] = SimulatedDevice(name, 'xps:bram')
+        for k in range(self.nadcs):
+            name = 'skarab_adc4x3g_14_%i' % k
+            devices[name] = SimulatedAdc(self, name, k, 'Master' if k == 0 else 'Slave')
+        self.memory_devices = devices
+        self.system_info = {'clk_src': 'sys_clk'}
+
+    def upload_to_ram_and_program(self, filename=None, *args, **kwargs):
+        if self.program_time:
+            time.sleep(self.program_time)
+        self._load_design()
+        self.programmed = True
+        self.restart(self.clock())
+        return True
+
+    def get_system_information(self, filename=None, fpg_info=None, **kwargs):
+        self._load_design()
+
+    def is_running(self):
+        return self.programmed
+
+    # -- accumulator and PPS -------------------------------------------
+
+    def restart(self, when):
+        """Restart acc_cnt at 0 on the edge at time ``when``."""
+        self._epoch = when
+        self._cache = (None, None)
+
+    def _update_pps(self, now):
+        if self._pps_armed and now >= self._pps_due:
+            self._pps_armed = False
+            self._pps_time = self._pps_due
+            self._pps_value = self.registers['utc_time']
+            self.restart(self._pps_due)
+
+    def acc_cnt(self, now=None):
+        if now is None:
+            now = self.clock()
+        return int((now - self._epoch) // self.dump_period()) & 0xffffffff
+
+    def _register(self, name, now):
+        if name == 'acc_cnt':
+            return self.acc_cnt(now)
+        if name == 'utc_time_count':
+            if self._pps_time is None:
+                return 0
+            return (self._pps_value + int(now - self._pps_time)) & 0xffffffff
+        return self.registers[name]
+
+    def _write_register(self, name, value, now):
+        old = self.registers[name]
+        self.registers[name] = value
+        if name == 'cnt_rst' and value and not old:
+            self.restart(now)
+        elif name == 'acc_len':
+            self.restart(now)
+        elif name == 'sw_pps':
+            if value & 0x4 and not old & 0x4:
+                self._pps_armed = True
+                software = value & 0x2
+                self._pps_due = now if software and value & 0x1 else float(np.floor(now) + 1)
+            elif old & 0x4 and not value & 0x4:
+                self._pps_armed = False     # LOAD_PPS dropped before the edge
+
+    # -- synthetic data ------------------------------------------------
+
+    def spectrum(self, acc_cnt):
+        """Synthetic spectrum of one dump, in BRAM order, as uint32."""
+        channel_map = self.channel_map
+        nchan = channel_map.nchan
+        acc_len = max(1, self.registers['acc_len'])
+        rng = np.random.RandomState([self.seed, self._salt, acc_cnt])
+        x = np.arange(nchan) / nchan
+        mean = self.level * acc_len * (1 + 0.3 * np.sin(2 * np.pi * 3 * x)) * \
+            np.exp(-((x - 0.5) / 0.45) ** 8)
+        data = mean * (1 + rng.standard_normal(nchan) / np.sqrt(acc_len))
+        for offset, power in self.tones:
+            channel = int(nchan // 2 + channel_map.step * round(offset * nchan))
+            if 0 <= channel < nchan:
+                data[channel] += power * self.level * acc_len
+        np.clip(data, 0, 2 ** 32 - 1, out=data)
+        # display channel d lives in BRAM channel perm[d]
+        raw = np.empty(nchan, dtype='>u4')
+        raw[channel_map.perm] = data
+        return raw
+
+    def _bram_contents(self, now):
+        acc_cnt = self.acc_cnt(now)
+        cached_cnt, contents = self._cache
+        if cached_cnt != acc_cnt:
+            raw = self.spectrum(acc_cnt)
+            brams = self.spec['brams']
+            contents = dict((name, raw[k::len(brams)].tobytes())
+                            for k, name in enumerate(brams))
+            self._cache = (acc_cnt, contents)
+        return contents
+
+    def _buffer_contents(self, name, now):
+        """One refill of a packet buffer: complex noise plus a tone."""
+        words = self.spec['buffer_words']
+        rate = self.channel_map.sample_rate
+        refill = int((now - self._epoch) * rate // words)
+        component = COMPONENTS.index(name[len('packet_buffer_'):-2])
+        rng = np.random.RandomState([self.seed, refill, component])
+        t = (refill * words + np.arange(words)) / rate
+        phase = 2 * np.pi * 0.125 * rate * t + (np.pi / 2 if component % 2 else 0)
+        samples = 1000 * rng.standard_normal(words) + 2000 * np.cos(phase)
+        return np.clip(samples, -32768, 32767).astype('>i2').tobytes()
+
+    # -- transactions --------------------------------------------------
+
+    def _transaction(self, nbytes=0):
+        """Hold the link for one transaction; returns its completion time."""
+        cost = self.latency
+        if self.bandwidth:
+            cost += nbytes / self.bandwidth
+        if cost:
+            time.sleep(cost)
+        self.transactions += 1
+        self.busy_time += cost
+        now = self.clock()
+        self._update_pps(now)
+        return now
+
+    def _device(self, name):
+        if name not in self.memory_devices:
+            raise KeyError('%s: no device %r in design %s' % (self.host, name, self.design))
+        return self.memory_devices[name]
+
+    def read(self, device_name, size, offset=0):
+        """Read ``size`` bytes of a BRAM or packet buffer."""
+        with self._lock:
+            self._device(device_name)
+            now = self._transaction(size)
+            if device_name in self.registers:
+                data = np.array([self._register(device_name, now)], '>u4').tobytes()
+            elif device_name in self.spec['brams']:
+                data = self._bram_contents(now)[device_name]
+            else:
+                data = self._buffer_contents(device_name, now)
+            if offset + size > len(data):
+                raise ValueError('%s: read of %i bytes at %i past the end of %s (%i bytes)'
+                                 % (self.host, size, offset, device_name, len(data)))
+            self.bytes_read += size
+            return data[offset:offset + size]
+
+    def read_uint(self, device_name, word_offset=0):
+        with self._lock:
+            self._device(device_name)
+            now = self._transaction(4)
+            return self._register(device_name, now)
+
+    def write_int(self, device_name, integer, blindwrite=False, word_offset=0):
+        with self._lock:
+            self._device(device_name)
+            now = self._transaction(4)
+            self._write_register(device_name, int(integer) & 0xffffffff, now)
+            if not blindwrite:
+                self._transaction(4)    # the read-back
+
+    def stats(self):
+        """Transactions, bytes read and seconds spent on the link."""
+        return {'transactions': self.transactions, 'bytes_read': self.bytes_read,
+                'busy_time': self.busy_time}
+
+
+def main():
+    """Run the readout and acquisition path against a simulated board."""
+    from optparse import OptionParser
+
+    from .acquisition import Acquisition
+    from .readout import SpectrumReader
+    from .scheduler import DumpScheduler
+    from .sinks import LatestSink
+
+    p = OptionParser()
+    p.set_usage('python -m bingo_backend.simulator [options]')
+    p.set_description(__doc__)
+    p.add_option('-d', '--design', dest='design', type='choice', default='dec16_32k',
+                 choices=sorted(d for d in DESIGNS if DESIGNS[d]['brams']),
+                 help='Simulated design. Default dec16_32k.')
+    p.add_option('-l', '--acc_len', dest='acc_len', type='int', default=512,
+                 help='Spectra accumulated per dump. Default 512.')
+    p.add_option('-L', '--latency', dest='latency', type='float', default=0.5,
+                 help='Milliseconds per transaction. Default 0.5.')
+    p.add_option('-t', '--duration', dest='duration', type='float', default=5.0,
+                 help='Seconds to run. Default 5.')
+    opts, args = p.parse_args()
+
+    board = SimulatedSkarab('sim0', opts.design, latency=opts.latency / 1e3)
+    board.upload_to_ram_and_program()
+    board.write_int('acc_len', opts.acc_len)
+    nchan = board.channel_map.nchan
+    brams = DESIGNS[opts.design]['brams']
+    reader = SpectrumReader(board, brams, nchan // len(brams))
+    latest = LatestSink()
+    acquisition = Acquisition(reader, [latest],
+                              scheduler=DumpScheduler(reader, board.dump_period()))
+    print('%s: %i channels, one dump every %.3f s'
+          % (board, nchan, board.dump_period()))
+    acquisition.start()
+    time.sleep(opts.duration)
+    acquisition.stop()
+    spectrum = latest.get()
+    stats = acquisition.stats()
+    print('spectra %i, last acc_cnt %r, torn reads %i, read errors %i'
+          % (stats['spectra'], stats['last_acc_cnt'], stats['reads']['torn'],
+             stats['read_errors']))
+    print('board: %(transactions)i transactions, %(bytes_read)i bytes, '
+          '%(busy_time).3f s on the link' % board.stats())
+    if spectrum is not None:
+        shown = board.channel_map.reorder(spectrum.data)
+        print('strongest channel %i of %i' % (int(np.argmax(shown)), nchan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Spectrum sinks fed by the acquisition loop.
+
+A sink receives every spectrum published by bingo_backend.acquisition on
+its own worker thread, so a slow sink (a plot redraw, a full disk) never
+holds up the board readout.  New sinks subclass Sink and implement
+write().  open() is called by Publisher.start(), on the starting thread,
+so a sink that cannot open stops the acquisition from starting; close()
+is called on the worker thread after the last write.
+"""
+
+from __future__ import division, print_function
+
+import threading
+
+import numpy as np
+
+
+class Sink(object):
+    """Base class for spectrum consumers."""
+
+    def open(self):
+        """Called once by Publisher.start() before the first write; an
+        exception here fails the start."""
+        pass
+
+    def write(self, spectrum):
+        """Consume one bingo_backend.acquisition.Spectrum."""
+        raise NotImplementedError
+
+    def close(self):
+        """Called once on the worker thread after the last write."""
+        pass
+
+
+class LatestSink(Sink):
+    """Keep only the newest spectrum, for a live view to pick up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spectrum = None
+
+    def write(self, spectrum):
+        with self._lock:
+            self._spectrum = spectrum
+
+    def get(self):
+        """Return the newest spectrum, or None before the first dump."""
+        with self._lock:
+            return self._spectrum
+
+
+class PeakSink(Sink):
+    """Print the accumulation number and the strongest channel of each dump.
+
+    Multi-board spectra (boards x channels) get one line per board.
+    """
+
+    def write(self, spectrum):
+        for board, data in enumerate(np.atleast_2d(spectrum.data)):
+            indx = int(np.argmax(data))
+            print(spectrum.acc_cnt, board, indx, data[indx])
@@ -0,0 +1,443 @@
+"""
+SPEAD receiver for spectra streamed over 10/40 GbE, and a loopback sender.
+
+The spectrometer designs carry dest_ip/dest_port registers for streaming
+accumulations over UDP instead of reading them out of BRAM.  Each
+accumulation is sent as one SPEAD-64-48 heap: every packet starts with an
+8-byte header (0x53 0x04 0x02 0x06, two reserved bytes, item count) and a
+list of 64-bit item pointers (bit 63 immediate, 15-bit id, 48-bit value),
+followed by a slice of the spectrum:
+
+    HEAP_CNT     0x0001  heap counter (one per accumulation)
+    HEAP_SIZE    0x0002  bytes of spectrum in the heap
+    HEAP_OFFSET  0x0003  offset of this packet's payload in the heap
+    PAYLOAD_LEN  0x0004  bytes of payload in this packet
+    TIMESTAMP    0x1600  hardware timestamp of the accumulation
+
+SpeadReceiver drains the socket in batches into a pre-allocated
+(batch x max_packet) array, so a burst costs one select() and no
+allocation, and decodes the headers of the whole batch with NumPy.
+Payloads are copied into a small ring of heap buffers keyed by heap
+counter; each heap keeps the payload offsets it has received, so a
+repeated packet is counted as a duplicate instead of towards completion.
+Heaps are published (as Spectrum objects, to the same sinks as the BRAM
+readout) in heap counter order, as the archive, integrator and FITS sinks
+expect: a complete heap is held back until every older heap in the ring
+is complete too.  When the ring is full the oldest incomplete heap is
+given up, which releases the complete heaps behind it.  Packets for heaps
+already published or given up are counted as late.  Heap counters passed
+over without being published, given up or never seen, are counted as
+lost.
+
+Python has no recvmmsg(), so the batch is filled with recv_into() calls
+on a non-blocking socket; the kernel receive buffer (``rcvbuf``) is what
+absorbs bursts while a batch is being processed.  Its effective size is
+capped by net.core.rmem_max, and packets the kernel had to drop are
+reported by kernel_drops().
+
+Loopback test without hardware:
+
+    python -m bingo_backend.spead -n 32768 -c 200
+"""
+
+from __future__ import division, print_function
+
+import logging
+import select
+import socket
+import time
+
+import numpy as np
+
+from .acquisition import Publisher, Spectrum
+
+logger = logging.getLogger(__name__)
+
+SPEAD_MAGIC = 0x53040206        # magic, version, item pointer and address widths
+ADDRESS_BITS = 48
+ADDRESS_MASK = (1 << ADDRESS_BITS) - 1
+IMMEDIATE = 1 << 63
+
+HEAP_CNT = 0x0001
+HEAP_SIZE = 0x0002
+HEAP_OFFSET = 0x0003
+PAYLOAD_LEN = 0x0004
+TIMESTAMP = 0x1600
+SPECTRUM = 0x1800
+
+
+def item_pointer(item_id, value, immediate=True):
+    """One 64-bit SPEAD-64-48 item pointer."""
+    return (IMMEDIATE if immediate else 0) | (item_id << ADDRESS_BITS) | (value & ADDRESS_MASK)
+
+
+def parse_packets(packets, lengths, item_ids):
+    """Decode the headers of a batch of SPEAD packets.
+
+    :param packets: (n x max_packet) uint8 array, one packet per row
+    :param lengths: bytes received in each row
+    :param item_ids: ids of the immediate items to extract
+    :return: ``(valid, payload_start, values)``; ``values`` maps each item
+        id to an int64 array, ``valid`` is False for rows that are not
+        SPEAD-64-48 or lack one of the items
+    """
+    n = len(lengths)
+    valid = lengths >= 8
+    start = np.zeros(n, dtype=np.int64)
+    values = dict((i, np.zeros(n, dtype=np.int64)) for i in item_ids)
+    header = np.ascontiguousarray(packets[:n, :8]).view('>u8').ravel()
+    valid &= (header >> 32) == SPEAD_MAGIC
+    nitems = (header & 0xffff).astype(np.int64)
+    # packets of one stream share a layout, so this is normally one group
+    for k in np.unique(nitems[valid]):
+        rows = np.flatnonzero(valid & (nitems == k))
+        end = 8 + 8 * int(k)
+        if end > packets.shape[1]:
+            valid[rows] = False
+            continue
+        pointers = np.ascontiguousarray(packets[rows, 8:end]).view('>u8')
+        ids = (pointers >> ADDRESS_BITS) & 0x7fff
+        for item_id in item_ids:
+            match = ids == item_id
+            present = match.any(axis=1)
+            column = match.argmax(axis=1)
+            values[item_id][rows] = (pointers[np.arange(len(rows)), column] &
+                                     ADDRESS_MASK).astype(np.int64)
+            valid[rows[~present]] = False
+        start[rows] = end
+    if PAYLOAD_LEN in values:
+        valid &= start + values[PAYLOAD_LEN] <= lengths
+    return valid, start, values
+
+
+def kernel_drops(port):
+    """Datagrams the kernel dropped on a local UDP port (Linux), or None."""
+    drops = None
+    try:
+        with open('/proc/net/udp') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if int(fields[1].split(':')[1], 16) == port:
+                    drops = (drops or 0) + int(fields[-1])
+    except (IOError, OSError, StopIteration, ValueError, IndexError):
+        return None
+    return drops
+
+
+class _Heap(object):
+    """A ring slot: the buffer of one heap being assembled."""
+
+    __slots__ = ('heap_cnt', 'timestamp', 'received', 'offsets', 'complete',
+                 'buffer')
+
+    def __init__(self, nbytes):
+        self.heap_cnt = None
+        self.timestamp = None
+        self.received = 0
+        self.offsets = set()    # payload offsets received
+        self.complete = False   # every byte received, waiting for older heaps
+        self.buffer = np.zeros(nbytes, dtype=np.uint8)
+
+
+class SpeadReceiver(Publisher):
+    """Receive SPEAD heaps over UDP and publish them as spectra."""
+
+    thread_name = 'spead-receiver'
+
+    def __init__(self, port, nchan, dtype='>u4', bind='', sinks=(),
+                 queue_size=16, board=0, batch=64, max_packet=9000,
+                 ring_heaps=8, rcvbuf=64 * 1024 ** 2, heap_step=1,
+                 out_dtype=np.float64):
+        """
+        :param port: UDP port the board sends to (dest_port)
+        :param nchan: channels per heap
+        :param dtype: sample type of the heap payload
+        :param bind: local address to listen on ('' for all)
+        :param sinks: bingo_backend.sinks.Sink objects to publish to
+        :param queue_size: spectra buffered per sink before dropping
+        :param board: board label stored in every Spectrum
+        :param batch: packets drained from the socket per pass
+        :param max_packet: largest datagram expected (jumbo frames: 9000)
+        :param ring_heaps: heaps assembled concurrently, and the most
+            complete heaps held back behind an incomplete one
+        :param rcvbuf: kernel receive buffer to ask for, in bytes
+        :param heap_step: heap counter increment between accumulations
+        :param out_dtype: dtype of the published spectra
+        """
+        Publisher.__init__(self, sinks, queue_size)
+        self.nchan = nchan
+        self.dtype = np.dtype(dtype)
+        self.heap_bytes = nchan * self.dtype.itemsize
+        self.board = board
+        self.heap_step = heap_step
+        self.out_dtype = out_dtype
+        self.poll_interval = 0.1
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.rcvbuf = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        if self.rcvbuf < rcvbuf:
+            logger.warning('receive buffer is %i bytes, not %i: raise '
+                           'net.core.rmem_max to absorb longer bursts',
+                           self.rcvbuf, rcvbuf)
+        self.sock.bind((bind, port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+
+        # one spare byte per row tells a datagram longer than max_packet
+        # from one of exactly max_packet bytes
+        self._packets = np.zeros((batch, max_packet + 1), dtype=np.uint8)
+        self._views = [memoryview(row) for row in self._packets]
+        self._lengths = np.zeros(batch, dtype=np.int64)
+        self._ring = [_Heap(self.heap_bytes) for _ in range(ring_heaps)]
+        self._active = {}           # heap_cnt -> _Heap
+        self._floor = None          # newest heap published or given up
+
+        self.packets = 0
+        self.batches = 0
+        self.heaps = 0              # heaps published
+        self.incomplete = 0         # heaps given up with bytes missing
+        self.lost = 0               # heap counters passed over unpublished
+        self.late = 0               # packets for heaps already finished
+        self.duplicates = 0         # packets repeating an offset already received
+        self.invalid = 0            # packets that are not our SPEAD heaps
+        self.truncated = 0          # datagrams longer than max_packet
+        self.kernel_drops = None    # kernel count, kept when the socket closes
+
+    # -- socket --------------------------------------------------------
+
+    def receive_batch(self, timeout=None):
+        """Drain up to ``batch`` datagrams; returns how many were read."""
+        if timeout is not None:
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if not readable:
+                return 0
+        n = 0
+        max_packet = self._packets.shape[1] - 1
+        while n < len(self._views):
+            try:
+                nbytes = self.sock.recv_into(self._views[n])
+            except socket.error:
+                break           # EAGAIN: socket drained
+            if nbytes > max_packet:
+                self.truncated += 1
+                nbytes = max_packet
+            self._lengths[n] = nbytes
+            n += 1
+        if n:
+            self.batches += 1
+            self.packets += n
+        return n
+
+    # -- heap assembly -------------------------------------------------
+
+    def _slot(self, heap_cnt):
+        """Ring slot for a heap, evicting the oldest one if the ring is full."""
+        heap = self._active.get(heap_cnt)
+        if heap is not None:
+            return heap
+        if self._floor is not None and heap_cnt <= self._floor:
+            self.late += 1
+            return None
+        if len(self._active) == len(self._ring):
+            # the oldest heap is incomplete, or it would have been published
+            self.incomplete += 1
+            self._retire(self._active[min(self._active)], published=False)
+            self._release()
+            if heap_cnt <= self._floor:
+                self.late += 1
+                return None
+        heap = next(h for h in self._ring if h.heap_cnt is None)
+        heap.heap_cnt = heap_cnt
+        heap.received = 0
+        heap.offsets.clear()
+        heap.complete = False
+        self._active[heap_cnt] = heap
+        return heap
+
+    def _retire(self, heap, published):
+        """Free the slot of the oldest active heap and count the heap
+        counters passed over since the last one retired."""
+        heap_cnt = heap.heap_cnt
+        if self._floor is not None:
+            self.lost += max(0, (heap_cnt - self._floor) // self.heap_step - 1)
+        if not published:
+            self.lost += 1
+        self._floor = heap_cnt
+        del self._active[heap_cnt]
+        heap.heap_cnt = None
+
+    def _release(self):
+        """Publish the complete heaps that no older heap holds back."""
+        while self._active:
+            heap = self._active[min(self._active)]
+            if not heap.complete:
+                break
+            data = heap.buffer.view(self.dtype).astype(self.out_dtype)
+            data.flags.writeable = False  # shared by all sinks
+            spectrum = Spectrum(heap.heap_cnt, data, time.time(), self.board,
+                                ticks=heap.timestamp)
+            self._retire(heap, published=True)
+            self.heaps += 1
+            self.publish(spectrum)
+
+    def process_batch(self, n):
+        """Copy the payloads of ``n`` received packets into their heaps."""
+        if not n:
+            return
+        valid, start, values = parse_packets(
+            self._packets, self._lengths[:n],
+            (HEAP_CNT, HEAP_SIZE, HEAP_OFFSET, PAYLOAD_LEN, TIMESTAMP))
+        valid &= values[HEAP_SIZE] == self.heap_bytes
+        valid &= values[HEAP_OFFSET] + values[PAYLOAD_LEN] <= self.heap_bytes
+        self.invalid += int(n - valid.sum())
+        heap_cnts = values[HEAP_CNT]
+        offsets = values[HEAP_OFFSET]
+        lengths = values[PAYLOAD_LEN]
+        timestamps = values[TIMESTAMP]
+        for i in np.flatnonzero(valid):
+            heap = self._slot(int(heap_cnts[i]))
+            if heap is None:
+                continue
+            offset, length, first = int(offsets[i]), int(lengths[i]), int(start[i])
+            if offset in heap.offsets:
+                self.duplicates += 1
+                continue
+            heap.offsets.add(offset)
+            heap.buffer[offset:offset + length] = self._packets[i, first:first + length]
+            heap.received += length
+            heap.timestamp = int(timestamps[i])
+            if heap.received >= self.heap_bytes:
+                heap.complete = True
+                self._release()
+
+    def poll_once(self, timeout=None):
+        """Receive and assemble one batch; returns packets received."""
+        n = self.receive_batch(timeout)
+        self.process_batch(n)
+        return n
+
+    def run(self):
+        """Receive until stop() is called."""
+        while not self._halt.is_set():
+            try:
+                self.poll_once(self.poll_interval)
+            except Exception:
+                logger.exception('board %r: SPEAD receive failed', self.board)
+
+    def stop(self, timeout=5.0):
+        Publisher.stop(self, timeout)
+        self.kernel_drops = kernel_drops(self.port)
+        self.sock.close()
+
+    def stats(self):
+        """Packet, heap and loss counters, and the per-sink counters."""
+        return {
+            'packets': self.packets,
+            'batches': self.batches,
+            'heaps': self.heaps,
+            'incomplete': self.incomplete,
+            'lost': self.lost,
+            'late': self.late,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'truncated': self.truncated,
+            'kernel_drops': (self.kernel_drops if self._halt.is_set()
+                             else kernel_drops(self.port)),
+            'rcvbuf': self.rcvbuf,
+            'sinks': self.sink_stats(),
+        }
+
+
+class SpeadSender(object):
+    """Send spectra as SPEAD heaps, for testing the receiver without a board."""
+
+    def __init__(self, host='127.0.0.1', port=7148, payload_bytes=8192,
+                 drop=0.0, seed=None):
+        """
+        :param host, port: destination of the stream
+        :param payload_bytes: spectrum bytes per packet
+        :param drop: fraction of packets silently not sent, to exercise
+            the loss counters of the receiver
+        """
+        self.address = (host, port)
+        self.payload_bytes = payload_bytes
+        self.drop = drop
+        self._random = np.random.RandomState(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent = 0
+        self.dropped = 0
+
+    def packets(self, heap_cnt, data, timestamp=0):
+        """The datagrams of one heap."""
+        payload = np.ascontiguousarray(data).tobytes()
+        heap_size = len(payload)
+        header = np.array([SPEAD_MAGIC << 32 | 6], dtype='>u8')
+        pointers = np.array([item_pointer(HEAP_CNT, heap_cnt),
+                             item_pointer(HEAP_SIZE, heap_size),
+                             item_pointer(HEAP_OFFSET, 0),
+                             item_pointer(PAYLOAD_LEN, 0),
+                             item_pointer(TIMESTAMP, timestamp),
+                             item_pointer(SPECTRUM, 0, immediate=False)],
+                            dtype='>u8')
+        for offset in range(0, heap_size, self.payload_bytes):
+            chunk = payload[offset:offset + self.payload_bytes]
+            pointers[2] = item_pointer(HEAP_OFFSET, offset)
+            pointers[3] = item_pointer(PAYLOAD_LEN, len(chunk))
+            yield header.tobytes() + pointers.tobytes() + chunk
+
+    def send_heap(self, heap_cnt, data, timestamp=0):
+        """Send one spectrum as a heap."""
+        for packet in self.packets(heap_cnt, data, timestamp):
+            if self.drop and self._random.random_sample() < self.drop:
+                self.dropped += 1
+                continue
+            self.sock.sendto(packet, self.address)
+            self.sent += 1
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    from optparse import OptionParser
+
+    p = OptionParser()
+    p.set_usage('python -m bingo_backend.spead [options]')
+    p.set_description(__doc__)
+    p.add_option('-n', '--nchan', dest='nchan', type='int', default=32768,
+                 help='Channels per spectrum. Default 32768.')
+    p.add_option('-c', '--count', dest='count', type='int', default=100,
+                 help='Heaps to send. Default 100.')
+    p.add_option('-p', '--port', dest='port', type='int', default=0,
+                 help='UDP port. Default: any free port.')
+    p.add_option('-d', '--drop', dest='drop', type='float', default=0.0,
+                 help='Fraction of packets to drop at the sender. Default 0.')
+    p.add_option('-r', '--rate', dest='rate', type='float', default=0.0,
+                 help='Heaps per second, 0 for as fast as possible.')
+    opts, args = p.parse_args()
+
+    receiver = SpeadReceiver(opts.port, opts.nchan, bind='127.0.0.1')
+    sender = SpeadSender('127.0.0.1', receiver.port, drop=opts.drop, seed=0)
+    receiver.start()
+    data = np.arange(opts.nchan, dtype='>u4')
+    start = time.time()
+    for heap_cnt in range(opts.count):
+        sender.send_heap(heap_cnt, data, timestamp=heap_cnt * 1000)
+        if opts.rate:
+            time.sleep(max(0.0, start + (heap_cnt + 1) / opts.rate - time.time()))
+    elapsed = time.time() - start
+    time.sleep(0.5)
+    receiver.stop()
+    sender.close()
+
+    print('sent %i heaps (%i packets, %i dropped) in %.3f s, %.1f MB/s'
+          % (opts.count, sender.sent, sender.dropped, elapsed,
+             opts.count * receiver.heap_bytes / elapsed / 1e6))
+    for key, value in sorted(receiver.stats().items()):
+        print('%-12s %s' % (key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+Hardware timestamps of the spectra, from the PPS-synchronised counters.
+
+A Spectrum's ``timestamp`` is normally the host time at which it was
+read, which carries the network latency, the polling jitter and the host
+clock's own error.  Once the boards are synchronised to PPS
+(bingo_backend.pps), the accumulators restart on the PPS edge that starts
+second ``epoch`` (with a software PPS, when the trigger write reaches the
+board; Timestamper.from_sync() takes the epoch from the measured trigger
+times).  From then on, dump ``acc_cnt`` completes after exactly
+``acc_cnt * acc_len * nchan`` samples of the FFT clock:
+
+    ticks    = (acc_cnt - acc_cnt0) * acc_len * nchan
+    end time = epoch + ticks / sample_rate - latency
+
+Timestamper computes this as a stage on every spectrum.  It sets
+``ticks``, replaces ``timestamp`` with the end of the accumulation
+derived above, and sets ``time_error`` to the estimated uncertainty: the
+PPS error at the epoch plus the sample clock's frequency tolerance
+(``clock_ppm``) times the time elapsed since.  The host clock is not
+involved.  times() does the same for whole arrays of acc_cnt (archive
+index blocks, for instance) in a few vectorised operations, and unwraps
+the 32-bit counter.
+
+The accumulators must not be restarted after the sync (cnt_rst, acc_len
+writes, ADC sync), or the epoch no longer holds: synchronise to PPS
+last.  DriftMonitor compares each hardware timestamp with the host (NTP)
+time the spectrum was read at.  The offset should be a small, steady read
+latency; a jump means the counters were restarted, and a slope means the
+sample clock runs off its nominal rate.  instrument() publishes both to
+bingo_backend.metrics.
+"""
+
+from __future__ import division, print_function
+
+import logging
+
+import numpy as np
+
+from .scheduler import dump_period
+
+logger = logging.getLogger(__name__)
+
+WRAP = 1 << 32          # acc_cnt is a 32-bit register
+PPS_ERROR = 1e-7        # seconds, a GPS-disciplined PPS
+NTP_ERROR = 1e-3        # seconds, a host on a LAN NTP server
+
+
+class DriftMonitor(object):
+    """Track the host clock against the hardware timestamps."""
+
+    def __init__(self, window=256, tolerance=0.05, min_span=60.0):
+        """
+        :param window: observations kept for the offset and drift estimates
+        :param tolerance: seconds of offset beyond which a warning is logged
+        :param min_span: seconds the window must cover before a drift is
+            estimated; over shorter spans the read jitter dominates
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.min_span = min_span
+        self._hw = np.zeros(window)
+        self._offset = np.zeros(window)
+        self.observations = 0
+        self.excursions = 0         # observations beyond tolerance
+        self.last_offset = None
+        self._warned = False
+
+    def observe(self, hardware_time, host_time):
+        """Record one spectrum: host time it was read at minus its hardware
+        timestamp (the read latency, if both clocks are right)."""
+        offset = host_time - hardware_time
+        slot = self.observations % self.window
+        self._hw[slot] = hardware_time
+        self._offset[slot] = offset
+        self.observations += 1
+        self.last_offset = offset
+        if abs(offset) > self.tolerance:
+            self.excursions += 1
+            if not self._warned:
+                logger.warning('host time is %.3f s off the hardware timestamps; '
+                               'were the counters restarted after the PPS sync?', offset)
+                self._warned = True
+        elif self._warned:
+            logger.info('host time back within %.3f s of the hardware timestamps',
+                        self.tolerance)
+            self._warned = False
+
+    def stats(self):
+        """Offset (minimum over the window, the read latency when the
+        clocks agree), its spread, and the drift in ppm of hardware time
+        (None until the window spans ``min_span``)."""
+        n = min(self.observations, self.window)
+        if not n:
+            return {'observations': 0, 'excursions': 0}
+        hw = self._hw[:n]
+        offset = self._offset[:n]
+        drift = None
+        if n > 2 and hw.max() - hw.min() >= self.min_span:
+            drift = float(1e6 * np.polyfit(hw - hw.min(), offset, 1)[0])
+        return {
+            'observations': self.observations,
+            'excursions': self.excursions,
+            'offset': float(offset.min()),
+            'offset_spread': float(offset.max() - offset.min()),
+            'last_offset': self.last_offset,
+            'drift_ppm': drift,
+        }
+
+
+class Timestamper(object):
+    """Stage tagging spectra with hardware time from the PPS epoch."""
+
+    def __init__(self, epoch, acc_len, nchan, sample_rate, acc_cnt0=0,
+                 latency=0.0, epoch_error=PPS_ERROR, clock_ppm=1.0,
+                 monitor=True):
+        """
+        :param epoch: UTC time of the PPS edge the accumulators restarted
+            on (SyncResult.epoch, see from_sync())
+        :param acc_len, nchan, sample_rate: dump period parameters, as for
+            bingo_backend.scheduler.dump_period
+        :param acc_cnt0: acc_cnt at the epoch
+        :param latency: seconds from the end of an accumulation to acc_cnt
+            counting it, subtracted out (firmware pipeline)
+        :param epoch_error: uncertainty of the epoch in seconds
+        :param clock_ppm: frequency tolerance of the sample clock
+        :param monitor: DriftMonitor to feed, True for a new one, False
+            for none
+        """
+        self.epoch = epoch
+        self.acc_len = acc_len
+        self.nchan = nchan
+        self.sample_rate = sample_rate
+        self.acc_cnt0 = acc_cnt0
+        self.latency = latency
+        self.epoch_error = epoch_error
+        self.clock_ppm = clock_ppm
+        self.period = dump_period(acc_len, nchan, sample_rate)
+        self.ticks_per_dump = int(acc_len) * int(nchan)
+        if monitor is True:
+            monitor = DriftMonitor()
+        self.monitor = monitor or None
+        self._last = None       # last unwrapped acc_cnt
+        self.spectra = 0
+
+    @classmethod
+    def from_sync(cls, result, acc_len, nchan, sample_rate, software=False, **kwargs):
+        """Timestamper for the epoch of a bingo_backend.pps.SyncResult.
+
+        A software PPS restarts the accumulators when the trigger write
+        reaches each board, somewhere in ``arm_window`` after the epoch's
+        second rather than on it: the epoch is taken at the middle of the
+        window, and is only as good as the host clock and half the window.
+        """
+        epoch = result.epoch
+        if software:
+            first, last = result.arm_window
+            epoch += (first + last) / 2
+            kwargs.setdefault('epoch_error', NTP_ERROR + (last - first) / 2)
+        return cls(epoch, acc_len, nchan, sample_rate, **kwargs)
+
+    def unwrap(self, acc_cnt):
+        """acc_cnt counted past its 32-bit wraps, from ``acc_cnt0``.  Arrays
+        must be in time order and shorter than one wrap."""
+        acc_cnt = np.asarray(acc_cnt, dtype=np.int64) - self.acc_cnt0
+        if acc_cnt.ndim:
+            wraps = np.concatenate(([0], np.cumsum(np.diff(acc_cnt) < -(WRAP // 2))))
+            return acc_cnt + WRAP * wraps
+        return acc_cnt
+
+    def ticks(self, acc_cnt):
+        """FFT clock samples from the epoch to the end of dump ``acc_cnt``."""
+        return self.unwrap(acc_cnt) * self.ticks_per_dump
+
+    def times(self, acc_cnt):
+        """End of the accumulation of each dump (UTC) and its error, for a
+        scalar or an array of acc_cnt."""
+        elapsed = self.unwrap(acc_cnt) * self.period - self.latency
+        return (self.epoch + elapsed,
+                self.epoch_error + 1e-6 * self.clock_ppm * np.abs(elapsed))
+
+    def __call__(self, spectrum):
+        if spectrum.acc_cnt is None:
+            return
+        n = spectrum.acc_cnt - self.acc_cnt0
+        if self._last is not None:
+            # keep counting across 32-bit wraps of acc_cnt
+            n += WRAP * ((self._last - n + WRAP // 2) // WRAP)
+        self._last = n
+        elapsed = n * self.period - self.latency
+        host_time = spectrum.timestamp
+        spectrum.ticks = n * self.ticks_per_dump
+        spectrum.timestamp = self.epoch + elapsed
+        spectrum.time_error = self.epoch_error + 1e-6 * self.clock_ppm * abs(elapsed)
+        if self.monitor is not None and host_time is not None:
+            self.monitor.observe(spectrum.timestamp, host_time)
+        self.spectra += 1
+
+    def stats(self):
+        """Epoch, dump period and the drift monitor's estimates."""
+        stats = {'epoch': self.epoch, 'period': self.period, 'spectra': self.spectra,
+                 'epoch_error': self.epoch_error}
+        if self.monitor is not None:
+            stats['drift'] = self.monitor.stats()
+        return stats
+
+    def instrument(self, metrics):
+        """Publish the clock offset, drift and timestamp error to a
+        bingo_backend.metrics.Metrics registry."""
+        metrics.add_collector(self._collect)
+
+    def _collect(self):
+        samples = [('timestamp_epoch_seconds', 'gauge',
+                    'PPS epoch of the hardware timestamps.', None, self.epoch)]
+        if self._last is not None:
+            elapsed = self._last * self.period
+            samples.append(('timestamp_error_seconds', 'gauge',
+                            'Estimated error of the latest hardware timestamp.', None,
+                            self.epoch_error + 1e-6 * self.clock_ppm * elapsed))
+        if self.monitor is not None and self.monitor.observations:
+            drift = self.monitor.stats()
+            samples += [
+                ('clock_offset_seconds', 'gauge',
+                 'Host read time minus hardware timestamp, minimum over the window.',
+                 None, drift['offset']),
+                ('clock_excursions_total', 'counter',
+                 'Spectra whose host time was off the hardware timestamp beyond tolerance.',
+                 None, drift['excursions']),
+            ]
+            if drift['drift_ppm'] is not None:
+                samples.append(('clock_drift_ppm', 'gauge',
+                                'Drift of the host time against the hardware timestamps.',
+                                None, drift['drift_ppm']))
+        return samples
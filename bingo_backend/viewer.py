@@ -0,0 +1,170 @@
+"""
+Live spectrum plot that redraws only the spectrum lines.
+
+The scripts used to clear the figure and rebuild the axes, grid, labels
+and frequency axis on every tick, so the redraw, not the data, set the
+frame rate.  LiveSpectrumViewer builds the figure once.  Each frame it
+restores the cached background (axes, grid, labels), updates the line
+data and blits the axes, so a frame costs a few draw calls whatever the
+size of the rest of the figure.  The y limits are only changed, with a
+full redraw, when the data leaves them or shrinks well inside them.
+
+A 32k-point spectrum is far wider than the screen, so it is reduced to
+the minimum and maximum of each pixel column first (MinMaxDecimator) and
+drawn as an envelope; a single-channel RFI spike still shows at full
+height, which plain subsampling would lose.
+
+The frame timer runs every ``DEFAULT_INTERVAL`` ms, 25 frames/s, above
+the 20 frames/s target at 32k channels; benchmarks/bench_viewer.py
+measures the redraw rate against that target.
+"""
+
+from __future__ import division, print_function
+
+import time
+
+import numpy as np
+
+TARGET_FPS = 20                 # live view at 32k channels
+DEFAULT_INTERVAL = 40           # ms between frames, 25 frames/s
+
+
+class MinMaxDecimator(object):
+    """Reduce spectra to min/max envelopes of a fixed number of buckets."""
+
+    def __init__(self, x, nbuckets):
+        """
+        :param x: x coordinate of every channel
+        :param nbuckets: number of buckets, about one per screen pixel
+        """
+        n = len(x)
+        self.nbuckets = nbuckets = min(nbuckets, n // 2)
+        self._starts = np.linspace(0, n, nbuckets + 1).astype(np.intp)[:-1]
+        ends = np.append(self._starts[1:], n) - 1
+        # envelope point pairs: (bucket start, min), (bucket end, max)
+        self.x = np.empty(2 * nbuckets)
+        self.x[0::2] = x[self._starts]
+        self.x[1::2] = x[ends]
+
+    def __call__(self, y, out=None):
+        """Envelope of ``y`` (..., nchan) as (..., 2 * nbuckets)."""
+        if out is None:
+            out = np.empty(y.shape[:-1] + (2 * self.nbuckets,))
+        out[..., 0::2] = np.minimum.reduceat(y, self._starts, axis=-1)
+        out[..., 1::2] = np.maximum.reduceat(y, self._starts, axis=-1)
+        return out
+
+
+class LiveSpectrumViewer(object):
+    """Blitting matplotlib view of the newest spectrum."""
+
+    def __init__(self, source, freqs, title='Integration number %i.',
+                 xlabel='Freq (MHz)', ylabel=None, interval=DEFAULT_INTERVAL,
+                 nbuckets=None, fig=None, style=None):
+        """
+        :param source: callable returning ``(acc_n, spectra)`` of the newest
+            accumulation, spectra as (nchan,) or (boards x nchan), or None
+            when there is nothing new to show
+        :param freqs: x coordinate of every channel, e.g. from
+            bingo_backend.channels.frequency_axis
+        :param title: format for the accumulation number shown in the plot
+        :param interval: milliseconds between frames
+        :param nbuckets: envelope buckets; by default the figure width in
+            pixels
+        :param fig: figure to draw in, by default a new one
+        :param style: matplotlib format string of the lines
+        """
+        import matplotlib.pyplot as plt
+
+        self.source = source
+        self.freqs = np.asarray(freqs)
+        self.title = title
+        self.interval = interval
+        self.style = style
+        self.fig = fig if fig is not None else plt.figure()
+        self.canvas = self.fig.canvas
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.ax.set_xlim(self.freqs.min(), self.freqs.max())
+        self.ax.set_xlabel(xlabel)
+        if ylabel:
+            self.ax.set_ylabel(ylabel)
+        self.ax.grid()
+        self.label = self.ax.text(0.01, 0.97, '', transform=self.ax.transAxes,
+                                  va='top', animated=True)
+        if nbuckets is None:
+            nbuckets = int(self.fig.get_figwidth() * self.fig.dpi)
+        self.decimate = MinMaxDecimator(self.freqs, nbuckets)
+        self.lines = []
+        self._background = None
+        self._envelope = None
+        self._timer = None
+        self.frames = 0
+        self.frame_time = 0.0
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        """Cache the static background after every full redraw."""
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for line in self.lines:
+            self.ax.draw_artist(line)
+        self.ax.draw_artist(self.label)
+
+    def _make_lines(self, nlines):
+        args = (self.style,) if self.style else ()
+        for _ in range(nlines):
+            line, = self.ax.plot(self.decimate.x, np.zeros(len(self.decimate.x)),
+                                 *args, animated=True)
+            self.lines.append(line)
+
+    def _rescale(self, lo, hi):
+        """Move the y limits if the data left them or shrank well inside."""
+        bottom, top = self.ax.get_ylim()
+        span = top - bottom
+        if lo >= bottom and hi <= top and (hi - lo) > 0.25 * span:
+            return False
+        margin = 0.05 * (hi - lo) or 1.0
+        self.ax.set_ylim(lo - margin, hi + margin)
+        return True
+
+    def update(self):
+        """Draw the newest spectrum, if there is a new one."""
+        data = self.source()
+        if data is None:
+            return False
+        start = time.time()
+        acc_n, spectra = data
+        spectra = np.atleast_2d(spectra)
+        if not self.lines:
+            self._make_lines(len(spectra))
+        self._envelope = self.decimate(spectra, self._envelope)
+        for line, y in zip(self.lines, self._envelope):
+            line.set_ydata(y)
+        self.label.set_text(self.title % acc_n if acc_n is not None else '')
+        if self._rescale(self._envelope.min(), self._envelope.max()) or \
+                self._background is None:
+            self.canvas.draw()              # redraws the background too
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_animated()
+            self.canvas.blit(self.ax.bbox)
+        self.canvas.flush_events()
+        self.frames += 1
+        self.frame_time += time.time() - start
+        return True
+
+    def start(self):
+        """Redraw every ``interval`` ms from the GUI event loop."""
+        self._timer = self.canvas.new_timer(interval=self.interval)
+        self._timer.add_callback(self.update)
+        self._timer.start()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+
+    def fps(self):
+        """Frames per second the redraw alone could sustain."""
+        return self.frames / self.frame_time if self.frame_time else 0.0
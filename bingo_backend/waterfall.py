@@ -0,0 +1,262 @@
+"""
+Multi-resolution waterfall built incrementally from the spectrum stream.
+
+A day of 32k-channel, 1 s spectra is 11 GB; plotting it, or any zoom of
+it, from the raw archive means reading all of it.  WaterfallPyramid keeps
+the same data at a ladder of resolutions instead: level k pools 2**k
+spectra in time and 2**k channels in frequency, both as a mean and as a
+max (so narrow-band RFI stays visible in the coarse levels).  A plot then
+reads the finest level that still fits its pixel budget, which is a few
+hundred kB however long the time range is.
+
+Each level and statistic is a bingo_backend.archive.SpectrumArchive in the
+pyramid directory (``L03_mean.*``, ``L03_max.*``, ...), so it is appended
+to as data arrives, can be read while acquisition is running, and is
+sliced without copying.  The index timestamp of a row is that of the first
+spectrum pooled into it.  Rows are built in memory from the two rows
+below them, so every spectrum is touched once per level and the raw data
+is never re-read.
+
+Build it live with WaterfallSink, or offline from an archive with
+WaterfallPyramid.extend().  Like the archives, an existing pyramid is
+never truncated: WaterfallSink resumes it when the level layout and metadata match
+and refuses to start otherwise.
+"""
+
+from __future__ import division, print_function
+
+import json
+import os
+
+import numpy as np
+
+from .archive import SpectrumArchive, check_meta
+from .sinks import Sink
+
+STATS = ('mean', 'max')
+
+
+class _Pending(object):
+    """A row of one level waiting for its second half."""
+
+    __slots__ = ('mean', 'max', 'count', 'acc_cnt', 'timestamp')
+
+    def __init__(self):
+        self.count = 0
+
+
+def _pool_channels(row, op):
+    return op(row.reshape(-1, 2), axis=1)
+
+
+class WaterfallPyramid(object):
+    """Time x frequency pyramid of mean- and max-pooled spectra on disk."""
+
+    def __init__(self, directory, mode='r'):
+        """Open an existing pyramid; use WaterfallPyramid.create() for new ones.
+
+        :param directory: pyramid directory
+        :param mode: 'r' to read, 'r+' to append
+        """
+        self.directory = directory
+        self.mode = mode
+        with open(os.path.join(directory, 'pyramid.json')) as f:
+            self.meta = json.load(f)
+        self.nchan = int(self.meta['nchan'])
+        self.levels = int(self.meta['levels'])
+        self.min_level = int(self.meta['min_level'])
+        self.archives = {}
+        for level in range(self.min_level, self.levels):
+            for stat in STATS:
+                self.archives[level, stat] = SpectrumArchive(self._base(level, stat), mode)
+        self._pending = [_Pending() for _ in range(self.levels)]
+
+    def _base(self, level, stat):
+        return os.path.join(self.directory, 'L%02i_%s' % (level, stat))
+
+    @classmethod
+    def create(cls, directory, nchan, levels=11, min_level=1, capacity=4096,
+               meta=None):
+        """Create a pyramid and open it for appending.
+
+        :param nchan: channels per input spectrum, a multiple of
+            2**(levels - 1)
+        :param levels: number of levels; level k pools 2**k spectra and
+            2**k channels
+        :param min_level: first level written to disk; the default skips
+            level 0, which is the raw data already kept by the archive
+        :param capacity: rows pre-allocated at a time at level 0, halved
+            at every level above
+        :param meta: extra JSON-serialisable metadata
+        :raises OSError: if the directory already holds a pyramid (see
+            resume())
+        """
+        if nchan % 2 ** (levels - 1):
+            raise ValueError('nchan=%i cannot be halved %i times' % (nchan, levels - 1))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        info = dict(meta or {})
+        info.update(nchan=int(nchan), levels=int(levels), min_level=int(min_level))
+        fd = os.open(os.path.join(directory, 'pyramid.json'),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        for level in range(min_level, levels):
+            for stat in STATS:
+                SpectrumArchive.create(os.path.join(directory, 'L%02i_%s' % (level, stat)),
+                                       nchan >> level, 'float32',
+                                       max(64, capacity >> level)).close()
+        return cls(directory, mode='r+')
+
+    @classmethod
+    def resume(cls, directory, nchan, levels=11, min_level=1, meta=None):
+        """Reopen an existing pyramid to append after its stored rows.
+        Pooling restarts from the next spectrum: rows that were waiting
+        for their second half when it was closed are not completed.
+
+        :param meta: metadata the caller would create the pyramid with;
+            every key must match the stored value
+        :raises ValueError: if the pyramid has a different layout or
+            metadata
+        """
+        pyramid = cls(directory, mode='r+')
+        try:
+            check_meta(directory, pyramid.meta, meta)
+        except ValueError:
+            pyramid.close()
+            raise
+        if (pyramid.nchan, pyramid.levels, pyramid.min_level) != (nchan, levels, min_level):
+            pyramid.close()
+            raise ValueError('%s holds %i channels in levels %i-%i, not %i in %i-%i'
+                             % (directory, pyramid.nchan, pyramid.min_level,
+                                pyramid.levels - 1, nchan, min_level, levels - 1))
+        return pyramid
+
+    @staticmethod
+    def exists(directory):
+        """Whether a pyramid was created in ``directory``."""
+        return os.path.exists(os.path.join(directory, 'pyramid.json'))
+
+    # -- writing -------------------------------------------------------
+
+    def append(self, data, acc_cnt=0, timestamp=0.0):
+        """Add one spectrum; completes at most one row per level."""
+        mean = np.asarray(data, dtype=np.float32)
+        peak = mean
+        for level in range(self.levels):
+            if level:
+                pending = self._pending[level]
+                if pending.count == 0:
+                    pending.mean = mean.copy()
+                    pending.max = peak.copy()
+                    pending.acc_cnt = acc_cnt
+                    pending.timestamp = timestamp
+                    pending.count = 1
+                    return
+                # second half: pool in time, then in channels
+                pending.count = 0
+                mean = _pool_channels(pending.mean + mean, np.sum) / 4
+                peak = _pool_channels(np.maximum(pending.max, peak), np.max)
+                acc_cnt, timestamp = pending.acc_cnt, pending.timestamp
+            if level >= self.min_level:
+                self.archives[level, 'mean'].append(mean, acc_cnt, timestamp)
+                self.archives[level, 'max'].append(peak, acc_cnt, timestamp)
+
+    def extend(self, archive, start=None, stop=None, board=None, chunk=256):
+        """Add the spectra of a SpectrumArchive between two UTC times.
+
+        :param board: only rows of this board, for multi-board archives
+        """
+        index, spectra = archive.select(start, stop)
+        for first in range(0, len(index), chunk):
+            rows = index[first:first + chunk]
+            block = np.asarray(spectra[first:first + chunk])
+            for record, row in zip(rows, block):
+                if board is None or record['board'] == board:
+                    self.append(row, record['acc_cnt'], record['timestamp'])
+
+    def flush(self):
+        for archive in self.archives.values():
+            archive.flush()
+
+    def close(self):
+        """Close every level; rows still waiting for their second half
+        are not written."""
+        for archive in self.archives.values():
+            archive.close()
+
+    # -- reading -------------------------------------------------------
+
+    def refresh(self):
+        """Pick up rows appended by a writer since the pyramid was opened."""
+        for archive in self.archives.values():
+            archive.refresh()
+
+    def level_for(self, start=None, stop=None, channels=None, max_rows=1024,
+                  max_chans=2048):
+        """Finest stored level whose rows and channels in a range fit
+        ``max_rows`` x ``max_chans``."""
+        lo, hi = channels or (0, self.nchan)
+        for level in range(self.min_level, self.levels):
+            rows = self.archives[level, 'mean'].time_range(start, stop)
+            if (rows.stop - rows.start <= max_rows and
+                    (hi - lo) >> level <= max_chans):
+                return level
+        return self.levels - 1
+
+    def view(self, start=None, stop=None, channels=None, stat='mean',
+             max_rows=1024, max_chans=2048, level=None):
+        """Read a time and channel range at the finest level that fits.
+
+        :param start, stop: unix times bounding the rows, None for open
+        :param channels: ``(first, last)`` input channel range, None for all
+        :param stat: 'mean' or 'max'
+        :param max_rows, max_chans: pixel budget of the plot
+        :param level: force a level instead of choosing one
+        :return: ``(level, timestamps, channel_edges, data)``; row i of the
+            zero-copy ``data`` starts at ``timestamps[i]`` and column j
+            covers input channels ``channel_edges[j]`` to
+            ``channel_edges[j + 1]``
+        """
+        if level is None:
+            level = self.level_for(start, stop, channels, max_rows, max_chans)
+        lo, hi = channels or (0, self.nchan)
+        first, last = lo >> level, -(-hi >> level)
+        index, data = self.archives[level, stat].select(start, stop, slice(first, last))
+        edges = np.arange(first, last + 1) << level
+        return level, index['timestamp'], edges, data
+
+
+class WaterfallSink(Sink):
+    """Feed every published spectrum into a WaterfallPyramid, continuing
+    an existing one."""
+
+    def __init__(self, directory, nchan, board=0, **kwargs):
+        """
+        :param board: row of multi-board spectra to use
+        :param kwargs: passed to WaterfallPyramid.create()
+        """
+        self.directory = directory
+        self.nchan = nchan
+        self.board = board
+        self.kwargs = kwargs
+        self.pyramid = None
+
+    def open(self):
+        if WaterfallPyramid.exists(self.directory):
+            layout = dict((key, self.kwargs[key]) for key in ('levels', 'min_level', 'meta')
+                          if key in self.kwargs)
+            self.pyramid = WaterfallPyramid.resume(self.directory, self.nchan, **layout)
+        else:
+            self.pyramid = WaterfallPyramid.create(self.directory, self.nchan,
+                                                   **self.kwargs)
+
+    def write(self, spectrum):
+        data = spectrum.data
+        if data.ndim == 2:
+            data = data[self.board]
+        self.pyramid.append(data, spectrum.acc_cnt or 0, spectrum.timestamp)
+
+    def close(self):
+        if self.pyramid is not None:
+            self.pyramid.close()
@@ -47,86 +47,110 @@
 
 #--------------------------------------------------------------------------------------
 
-import casperfpga
-from casperfpga import skarab_definitions as sd
 import sys
 import os.path
+import tempfile
 from os import path
 
 import time,numpy,struct,logging,pylab,matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from bingo_backend.bringup import bring_up, report, fpg_fingerprint, ProgramState
+from bingo_backend.devices import FpgCache
+from bingo_backend.parallel import raise_failures
+from bingo_backend.readout import SpectrumReader
+from bingo_backend.multiboard import MultiBoardReader
+from bingo_backend.registers import accumulation_plan, apply_plan
+from bingo_backend.pps import sync_pps
+from bingo_backend.timing import Timestamper
+from bingo_backend.acquisition import Acquisition
+from bingo_backend.metrics import MetricsServer
+from bingo_backend.archive import ArchiveSink
+from bingo_backend.rfi import RfiFlagger
+from bingo_backend.integrate import IntegrationSink, dumps_for
+from bingo_backend.fits import FitsSink
+from bingo_backend.scheduler import DumpScheduler, dump_period
+from bingo_backend.sinks import LatestSink, PeakSink
+from bingo_backend.shmring import RingSink
+from bingo_backend.waterfall import WaterfallSink
+from bingo_backend.channels import ChannelMap
+from bingo_backend.viewer import LiveSpectrumViewer
+from bingo_backend.simulator import SimulatedSkarab, skarab_definitions
+
 actual_channels_ddc_centre_freq = 0.0
 
 def get_data():
-        #get the data...    
-	acc_n=skarabs[0].read_uint('acc_cnt')#acc_n = fpga.read_uint('acc_cnt')
-	#a_1=struct.unpack('>32768L',skarabs[0].read('mem1',32768*4,0))
-	a_1=struct.unpack('>32768L',skarabs[0].read('mem_left_0_0',32768*4,0))
-	#a_2=struct.unpack('>16384Q',skarabs[0].read('mem2',16384*8,0))
-	
-        #b_1=struct.unpack('>1024h',skarabs[0].read('mem3',256*8,0))
-        #for i in range(256):
-        #    print 'Index ',i,' x00=',hex(b_1[4*i]),',',hex(b_1[4*i+1]) 
-        #    print 'Index ',i,' x00=',hex(b_1[4*i+2]),",",hex(b_1[4*i+3])
-
-	interleave_a=[]
-
-	for i in range(32768):
-		interleave_a.append(a_1[i])
-		#interleave_a.append(a_2[i])
-
-	return acc_n, numpy.array(interleave_a,dtype=numpy.float) 
-        
-def plot_spectrum():
-        freq_range_mhz_lo = -0.5*93.75 +actual_channels_ddc_centre_freq/1.0e6
-        freq_range_mhz_hi =  0.5*93.75 +actual_channels_ddc_centre_freq/1.0e6
-        matplotlib.pyplot.clf()
-	acc_n, interleave_a = get_data()
-	interleave_a = interleave_a[::-1]
-	interleave_a = np.fft.fftshift(interleave_a)
-	peak = np.amax(interleave_a)
-        indx = np.argmax(interleave_a)
-        print indx, peak
-	#interleave_a = 10*numpy.log10(interleave_a)
-	#print(np.linspace(-32768./2,32768./2-1,32768).shape,interleave_a.shape)
-	matplotlib.pylab.plot(
-                np.linspace(-32768./2,32768./2-1,32768)
-                    *(-93.75/32768.)+actual_channels_ddc_centre_freq/1.0e6,
-                interleave_a,
-                'b'
-        )
-	matplotlib.pylab.title('Integration number %i.'%acc_n)
-	#matplotlib.pylab.ylabel('Power (dB)')
-	matplotlib.pylab.grid()
-	matplotlib.pylab.xlabel('Freq (MHz)')
-	matplotlib.pylab.xlim(freq_range_mhz_lo, freq_range_mhz_hi)
-        #matplotlib.pylab.ylim(0, 1e10)
-	fig.canvas.draw()
-	fig.canvas.manager.window.after(100, plot_spectrum)
-
-        
+        #get the newest spectrum published by the acquisition thread,
+        #or None if it has been drawn already
+	spectrum = latest.get()
+	if spectrum is None or spectrum is drawn[0]:
+		return None
+	drawn[0] = spectrum
+	# one row per board, reordered ([::-1], fftshift) in a single gather
+	# into a buffer reused from dump to dump
+	if shown[0] is None or shown[0].shape != spectrum.data.shape:
+		shown[0] = np.empty_like(spectrum.data)
+	return spectrum.acc_cnt, channel_map.reorder(spectrum.data, out=shown[0])
+
+drawn = [None]
+shown = [None]
 
 #START OF MAIN:
 if __name__ == '__main__':
         
         from optparse import OptionParser
         p = OptionParser()
-        p.set_usage('spectrometer.py <SKARAB_HOSTNAME_or_IP> [options]')
+        p.set_usage('spectrometer.py <SKARAB_HOSTNAME_or_IP> [<SKARAB_HOSTNAME_or_IP> ...] [options]')
         p.set_description(__doc__)
         p.add_option('-l', '--acc_len', dest='acc_len', type='int',default=5722,
         help='Set the number of vectors to accumulate between dumps. default is 2*(2^28)/4096, or just under 2 seconds.')
         p.add_option('-b', '--fpg', dest='fpgfile',type='str', default='',
         help='Specify the fpg file to load')
+        p.add_option('-u', '--upload_file', dest='upload_file', type='choice', default='auto',
+        choices=['y', 'n', 'auto'],
+        help='Program the fpg file: y (always), n (never) or auto (only boards not already running it) [default auto]')
+        p.add_option('-a', '--archive', dest='archive', type='str', default='',
+        help='Append every spectrum to the memory-mapped archive <ARCHIVE>.spec/.idx/.json')
+        p.add_option('-I', '--integrate', dest='integrate', type='str', default='',
+        help='Comma-separated software integration times in seconds, e.g. 10,60; each is archived to <ARCHIVE>_<T>s instead of archiving every dump')
+        p.add_option('-F', '--fits', dest='fits', type='str', default='',
+        help='Write spectra to hourly FITS files <FITS>_<UTC start>.fits')
+        p.add_option('-W', '--waterfall', dest='waterfall', type='str', default='',
+        help='Build a multi-resolution waterfall of the first board in directory <WATERFALL>')
+        p.add_option('-R', '--ring', dest='ring', type='str', default='',
+        help='Publish spectra to the shared-memory ring <RING> for other processes')
+        p.add_option('-r', '--rfi', dest='rfi', type='choice', default='',
+        choices=['', 'sk', 'mad'],
+        help='Flag RFI in every spectrum with spectral kurtosis (sk) or MAD clipping (mad); the masks are kept with the archive')
+        p.add_option('-P', '--pps', dest='pps', type='choice', default='',
+        choices=['', 'hw', 'sw'],
+        help='Synchronise the boards to the hardware (hw) or software (sw) PPS after configuring them and timestamp every spectrum from the PPS epoch instead of the host clock')
+        p.add_option('-S', '--simulate', dest='simulate', action='store_true', default=False,
+        help='Run against simulated boards (bingo_backend.simulator) named by the host arguments')
+        p.add_option('--latency', dest='latency', type='float', default=0.5,
+        help='Milliseconds per transaction of the simulated boards [default 0.5]')
+        p.add_option('-M', '--metrics', dest='metrics', type='int', default=0,
+        help='Serve acquisition metrics for Prometheus on http://localhost:<METRICS>/metrics')
+        p.add_option('-H', '--headless', dest='headless', action='store_true', default=False,
+        help='Acquire without a plot window; stop with Ctrl-C')
         opts, args = p.parse_args(sys.argv[1:])
         if args==[]:
                 print 'Please specify a SKARAB board. Run with the -h flag to see all options.\nExiting.'
                 exit()
         else:
-                skarab_ip = args[0]
+                skarab_ips_arg = args
         if opts.fpgfile != '':
                 bitstream = opts.fpgfile
+        elif opts.simulate:
+                bitstream = 'simulated_dec16_32k.fpg'
+        # casperfpga is only needed for real boards; bring_up() imports it
+        if opts.simulate:
+                sd = skarab_definitions()
+        else:
+                from casperfpga import skarab_definitions as sd
+acquisition = None
 try:
         # -----------------------------------------------------------------
         # 1. PRINT TEST HEADER
@@ -146,7 +170,9 @@ try:
         # 2.2 ENABLE FPG FILE UPLOAD OR NOT 
         # - If the fpg file is already uploaded it is not required to 
         #   do it again. This allows the script to execute faster.
-        upload_fpg_file = 'y' # Other options: 'n'
+        # - 'auto' programs only the boards whose last programmed fpg
+        #   file (recorded in ~/.bingo_backend/programmed.json) differs.
+        upload_fpg_file = opts.upload_file # Other options: 'y', 'n'
 
         # 2.3 SET THE SKARAB IP(s)
         # - If there are more than one SKARAB systems in the hardware setup, 
@@ -155,7 +181,7 @@ try:
         #   Master SKARAB ADC Yellow Block in the fpg file uploaded to 
         #   its SKARAB system will be the master while all other SKARAB ADC 
         #   boards in the hardware setup will be the slaves.
-        skarab_ips = [skarab_ip] # Other options: ['10.0.7.3']; etc
+        skarab_ips = skarab_ips_arg # all boards given on the command line, master first
 
         # 2.4 SET THE NYQUIST ZONE FOR WHICH THE SKARAB ADC BOARDS SHOULD BE OPTIMISED
         # - Available Options: sd.FIRST_NYQ_ZONE  (First Nyquist zone)
@@ -192,22 +218,34 @@ try:
         # -----------------------------------------------------------------
         # 3. CONNECT TO SKARAB HARDWARE AND UPLOAD FPG FILE
         # -----------------------------------------------------------------
-        if upload_fpg_file == 'y':
+        if upload_fpg_file != 'n':
             print("------------------")
             print("UPLOAD FPG FILE(s)")
             print("------------------")
+        # - All boards are programmed (or attached to) in parallel; the
+        #   script does not wait for the operator so restarts run unattended.
         skarab_num = len(skarab_ips)
-        skarabs = [None] * 4
-        for i in range(skarab_num):
-            print(skarab_ips[i])
-            skarabs[i] = casperfpga.CasperFpga(skarab_ips[i])
-            if upload_fpg_file == 'y':
-                    skarabs[i].upload_to_ram_and_program(bitstream)
-            else:
-                    skarabs[i].get_system_information(bitstream)
-        if upload_fpg_file == 'y':
-            print("FPG files uploaded to SKARAB(s) successfully")
-        raw_input("Press Enter to continue with the ADC data captures")
+        program = {'y': True, 'n': False, 'auto': 'auto'}[upload_fpg_file]
+        if opts.simulate:
+                # stand-in boards; their programming state and device cache
+                # are kept apart from those of the real boards
+                sim_dir = tempfile.mkdtemp(prefix='bingo_sim_')
+                board_class = SimulatedSkarab.factory('dec16_32k', latency=opts.latency / 1e3)
+                program_state = ProgramState(path.join(sim_dir, 'programmed.json'))
+                fpg_cache = FpgCache(sim_dir)
+                fpg_hash = 'simulated'
+        else:
+                board_class = None
+                program_state = None
+                fpg_cache = FpgCache()
+                fpg_hash = fpg_fingerprint(bitstream)
+        bringup = bring_up(skarab_ips, bitstream, program=program,
+                           board_class=board_class, state=program_state,
+                           cache=fpg_cache, fingerprint=fpg_hash)
+        for line in report(skarab_ips, bringup):
+            print(line)
+        raise_failures(bringup, 'SKARAB bring-up')
+        skarabs = [result.value for result in bringup]
 
         # -----------------------------------------------------------------
         # 4. DETERMINE TEST PARAMATERS
@@ -216,39 +254,19 @@ try:
         #     DDC Mode SKARAB ADC Yellow Block tag: xps:skarab_adc4x3g_14
         #     Bypass Mode SKARAB ADC Yellow Block tag: xps:skarab_adc4x3g_14
         # -----------------------------------------------------------------
-        # 4.1 GET NUMBER OF ADCS PER SKARAB
-        adcs_per_skarab_num = 0
-        for memory_device_name in skarabs[0].memory_devices:
-            memory_device = skarabs[0].memory_devices[memory_device_name]
-            if hasattr(memory_device, 'device_info'):
-                    if memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14' or memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14_byp':
-                            adcs_per_skarab_num = adcs_per_skarab_num + 1
+        # 4.1 CLASSIFY THE DESIGN'S DEVICES IN ONE PASS
+        # - The result is cached per fpg file, so later starts skip the scan.
+        devices = fpg_cache.device_map(skarabs[0], fpg_hash)
+        adcs_per_skarab_num = len(devices.adcs)
         if adcs_per_skarab_num == 0:
             print("ERROR: No SKARAB ADC Yellow Blocks found in uploaded design")
             exit()
 
         # 4.2 GET SKARAB ADC YELLOW BLOCK NAMES AND MEZZANINE SITES
-        skarab_adc_yb_names = [None] * adcs_per_skarab_num
-        skarab_mez_sites = [None] * adcs_per_skarab_num
-        itr = 0
-        device_tag = ''
-        for memory_device_name in skarabs[0].memory_devices:
-            memory_device = skarabs[0].memory_devices[memory_device_name]
-            if hasattr(memory_device, 'device_info'):
-                    if memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14' or memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14_byp':
-                            if memory_device.master_slave == 'Master':
-                                    device_tag = memory_device.device_info['tag']
-                                    skarab_adc_yb_names[itr] = memory_device.name
-                                    skarab_mez_sites[itr] = memory_device.mezzanine_site
-                                    itr = itr + 1
-        for memory_device_name in skarabs[0].memory_devices:
-            memory_device = skarabs[0].memory_devices[memory_device_name]
-            if hasattr(memory_device, 'device_info'):
-                    if memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14' or memory_device.device_info['tag'] == 'xps:skarab_adc4x3g_14_byp':
-                            if memory_device.master_slave == 'Slave':
-                                    skarab_adc_yb_names[itr] = memory_device.name
-                                    skarab_mez_sites[itr] = memory_device.mezzanine_site
-                                    itr = itr + 1				
+        # - Master first, then the Slaves
+        skarab_adc_yb_names = devices.adcs
+        skarab_mez_sites = devices.adc_sites
+        device_tag = devices.adc_tag
 
         # 4.3 GET NUMBER of SKARAB ADC Yellow BLOCKS PER SKARAB
         skarab_adc_yb_per_skarab_num = len(skarab_adc_yb_names)
@@ -427,30 +445,25 @@ try:
         elif nyquist_zone == sd.SECOND_NYQ_ZONE:
             print("Nyquist zone optimisation: Second")
 
-        # Set registers.
-        print 'Configuring accumulation period...',
-        sys.stdout.flush()
-        for i in range(skarab_num):
-            skarabs[i].write_int('acc_len',opts.acc_len)
-            #skarabs[i].write_int('dest_ip1', DEST_IP)
-            #skarabs[i].write_int('dest_port1', DEST_PORT)
-        print 'done'
-
-        for i in range(skarab_num):
-            #skarabs[i].write_int('fft_shift', 0x00ff)
-            skarabs[i].write_int('fft_shift', 32768)
-
-        print 'Resetting counters...',
+        # Set registers: acc_len, fft_shift, the rst_cpoge and cnt_rst
+        # pulses and shift as one plan of blind writes, applied to all
+        # boards in parallel and verified by reading back once at the end.
+        #   (dest_ip1 / dest_port1 would be plan.write('dest_ip1', DEST_IP) ...)
+        print 'Configuring accumulation period and resetting counters...',
         sys.stdout.flush()
-        for i in range(skarab_num):
-            
-            skarabs[i].write_int('rst_cpoge',1)
-            skarabs[i].write_int('rst_cpoge',0)
-	    skarabs[i].write_int('cnt_rst',1)
-            skarabs[i].write_int('cnt_rst',0)
-	    skarabs[i].write_int('shift',0)
-            
-        print 'done'
+        fft_shift = 32768
+        plan = accumulation_plan(opts.acc_len, fft_shift=fft_shift, shift=0)
+        results = apply_plan(skarabs, plan)
+        raise_failures(results, 'register configuration')
+        print 'done (%.3f s)' % max(r.elapsed for r in results)
+
+        # PPS sync last: it restarts the accumulators on the PPS edge, and
+        # the hardware timestamps count dumps from that edge.
+        pps = None
+        if opts.pps != '':
+                pps = sync_pps(skarabs, software=opts.pps == 'sw')
+                print('PPS epoch %i on all boards (attempt %i, armed within %.1f ms)'
+                      % (pps.epoch, pps.attempts, 1e3 * pps.arm_spread))
 
         # Sync the ADC
         #   print 'Syncing the ADC...'
@@ -465,17 +478,114 @@ try:
         print("SKARAB ADC SYNCHRONISED SAMPLING AND SPECTROMETER TEST COMPLETE")
         print("---------------------------------------------------------------")
 
-        #set up the figure with a subplot to be plotted
-        fig = matplotlib.pyplot.figure()
-        ax = fig.add_subplot(1,1,1)
+        # Channel order and frequency axis of this design, shared by the
+        # plot and the file headers (spectra are stored in BRAM order).
+        channel_map = ChannelMap.for_mode('dec16_32k', actual_channels_ddc_centre_freq)
+
+        # Spectrum readout: 32768 channels from one accumulator BRAM per
+        # board; several boards are read in parallel and stacked.
+        if skarab_num == 1:
+                reader = SpectrumReader(skarabs[0], ['mem_left_0_0'], 32768)
+        else:
+                reader = MultiBoardReader([SpectrumReader(skarabs[i], ['mem_left_0_0'], 32768)
+                                           for i in range(skarab_num)])
+
+        # The board is read on its own thread; the plot only shows the
+        # newest spectrum, so redraws never hold up the acquisition.
+        # Dumps are predicted from acc_len (3 GHz / 16 into a 32k-point FFT)
+        # and each one is read exactly once.
+        scheduler = DumpScheduler(reader, dump_period(opts.acc_len, 32768, channel_map.sample_rate))
+        latest = LatestSink()
+        acquisition = Acquisition(reader, [latest, PeakSink()], scheduler=scheduler)
+        time_source = 'host'
+        if pps is not None:
+                # timestamps from acc_cnt, acc_len and the FFT clock since
+                # the PPS epoch; the host clock is only watched for drift
+                timestamper = Timestamper.from_sync(pps, opts.acc_len, 32768,
+                                                    channel_map.sample_rate,
+                                                    software=opts.pps == 'sw')
+                acquisition.add_stage(timestamper)
+                timestamper.instrument(acquisition.metrics)
+                time_source = 'pps_%s' % opts.pps
+        if opts.rfi != '':
+                # sliding window of the last 64 dumps of every channel
+                shape = 32768 if skarab_num == 1 else (skarab_num, 32768)
+                acquisition.add_stage(RfiFlagger(shape, opts.rfi, window=64,
+                                                 acc_len=opts.acc_len))
+        archive_meta = {'acc_len': opts.acc_len,
+                        'skarab_ips': skarab_ips,
+                        'bitstream': bitstream,
+                        'channel_mode': channel_map.mode,
+                        'time_source': time_source,
+                        'ddc_freq': float(actual_channels_ddc_centre_freq)}
+        if opts.archive != '' and opts.integrate != '':
+                # only the software integrations go to disk; the dumps stay
+                # at full rate for the plot and the RFI flagging
+                for seconds in [float(t) for t in opts.integrate.split(',')]:
+                        ndumps = dumps_for(seconds, scheduler.period)
+                        meta = dict(archive_meta, integration_dumps=ndumps,
+                                    integration_time=ndumps * scheduler.period)
+                        sink = ArchiveSink('%s_%gs' % (opts.archive, seconds), 32768,
+                                           capacity=max(64, 3600 // ndumps),
+                                           masks=opts.rfi != '', meta=meta)
+                        acquisition.add_sink(IntegrationSink(ndumps, [sink],
+                                                             masked=opts.rfi != '',
+                                                             metrics=acquisition.metrics))
+        elif opts.archive != '':
+                # ~11 GB/day at 1 s dumps; space is reserved an hour at a time
+                acquisition.add_sink(ArchiveSink(opts.archive, 32768, capacity=3600,
+                                                 masks=opts.rfi != '',
+                                                 meta=archive_meta))
+        if opts.fits != '':
+                fits_meta = [('ACC_LEN', opts.acc_len, 'spectra accumulated per dump'),
+                             ('FFTSHIFT', fft_shift, 'FFT shift schedule'),
+                             ('DDC_FREQ', float(actual_channels_ddc_centre_freq), '[Hz] DDC centre frequency'),
+                             ('BANDWDTH', channel_map.bandwidth, '[Hz] band spanned by the channels'),
+                             ('CHAN_BW', channel_map.channel_width, '[Hz] channel width'),
+                             ('CHANMODE', channel_map.mode, 'bingo_backend.channels mode'),
+                             ('NCHAN', 32768, 'channels per spectrum'),
+                             ('TIMESRC', time_source, 'TIME from host clock or PPS counters'),
+                             ('NBOARDS', skarab_num, 'SKARABs in this file')]
+                for j in range(4):
+                        fits_meta.append(('GAIN%i' % j, channels_gain[j], '[dB] ADC channel %i gain' % j))
+                acquisition.add_sink(FitsSink(opts.fits, 32768, fits_meta))
+        if opts.waterfall != '':
+                # 11 levels: 1 s x 1 channel up to ~17 min x 32 channels
+                acquisition.add_sink(WaterfallSink(opts.waterfall, 32768, levels=11,
+                                                   capacity=3600,
+                                                   meta={'acc_len': opts.acc_len,
+                                                         'bitstream': bitstream}))
+        if opts.ring != '':
+                # consumers attach with SpectrumRing.attach(<RING>).consumer(i)
+                shape = 32768 if skarab_num == 1 else (skarab_num, 32768)
+                acquisition.add_sink(RingSink(opts.ring, shape, nslots=64, consumers=4))
+        if opts.metrics:
+                # stage timings, dump jitter and missed dumps of this run
+                MetricsServer(acquisition.metrics, opts.metrics).start()
+                print 'Metrics at http://localhost:%i/metrics' % opts.metrics
+        if opts.headless:
+                print 'Headless acquisition started, press Ctrl-C to stop.'
+                acquisition.run_forever()
+                print acquisition.stats()
+                exit()
+        acquisition.start()
 
-        # start the process
-        fig.canvas.manager.window.after(100, plot_spectrum)
-        matplotlib.pyplot.show()
-        print 'Plot started.'
+        # The figure is built once; each new dump only updates the lines
+        # (a min/max envelope per pixel column) and blits them.
+        # Closing the window stops the acquisition, so the sinks flush
+        # their files and release their shared memory.
+        try:
+                viewer = LiveSpectrumViewer(get_data, channel_map.freqs)
+                viewer.start()
+                matplotlib.pyplot.show()
+        finally:
+                acquisition.stop()
+        print 'Plot closed.'
 
 
 
 except KeyboardInterrupt:
+       if acquisition is not None:
+               acquisition.stop()
        exit()
 
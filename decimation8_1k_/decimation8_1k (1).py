@@ -57,56 +57,27 @@ import time,numpy,struct,logging,pylab,matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from bingo_backend.readout import SpectrumReader
+from bingo_backend.registers import accumulation_plan, apply_plan
+from bingo_backend.parallel import raise_failures
+from bingo_backend.pps import sync_pps
+from bingo_backend.scheduler import DumpScheduler
+from bingo_backend.channels import ChannelMap
+from bingo_backend.viewer import LiveSpectrumViewer
+
 actual_channels_ddc_centre_freq = 0.0
 
 def get_data():
-        #get the data...    
-	acc_n=skarabs[0].read_uint('acc_cnt')#acc_n = fpga.read_uint('acc_cnt')
-	a_1=struct.unpack('>1024L',skarabs[0].read('mem_left_0_0',1024*4,0))
-	a_2=struct.unpack('>1024L',skarabs[0].read('mem_left_0_1',1024*4,0))
-        #a_1=struct.unpack('>512Q',skarabs[0].read('mem1',512*8,0))
-	#a_2=struct.unpack('>512Q',skarabs[0].read('mem2',512*8,0))
-	
-        #b_1=struct.unpack('>1024h',skarabs[0].read('mem3',256*8,0))
-        #for i in range(256):
-        #    print 'Index ',i,' x00=',hex(b_1[4*i]),',',hex(b_1[4*i+1]) 
-        #    print 'Index ',i,' x00=',hex(b_1[4*i+2]),",",hex(b_1[4*i+3])
-
-	interleave_a=[]
-
-	for i in range(512):
-		interleave_a.append(a_1[i])
-		interleave_a.append(a_2[i])
-
-	return acc_n, numpy.array(interleave_a,dtype=numpy.float) 
-        
-def plot_spectrum():
-        #freq_range_mhz_lo = -0.5*375.+actual_channels_ddc_centre_freq/1.0e6
-        #freq_range_mhz_hi =  0.5*375.+actual_channels_ddc_centre_freq/1.0e6
-        #freq_range_mhz_lo = -0.5*375/1.0e6
-        #freq_range_mhz_hi =  0.5*375/1.0e6
-        freq_range_mhz_lo = -0.5*375 +actual_channels_ddc_centre_freq/1.0e6 
-        freq_range_mhz_hi = 0.5*375 +actual_channels_ddc_centre_freq/1.0e6
-        matplotlib.pyplot.clf()
-	acc_n, interleave_a = get_data()
-	interleave_a = interleave_a[::-1]
-	interleave_a = np.fft.fftshift(interleave_a)
-	#interleave_a = 10*numpy.log10(interleave_a)
-	print(np.linspace(-1024./2,1024./2-1,1024).shape,interleave_a.shape)
-	matplotlib.pylab.plot(
-                np.linspace(-1024./2,1024./2-1,1024)
-                    *375./1024.+actual_channels_ddc_centre_freq/1.0e6,
-                interleave_a,
-                'b'
-        )
-	matplotlib.pylab.title('Integration number %i.'%acc_n)
-	#matplotlib.pylab.ylabel('Power (dB)'
-	matplotlib.pylab.grid()
-	matplotlib.pylab.xlabel('Freq (MHz)')
-	matplotlib.pylab.xlim(freq_range_mhz_lo, freq_range_mhz_hi)
-        #matplotlib.pylab.ylim(0, 1e10)
-	fig.canvas.draw()
-	fig.canvas.manager.window.after(100, plot_spectrum)
+        #get the data, or None if acc_cnt has not moved since the last read
+	if not scheduler.check():
+		return None
+	acc_n, interleave_a = reader.read()
+	if acc_n is not None and acc_n != scheduler.last_acc_cnt:
+		# a dump landed between the poll and the read
+		scheduler.observe(acc_n)
+	# [::-1] and fftshift in one gather, into the same buffer every dump
+	return acc_n, channel_map.reorder(interleave_a, out=display)
         
 
 #START OF MAIN:
@@ -284,32 +255,12 @@ try:
         # -----------------------------------------------------------------
         print("Synchronizing to PPS")
         software_pps = False   # True if self_generated PPS must be used
-        if software_pps: 
-            sw_pps_mask = 0x2
-        else:
-            sw_pps_mask = 0x0
-
-        frac_time = np.mod(time.time(),1.0) # ensure to be not too close to PPS
-        if frac_time > 0.8: 
-            time.sleep(1.1-frac_time)
-            frac_time = np.mod(time.time(),1.0)
-
-        utc_time = int(time.time()) + 1  # sync to next PPS
-        for i in range(skarab_num):
- 	    skarabs[i].write_int('utc_time', utc_time)
-            skarabs[i].write_int('sw_pps', sw_pps_mask) 
-
-        if software_pps: 		        # if PPS generated by SW wait for next UTC boundary
-            time.sleep(1.0-frac_time)
-
-        for i in range(skarab_num):	# Trigger PPS capture. 
-            skarabs[i].write_int('sw_pps', sw_pps_mask | 0x5) 
-        if not software_pps:                # For HW pps, wait for it to occur
-            time.sleep(1.0)
-        for i in range(skarab_num):     # deassert LOAD_PPS signal and check that time has been captured
-            skarabs[i].write_int('sw_pps', sw_pps_mask) 
-	# print(str("Skarab ")+str(i)+str(" time counter: ")+str(
-        #       skarabs[i].read_uint('utc_time_count')))
+        # All boards are armed in parallel inside a measured window of the
+        # second and utc_time_count is read back from every board; the sync
+        # is retried if any board latched a different second.
+        pps = sync_pps(skarabs[:skarab_num], software=software_pps)
+        print('PPS epoch %i on all boards (attempt %i, armed within %.1f ms)'
+              % (pps.epoch, pps.attempts, 1e3 * pps.arm_spread))
         # -----------------------------------------------------------------
         # 6. CONFIGURE SKARAB ADC BOARD
         # - Note that the configure_skarab_adc function automatically 
@@ -460,30 +411,14 @@ try:
         elif nyquist_zone == sd.SECOND_NYQ_ZONE:
             print("Nyquist zone optimisation: Second")
 
-        # Set registers.
-        print 'Configuring accumulation period...',
-        sys.stdout.flush()
-        for i in range(skarab_num):
-            skarabs[i].write_int('acc_len',opts.acc_len)
-            #skarabs[i].write_int('dest_ip1', DEST_IP)
-            #skarabs[i].write_int('dest_port1', DEST_PORT)
-        print 'done'
-
-        for i in range(skarab_num):
-            #skarabs[i].write_int('fft_shift', 0x00ff)
-            skarabs[i].write_int('fft_shift', 1023)
-
-        print 'Resetting counters...',
+        # Set registers: one plan of blind writes for all boards in parallel,
+        # read back once at the end (see bingo_backend.registers).
+        print 'Configuring accumulation period and resetting counters...',
         sys.stdout.flush()
-        for i in range(skarab_num):
-            
-            skarabs[i].write_int('rst_cpoge',1)
-            skarabs[i].write_int('rst_cpoge',0)
-	    skarabs[i].write_int('cnt_rst',1)
-            skarabs[i].write_int('cnt_rst',0)
-	    skarabs[i].write_int('shift',0)
-            
-        print 'done'
+        plan = accumulation_plan(opts.acc_len, fft_shift=1023, shift=0)
+        results = apply_plan(skarabs[:skarab_num], plan)
+        raise_failures(results, 'register configuration')
+        print 'done (%.3f s)' % max(r.elapsed for r in results)
 
         # Sync the ADC
         #   print 'Syncing the ADC...'
@@ -498,12 +433,16 @@ try:
         print("SKARAB ADC SYNCHRONISED SAMPLING AND SPECTROMETER TEST COMPLETE")
         print("---------------------------------------------------------------")
 
-        #set up the figure with a subplot to be plotted
-        fig = matplotlib.pyplot.figure()
-        ax = fig.add_subplot(1,1,1)
+        # Spectrum readout: 1024 channels interleaved from two BRAMs
+        reader = SpectrumReader(skarabs[0], ['mem_left_0_0', 'mem_left_0_1'], 512)
+        scheduler = DumpScheduler(reader)
 
-        # start the process
-        fig.canvas.manager.window.after(100, plot_spectrum)
+        # The figure is built once; each new dump only updates the line
+        # and blits it.
+        channel_map = ChannelMap.for_mode('dec8_1k', actual_channels_ddc_centre_freq)
+        display = np.empty(channel_map.nchan)
+        viewer = LiveSpectrumViewer(get_data, channel_map.freqs, style='b')
+        viewer.start()
         matplotlib.pyplot.show()
         print 'Plot started.'
 
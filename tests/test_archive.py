@@ -0,0 +1,88 @@
+"""
+Restarting a run on an existing archive or pyramid continues it.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.acquisition import Spectrum
+from bingo_backend.archive import ArchiveSink, SpectrumArchive
+from bingo_backend.waterfall import WaterfallPyramid, WaterfallSink
+
+NCHAN = 64
+
+
+def run(sink, first, n):
+    sink.open()
+    for acc_cnt in range(first, first + n):
+        sink.write(Spectrum(acc_cnt, np.full(NCHAN, acc_cnt, dtype=np.float32),
+                            1000.0 + acc_cnt))
+    sink.close()
+
+
+def test_archive_sink_appends_after_stored_rows(tmpdir):
+    base = str(tmpdir.join('tod'))
+    run(ArchiveSink(base, NCHAN, capacity=4), 0, 10)
+    run(ArchiveSink(base, NCHAN, capacity=4), 10, 5)
+    archive = SpectrumArchive(base)
+    assert len(archive) == 15
+    assert list(archive.index['acc_cnt']) == list(range(15))
+    assert np.array_equal(archive.data[:, 0], np.arange(15))
+
+
+def test_archive_refuses_other_spectra(tmpdir):
+    base = str(tmpdir.join('tod'))
+    run(ArchiveSink(base, NCHAN), 0, 3)
+    with pytest.raises(OSError):
+        SpectrumArchive.create(base, NCHAN)
+    with pytest.raises(ValueError):
+        ArchiveSink(base, 2 * NCHAN).open()
+    with pytest.raises(ValueError):
+        ArchiveSink(base, NCHAN, dtype='uint32').open()
+    assert len(SpectrumArchive(base)) == 3
+
+
+def test_archive_refuses_other_meta(tmpdir):
+    base = str(tmpdir.join('tod'))
+    meta = {'acc_len': 1024, 'channel_mode': 'dec16_32k', 'skarab_ips': ('a', 'b')}
+    run(ArchiveSink(base, NCHAN, meta=meta), 0, 3)
+    run(ArchiveSink(base, NCHAN, meta=meta), 3, 3)
+    with pytest.raises(ValueError):
+        ArchiveSink(base, NCHAN, meta=dict(meta, acc_len=2048)).open()
+    with pytest.raises(ValueError):
+        ArchiveSink(base, NCHAN, meta=dict(meta, channel_mode='dec8_1k')).open()
+    assert len(SpectrumArchive(base)) == 6
+
+
+def test_reader_maps_rows_all_files_hold(tmpdir):
+    base = str(tmpdir.join('tod'))
+    archive = SpectrumArchive.create(base, NCHAN, capacity=4, masks=True)
+    for acc_cnt in range(4):
+        archive.append(np.zeros(NCHAN, dtype=np.float32), acc_cnt, 0.0)
+    archive.flush()
+    # a writer caught between growing .spec and .idx
+    with open(base + '.spec', 'ab') as f:
+        f.write(b'\0' * 4 * NCHAN * 4)
+    reader = SpectrumArchive(base)
+    assert reader.allocated == 4 and len(reader) == 4
+    assert reader.refresh() == 4
+    archive.close()
+
+
+def test_waterfall_sink_resumes(tmpdir):
+    directory = str(tmpdir.join('waterfall'))
+    run(WaterfallSink(directory, NCHAN, levels=3), 0, 8)
+    run(WaterfallSink(directory, NCHAN, levels=3), 8, 8)
+    pyramid = WaterfallPyramid(directory)
+    assert len(pyramid.archives[1, 'mean']) == 8
+    assert len(pyramid.archives[2, 'mean']) == 4
+    with pytest.raises(ValueError):
+        WaterfallSink(directory, NCHAN, levels=4).open()
+    with pytest.raises(ValueError):
+        WaterfallSink(directory, NCHAN, levels=3, meta={'acc_len': 2048}).open()
@@ -0,0 +1,116 @@
+"""
+Packet-buffer reads gated on the refill counter.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.baseband import BramSource
+
+NWORDS = 4
+
+
+class RefillingBoard(object):
+    """Packet buffers refilled whenever the counter is read, by the
+    number of refills scripted for that read."""
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.count = 0
+
+    def read_uint(self, name):
+        self.count += self.steps.pop(0) if self.steps else 0
+        return self.count
+
+    def read(self, name, nbytes, offset):
+        # a refill is its counter value in every word, re and im alike
+        return np.full(nbytes // 2, self.count, dtype='>i2').tobytes()
+
+
+def source(steps, count_register='pkt_cnt'):
+    src = BramSource('board', ('sxr_re', 'sxr_im'), NWORDS, count_register=count_register)
+    src.fpga = RefillingBoard(steps)
+    return src
+
+
+def refill(raws):
+    values = [set(np.frombuffer(raw, dtype='>i2')) for raw in raws]
+    assert len(values) == 2 and values[0] == values[1] and len(values[0]) == 1
+    return values[0].pop()
+
+
+def test_reads_each_refill_once():
+    # counter reads: before and after each buffer pair
+    src = source([1, 0, 0, 1, 0, 3, 0])
+    raws, dropped = src.read()
+    assert refill(raws) == 1 and dropped == 0
+    assert src.read() == (None, 0)              # not refilled since
+    raws, dropped = src.read()
+    assert refill(raws) == 2 and dropped == 0
+    raws, dropped = src.read()
+    assert refill(raws) == 5 and dropped == 2 * NWORDS
+    assert src.contiguous
+
+
+def test_discards_read_refilled_underneath():
+    src = source([1, 1, 0, 0])
+    assert src.read() == (None, 0)
+    raws, dropped = src.read()
+    assert refill(raws) == 2 and dropped == 0
+
+
+def test_without_counter_not_contiguous():
+    src = source([], count_register=None)
+    raws, dropped = src.read()
+    assert len(raws) == 2 and dropped == 0
+    assert not src.contiguous
+
+
+class FakeSource(BramSource):
+    """BramSource on a RefillingBoard that refills on every counter read."""
+
+    def open(self):
+        self.fpga = RefillingBoard([])
+        self.fpga.steps = [1, 0] * 1000
+
+
+def test_capture_pairs_polarisation_files(tmpdir):
+    from bingo_backend.baseband import BasebandCapture
+    from bingo_backend.dedisperse import BasebandFile
+    prefix = str(tmpdir.join('capture'))
+    capture = BasebandCapture([FakeSource('board', ('sxr_re', 'sxr_im'), NWORDS,
+                                          count_register='pkt_cnt')],
+                              prefix, block_bytes=4096)
+    capture.run(0.5, out=lambda line: None)
+    data = BasebandFile(prefix)
+    assert data.contiguous
+    assert data.nsamples > 0
+    samples = data.read(0, data.nsamples)[0]
+    # every refill once, in order, with re and im from the same refill
+    assert np.array_equal(samples.real, samples.imag)
+    assert np.array_equal(np.unique(samples.real), np.arange(1, data.nsamples // NWORDS + 1))
+
+
+def test_second_capture_keeps_the_first(tmpdir):
+    from bingo_backend.baseband import BasebandCapture
+    from bingo_backend.dedisperse import BasebandFile
+    prefix = str(tmpdir.join('capture'))
+    captures, written = [], []
+    for _ in range(2):
+        capture = BasebandCapture([FakeSource('board', ('sxr_re', 'sxr_im'), NWORDS,
+                                              count_register='pkt_cnt')],
+                                  prefix, block_bytes=4096)
+        capture.run(0.3, out=lambda line: None)
+        captures.append(capture)
+        written.append(tmpdir.join('capture.json').read() +
+                       repr(tmpdir.join('capture_sxr_re.raw').read_binary()))
+    assert captures[0].prefix == prefix
+    assert captures[1].prefix == prefix + '_1'
+    assert written[1] == written[0]
+    assert BasebandFile(prefix).nsamples > 0
+    assert BasebandFile(prefix + '_1').nsamples > 0
@@ -0,0 +1,43 @@
+"""
+Channel maps agree with the sample rate that times the spectra.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.channels import MODES, ChannelMap
+from bingo_backend.scheduler import dump_period
+
+
+def test_channels_span_the_decimated_band():
+    for mode, spec in MODES.items():
+        channel_map = ChannelMap.for_mode(mode, 1e9)
+        decimated = 3000e6 / spec['decimation']
+        assert np.isclose(channel_map.channel_width * channel_map.nchan, decimated), mode
+        assert np.isclose(channel_map.sample_rate, decimated), mode
+        # a spectrum takes nchan samples, so the channel width is its rate
+        assert np.isclose(1.0 / dump_period(1, channel_map.nchan, channel_map.sample_rate),
+                          channel_map.channel_width), mode
+
+
+def test_dec16_32k_band():
+    # 187.5 MHz over 32768 bins: 1026.25-1213.75 MHz around 1120 MHz
+    channel_map = ChannelMap.for_mode('dec16_32k', 1120e6)
+    assert channel_map.bandwidth == 187.5e6
+    assert np.isclose(channel_map.freqs.min(), 1026.25, atol=channel_map.channel_width / 1e6)
+    assert np.isclose(channel_map.freqs.max(), 1213.75, atol=channel_map.channel_width / 1e6)
+    # the default acc_len of the script dumps about once a second
+    assert abs(dump_period(5722, 32768, channel_map.sample_rate) - 1.0) < 1e-3
+
+
+def test_reorder_into_buffer():
+    channel_map = ChannelMap.for_mode('dec16_32k', 1e9)
+    data = np.arange(channel_map.nchan, dtype=np.uint32)
+    out = np.empty_like(data)
+    assert channel_map.reorder(data, out=out) is out
+    assert np.array_equal(out, data[::-1][np.fft.fftshift(np.arange(channel_map.nchan))])
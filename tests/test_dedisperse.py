@@ -0,0 +1,68 @@
+"""
+Coherent dedispersion against a pulse dispersed with the physical delay law.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.dedisperse import DedispersionPlan, chirp, dispersion_delay
+
+SAMPLE_RATE = 23.4375e6
+CENTRE_FREQ = 1e9
+DM = 2.0
+NSAMPLES = 1 << 16
+OFFSETS = np.linspace(-0.4, 0.4, 9) * SAMPLE_RATE      # sub-band centres, Hz
+
+
+def dispersed_pulse(t0=0.2e-3, width=20e-6):
+    """Narrow-band bursts at OFFSETS, each arriving at t0 plus the delay of
+    its sky frequency behind the top of the band."""
+    t = np.arange(NSAMPLES) / SAMPLE_RATE
+    f_hi = (CENTRE_FREQ + SAMPLE_RATE / 2) / 1e6
+    x = np.zeros(NSAMPLES, dtype=np.complex128)
+    for offset in OFFSETS:
+        arrival = t0 + dispersion_delay(DM, (CENTRE_FREQ + offset) / 1e6, f_hi)
+        x += np.exp(-0.5 * ((t - arrival) / width) ** 2) * np.exp(2j * np.pi * offset * t)
+    return x
+
+
+def arrivals(x):
+    """Peak time of each burst, from the signal mixed down and smoothed."""
+    t = np.arange(len(x)) / SAMPLE_RATE
+    kernel = np.ones(64) / 64
+    return np.array([t[np.argmax(np.abs(np.convolve(x * np.exp(-2j * np.pi * offset * t),
+                                                    kernel, 'same')))]
+                     for offset in OFFSETS])
+
+
+def test_chirp_removes_dispersion():
+    x = dispersed_pulse()
+    before = arrivals(x)
+    smear = dispersion_delay(DM, (CENTRE_FREQ + OFFSETS[0]) / 1e6,
+                             (CENTRE_FREQ + OFFSETS[-1]) / 1e6)
+    assert abs(np.ptp(before) - smear) < 0.05 * smear
+    y = np.fft.ifft(np.fft.fft(x) * chirp(NSAMPLES, SAMPLE_RATE, CENTRE_FREQ, DM))
+    after = arrivals(y)
+    # every sub-band lands within a few samples of the others
+    assert np.ptp(after) < 0.01 * smear, (np.ptp(after), smear)
+
+
+def test_plan_blocks_align_pulse():
+    x = dispersed_pulse()
+    plan = DedispersionPlan(SAMPLE_RATE, CENTRE_FREQ, DM)
+    response = plan.filter()
+    out = []
+    for k in range(plan.nblocks(NSAMPLES)):
+        block = np.zeros((1, plan.nfft), dtype=np.complex64)
+        chunk = x[k * plan.step:k * plan.step + plan.nfft]
+        block[0, :len(chunk)] = chunk
+        out.append(plan.dedisperse(block, response)[0])
+    y = np.concatenate(out)
+    after = arrivals(y)
+    smear = np.ptp(arrivals(x))
+    assert np.ptp(after) < 0.01 * smear, (np.ptp(after), smear)
@@ -0,0 +1,75 @@
+"""
+Rolling FITS files never overwrite one another.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.acquisition import Spectrum
+from bingo_backend.fits import BLOCK, FitsSink, FitsSpectrumWriter
+
+NCHAN = 16
+
+
+def test_rollover_within_one_second(tmpdir):
+    prefix = str(tmpdir.join('tod'))
+    # every row past the first header starts a new file
+    writer = FitsSpectrumWriter(prefix, NCHAN, rows_per_chunk=1, max_bytes=1)
+    for acc_cnt in range(3):
+        writer.append(np.full(NCHAN, acc_cnt), acc_cnt, 1700000000.0)
+    writer.close()
+    assert len(set(writer.files)) == 3
+    assert [os.path.basename(f) for f in writer.files] == [
+        'tod_20231114_221320.fits', 'tod_20231114_221320_1.fits',
+        'tod_20231114_221320_2.fits']
+    for acc_cnt, path in enumerate(writer.files):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        assert len(raw) % BLOCK == 0
+        # the data block starts with the row's big-endian ACC_CNT
+        assert np.frombuffer(raw, '>i8', 1, 2 * BLOCK)[0] == acc_cnt
+
+
+def test_restart_keeps_earlier_files(tmpdir):
+    prefix = str(tmpdir.join('tod'))
+    for run in range(2):
+        writer = FitsSpectrumWriter(prefix, NCHAN)
+        writer.append(np.zeros(NCHAN), run, 1700000000.0)
+        writer.close()
+    assert sorted(os.listdir(str(tmpdir))) == ['tod_20231114_221320.fits',
+                                               'tod_20231114_221320_1.fits']
+
+
+def test_valid_fits_after_every_chunk(tmpdir):
+    fits = pytest.importorskip('astropy.io.fits')
+    prefix = str(tmpdir.join('tod'))
+    writer = FitsSpectrumWriter(prefix, NCHAN, rows_per_chunk=4)
+    for acc_cnt in range(10):
+        writer.append(np.full(NCHAN, acc_cnt), acc_cnt, 1700000000.0 + acc_cnt)
+        if acc_cnt in (5, 9):
+            writer.flush()
+            assert os.path.getsize(writer.path) % BLOCK == 0
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                with fits.open(writer.path) as hdus:
+                    rows = hdus['SPECTRA'].data
+                    assert list(rows['ACC_CNT']) == list(range(acc_cnt + 1))
+                    assert np.array_equal(rows['DATA'][:, 0], np.arange(acc_cnt + 1))
+    writer.close()
+
+
+def test_sink_flushes_on_a_timer(tmpdir):
+    prefix = str(tmpdir.join('tod'))
+    sink = FitsSink(prefix, NCHAN, flush_seconds=0.0)
+    sink.write(Spectrum(7, np.zeros(NCHAN), 1700000000.0))
+    with open(sink.writer.path, 'rb') as f:
+        raw = f.read()
+    assert np.frombuffer(raw, '>i8', 1, 2 * BLOCK)[0] == 7
+    sink.close()
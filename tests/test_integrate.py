@@ -0,0 +1,78 @@
+"""
+Boxcar windows aligned on acc_cnt, incomplete windows and masked sums.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.acquisition import Spectrum
+from bingo_backend.integrate import Integrator
+from bingo_backend.rfi import pack_mask, unpack_mask
+
+NCHAN = 8
+
+
+def dump(acc_cnt, value=1, flagged=()):
+    mask = None
+    if flagged:
+        flags = np.zeros(NCHAN, dtype=bool)
+        flags[list(flagged)] = True
+        mask = pack_mask(flags)
+    return Spectrum(acc_cnt, np.full(NCHAN, value, dtype=np.uint32),
+                    1000.0 + acc_cnt, mask=mask)
+
+
+def run(integrator, dumps):
+    return [p for p in (integrator.add(d) for d in dumps) if p is not None]
+
+
+def test_windows_are_aligned_on_acc_cnt():
+    integrator = Integrator(4)
+    products = run(integrator, [dump(n, n) for n in range(2, 12)])
+    # 2-3 lack the start of window 0, 8-11 is whole
+    assert [p.acc_cnt for p in products] == [4, 8]
+    assert [p.timestamp for p in products] == [1004.0, 1008.0]
+    assert np.array_equal(products[0].data, np.full(NCHAN, 4 + 5 + 6 + 7))
+    assert products[0].data.dtype == np.uint64
+    assert integrator.products == 2
+    assert integrator.incomplete == 1
+
+
+def test_window_missing_a_dump_is_dropped():
+    integrator = Integrator(4)
+    products = run(integrator, [dump(n) for n in (0, 1, 3, 4, 5, 6, 7)])
+    assert [p.acc_cnt for p in products] == [4]
+    assert integrator.incomplete == 1
+
+
+def test_masked_samples_are_rescaled():
+    integrator = Integrator(4, masked=True)
+    products = run(integrator, [dump(0, 3, flagged=[2]), dump(1, 3),
+                                dump(2, 3, flagged=[2, 5]), dump(3, 3),
+                                dump(4, 3, flagged=[1])])
+    assert len(products) == 1
+    data = products[0].data
+    # three of four dumps of channel 5 scaled by 4/3, two of channel 2 by 2
+    assert data[5] == 4 * 3 and data[2] == 4 * 3
+    assert np.allclose(data, 12.0)
+    assert not unpack_mask(products[0].mask, NCHAN).any()
+
+
+def test_masked_incomplete_window_is_rescaled_and_fully_flagged_channel_masked():
+    integrator = Integrator(4, masked=True)
+    flagged = dict(flagged=[0])
+    products = run(integrator, [dump(0, 2, **flagged), dump(1, 2, **flagged),
+                                dump(2, 2, **flagged), dump(4, 2)])
+    # window 0 lacked acc_cnt 3: emitted when window 1 starts, rescaled
+    assert [p.acc_cnt for p in products] == [0]
+    data = products[0].data
+    assert np.isnan(data[0])
+    assert np.allclose(data[1:], 4 * 2)
+    assert unpack_mask(products[0].mask, NCHAN)[0]
+    assert not unpack_mask(products[0].mask, NCHAN)[1:].any()
+    assert integrator.incomplete == 0
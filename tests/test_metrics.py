@@ -0,0 +1,29 @@
+"""
+Every sink reports under its own metrics label.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.acquisition import Publisher
+from bingo_backend.integrate import IntegrationSink
+from bingo_backend.metrics import Metrics
+from bingo_backend.sinks import PeakSink
+
+
+def test_sink_labels_are_unique():
+    metrics = Metrics()
+    publisher = Publisher(metrics=metrics)
+    publisher.add_sink(PeakSink())
+    publisher.add_sink(PeakSink())
+    publisher.add_sink(IntegrationSink(10, [PeakSink(), PeakSink()], metrics=metrics))
+    lines = metrics.render().splitlines()
+    written = [l for l in lines if l.startswith('bingo_sink_written_total{')]
+    timed = [l for l in lines if l.startswith('bingo_stage_seconds_count{')
+             and 'sink_write' in l]
+    for series in (written, timed):
+        assert len(series) == 5
+        assert len(set(l.rsplit(' ', 1)[0] for l in series)) == 5
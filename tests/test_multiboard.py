@@ -0,0 +1,67 @@
+"""
+Aligning the reads of several simulated boards on acc_cnt.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.multiboard import AlignmentError, MultiBoardReader
+from bingo_backend.readout import SpectrumReader
+from bingo_backend.simulator import SimulatedSkarab
+
+
+class LaggingSkarab(SimulatedSkarab):
+    """A board whose dumps land one accumulation late for its next
+    ``lag`` acc_cnt evaluations (register and BRAM reads)."""
+
+    lag = 0
+
+    def acc_cnt(self, now=None):
+        count = SimulatedSkarab.acc_cnt(self, now)
+        if self.lag:
+            self.lag -= 1
+            return count - 1
+        return count
+
+
+def lagging_pair(lag, max_realign=3):
+    # a clock that stands still: both boards sit in accumulation 10
+    clock = lambda: 1000.0
+    boards = [LaggingSkarab('sim%i' % i, 'dec8_1k', clock=clock) for i in range(2)]
+    for board in boards:
+        board.upload_to_ram_and_program('simulated_dec8_1k.fpg')
+        board._epoch -= 10.5 * board.dump_period()
+    boards[1].lag = lag
+    readers = [SpectrumReader(board, ['mem_left_0_0', 'mem_left_0_1'], 512)
+               for board in boards]
+    return boards, MultiBoardReader(readers, max_realign, realign_delay=0.0)
+
+
+def test_lagging_board_is_read_again():
+    # the first bracketed read of board 1 (acc_cnt, two BRAMs, acc_cnt)
+    # still sees accumulation 9
+    boards, reader = lagging_pair(lag=4)
+    acc_n, spectra = reader.read()
+    assert acc_n == 10
+    assert spectra.shape == (2, 1024)
+    for board, row in zip(boards, spectra):
+        assert np.array_equal(row, board.spectrum(10))
+    assert reader.realigned == 1 and reader.misaligned == 0
+    assert reader.readers[1].reads == 2 and reader.readers[0].reads == 1
+    reader.close()
+
+
+def test_board_that_never_catches_up_raises():
+    boards, reader = lagging_pair(lag=1000, max_realign=2)
+    with pytest.raises(AlignmentError):
+        reader.read()
+    assert reader.misaligned == 1 and reader.realigned == 0
+    # the first read and two re-reads
+    assert reader.readers[1].reads == 3
+    reader.close()
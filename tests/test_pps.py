@@ -0,0 +1,51 @@
+"""
+PPS synchronisation of simulated boards.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.pps import LOAD_PPS, SOFTWARE_TRIGGER, PpsSync
+from bingo_backend.simulator import SimulatedSkarab
+from bingo_backend.timing import Timestamper
+
+
+class RecordingSkarab(SimulatedSkarab):
+    """Simulated board keeping every value written to sw_pps."""
+
+    def write_int(self, name, value, *args, **kwargs):
+        if name == 'sw_pps':
+            self.__dict__.setdefault('sw_pps_writes', []).append(value)
+        return SimulatedSkarab.write_int(self, name, value, *args, **kwargs)
+
+
+def boards(n, latency=0.0):
+    result = []
+    for i in range(n):
+        board = RecordingSkarab('sim%i' % i, design='dec16_32k', latency=latency)
+        board.upload_to_ram_and_program('simulated_dec16_32k.fpg')
+        result.append(board)
+    return result
+
+
+def test_hardware_pps_armed_with_trigger_bit():
+    skarabs = boards(2)
+    result = PpsSync(skarabs, window=(0.0, 0.9)).sync()
+    for board in skarabs:
+        assert LOAD_PPS | SOFTWARE_TRIGGER in board.sw_pps_writes
+        assert board.read_uint('utc_time_count') >= result.epoch
+    assert len(set(result.counts)) == 1
+
+
+def test_software_pps_epoch_is_the_trigger():
+    # the trigger takes a 20 ms transaction to reach the boards
+    skarabs = boards(2, latency=0.02)
+    result = PpsSync(skarabs, software=True, max_skew=0.05).sync()
+    timestamper = Timestamper.from_sync(result, 1024, 32768, 187.5e6, software=True)
+    for board in skarabs:
+        # the accumulators restarted when the trigger arrived
+        assert abs(timestamper.epoch - board._epoch) <= timestamper.epoch_error
+    assert timestamper.epoch - result.epoch > 0.01
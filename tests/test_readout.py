@@ -0,0 +1,72 @@
+"""
+Torn-read retries of the BRAM readout on a simulated board.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.readout import SpectrumReader, TornReadError
+from bingo_backend.simulator import SimulatedSkarab
+
+
+class SteppingClock(object):
+    """Time advancing by one step every time it is read."""
+
+    def __init__(self, step):
+        self.step = step
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def board(step_dumps):
+    """A 1k board whose clock advances ``step_dumps`` dumps per transaction."""
+    clock = SteppingClock(1.0)
+    skarab = SimulatedSkarab('sim0', 'dec8_1k', clock=clock)
+    skarab.upload_to_ram_and_program('simulated_dec8_1k.fpg')
+    clock.step = step_dumps * skarab.dump_period()
+    return skarab
+
+
+def reader(skarab, max_retries=3):
+    return SpectrumReader(skarab, ['mem_left_0_0', 'mem_left_0_1'], 512,
+                          max_retries=max_retries)
+
+
+def test_untorn_read():
+    skarab = board(0.1)
+    r = reader(skarab)
+    acc_n, spectrum = r.read()
+    assert r.stats()['reads'] == 1 and r.torn == 0
+    assert np.array_equal(spectrum, skarab.spectrum(acc_n))
+
+
+def test_dump_during_read_is_retried():
+    # the four transactions of an attempt span 0.3 dumps: depending on
+    # where the dumps fall, one attempt in three or four is torn
+    skarab = board(0.3)
+    r = reader(skarab)
+    for _ in range(20):
+        acc_n, spectrum = r.read()
+        # a retried read still returns the spectrum of a single dump
+        assert np.array_equal(spectrum, skarab.spectrum(acc_n))
+    assert r.torn > 0
+    assert r.reads == 20 + r.torn
+    assert r.failures == 0
+    assert r.stats()['torn_fraction'] == r.torn / r.reads
+
+
+def test_torn_every_time_gives_up():
+    # a dump lands on every transaction
+    r = reader(board(1.0), max_retries=2)
+    with pytest.raises(TornReadError):
+        r.read()
+    assert (r.reads, r.torn, r.failures) == (3, 3, 1)
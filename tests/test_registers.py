@@ -0,0 +1,67 @@
+"""
+Register plans applied to simulated boards, with read-back.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.registers import RegisterMismatch, accumulation_plan, apply_plan
+from bingo_backend.simulator import SimulatedSkarab
+
+
+class StuckSkarab(SimulatedSkarab):
+    """A board on which writes to one register do not take."""
+
+    stuck = 'fft_shift'
+
+    def _write_register(self, name, value, now):
+        if name != self.stuck:
+            SimulatedSkarab._write_register(self, name, value, now)
+
+
+def programmed(board_class, n):
+    boards = [board_class('sim%i' % i, 'dec16_32k') for i in range(n)]
+    for board in boards:
+        board.upload_to_ram_and_program('simulated_dec16_32k.fpg')
+    return boards
+
+
+def test_plan_configures_every_board():
+    boards = programmed(SimulatedSkarab, 3)
+    results = apply_plan(boards, accumulation_plan(2048, fft_shift=4095, shift=3))
+    assert all(r.ok for r in results)
+    for board, result in zip(boards, results):
+        assert (board.registers['acc_len'], board.registers['fft_shift'],
+                board.registers['shift']) == (2048, 4095, 3)
+        # the pulses end low
+        assert board.registers['cnt_rst'] == 0 and board.registers['rst_cpoge'] == 0
+        assert result.value == {'writes': 7, 'reads': 3, 'skipped': 0}
+
+
+def test_read_back_mismatch_fails_the_board():
+    boards = programmed(SimulatedSkarab, 1) + programmed(StuckSkarab, 1)
+    states = [{}, {}]
+    results = apply_plan(boards, accumulation_plan(2048, fft_shift=4095), states=states)
+    assert results[0].ok and not results[1].ok
+    error = results[1].error
+    assert isinstance(error, RegisterMismatch)
+    assert error.mismatches == [('fft_shift', 4095, 0)]
+    # the stuck register is written again next time, the others are not
+    assert states[0]['fft_shift'] == 4095 and 'fft_shift' not in states[1]
+    assert states[1]['acc_len'] == 2048
+
+
+def test_state_skips_unchanged_writes():
+    boards = programmed(SimulatedSkarab, 2)
+    states = [{}, {}]
+    plan = accumulation_plan(2048, fft_shift=4095, shift=3)
+    apply_plan(boards, plan, states=states)
+    results = apply_plan(boards, accumulation_plan(4096, fft_shift=4095, shift=3),
+                         states=states)
+    for result in results:
+        # acc_len and the four pulse writes; fft_shift and shift skipped
+        assert result.value == {'writes': 5, 'reads': 3, 'skipped': 2}
+    assert all(board.registers['acc_len'] == 4096 for board in boards)
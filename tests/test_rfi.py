@@ -0,0 +1,41 @@
+"""
+Spectral-kurtosis flagging marks the burst, not the window after it.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.rfi import RfiFlagger
+
+NCHAN = 256
+ACC_LEN = 1000
+
+
+def noise(rng, n):
+    """Spectra of ACC_LEN summed powers of complex noise."""
+    return 100.0 * (1 + rng.standard_normal((n, NCHAN)) / np.sqrt(ACC_LEN))
+
+
+def test_burst_flags_one_spectrum():
+    rng = np.random.RandomState(1)
+    spectra = noise(rng, 200)
+    spectra[100, 7] *= 20
+    flagger = RfiFlagger(NCHAN, 'sk', window=64, acc_len=ACC_LEN)
+    masks = np.array([flagger.flag(s).copy() for s in spectra])
+    assert masks[100, 7]
+    assert not masks[101:, 7].any()
+    assert masks.mean() < 0.01
+
+
+def test_cw_flags_channel():
+    rng = np.random.RandomState(2)
+    spectra = noise(rng, 100)
+    spectra[:, 3] = 500.0         # a steady tone: no radiometer noise
+    flagger = RfiFlagger(NCHAN, 'sk', window=32, acc_len=ACC_LEN)
+    masks = np.array([flagger.flag(s).copy() for s in spectra])
+    assert masks[32:, 3].all()      # once the window is full
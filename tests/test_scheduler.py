@@ -0,0 +1,123 @@
+"""
+Dump scheduling on a simulated board, driven by a fake clock.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.readout import SpectrumReader
+from bingo_backend.scheduler import DumpScheduler
+from bingo_backend.simulator import SimulatedSkarab
+
+ACC_LEN = 100000            # ~0.27 s dumps at 1k channels
+POLL = 0.01
+
+
+class FakeClock(object):
+    """Host clock that only moves when a wait passes time."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeHalt(object):
+    """Stands in for the halt event: waiting advances the clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def wait(self, timeout=None):
+        self.clock.now += timeout
+        return False
+
+    def is_set(self):
+        return False
+
+
+def scheduled_board(period_scale=1.0, relock_every=0):
+    clock = FakeClock()
+    board = SimulatedSkarab('sim0', 'dec8_1k', clock=clock)
+    board.upload_to_ram_and_program('simulated_dec8_1k.fpg')
+    board.write_int('acc_len', ACC_LEN)
+    reader = SpectrumReader(board, ['mem_left_0_0', 'mem_left_0_1'], 512)
+    scheduler = DumpScheduler(reader, board.dump_period() * period_scale,
+                              poll_interval=POLL, relock_every=relock_every,
+                              clock=clock)
+    halt = FakeHalt(clock)
+    # the first dump is read at once, the second pins the dump phase
+    assert scheduler.wait(halt) and scheduler.wait(halt)
+    assert scheduler.anchor is not None
+    return clock, board, scheduler, halt
+
+
+def test_wakes_once_per_dump():
+    clock, board, scheduler, halt = scheduled_board()
+    polls, repeats = scheduler.polls, scheduler.repeats
+    for _ in range(10):
+        assert scheduler.wait(halt)
+        assert scheduler.last_acc_cnt == board.acc_cnt()
+    assert scheduler.polls == polls + 10
+    assert scheduler.repeats == repeats
+    assert (scheduler.skipped, scheduler.late, scheduler.resets) == (0, 0, 0)
+
+
+def test_counts_skipped_dumps():
+    clock, board, scheduler, halt = scheduled_board()
+    last = scheduler.last_acc_cnt
+    # sleep through two dumps, wake up just after the third
+    clock.now += 3 * board.dump_period()
+    assert scheduler.wait(halt)
+    assert scheduler.last_acc_cnt == last + 3
+    assert scheduler.skipped == 2
+
+
+def test_counts_repeats():
+    clock, board, scheduler, halt = scheduled_board()
+    repeats = scheduler.repeats
+    assert scheduler.check() == 0
+    assert scheduler.repeats == repeats + 1
+
+
+def test_counts_resets_and_measures_the_phase_again():
+    clock, board, scheduler, halt = scheduled_board()
+    clock.now += 5 * board.dump_period()
+    scheduler.wait(halt)
+    board.write_int('cnt_rst', 0)
+    board.write_int('cnt_rst', 1)
+    assert scheduler.wait(halt)
+    assert scheduler.resets == 1
+    assert scheduler.anchor is None
+    assert scheduler.wait(halt)
+    assert scheduler.anchor is not None
+
+
+def test_counts_late_dumps():
+    # the scheduler expects dumps twice as often as they come
+    clock, board, scheduler, halt = scheduled_board(period_scale=0.5)
+    last = scheduler.last_acc_cnt
+    assert scheduler.wait(halt)
+    assert scheduler.late == 1
+    assert scheduler.last_acc_cnt == last + 1
+    assert scheduler.skipped == 0
+
+
+def test_relock_measures_the_dump_phase():
+    clock, board, scheduler, halt = scheduled_board(relock_every=2)
+    period = board.dump_period()
+    for _ in range(6):
+        dumps, polls = scheduler.dumps, scheduler.polls
+        assert scheduler.wait(halt)
+        if dumps % 2 == 0:
+            # woken before the dump, then polled up to it
+            assert scheduler.polls > polls + 1
+            dump_time = board._epoch + scheduler.last_acc_cnt * period
+            assert 0 <= scheduler.anchor - dump_time < POLL + 1e-9
+        else:
+            assert scheduler.polls == polls + 1
+    assert scheduler.late == 0 and scheduler.skipped == 0
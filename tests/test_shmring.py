@@ -0,0 +1,104 @@
+"""
+One producer and two consumer processes on a shared-memory ring.
+"""
+
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bingo_backend.acquisition import Spectrum
+from bingo_backend.shmring import RingSink, SpectrumRing
+
+NCHAN = 4096
+NSLOTS = 8
+COUNT = 2000
+
+if hasattr(multiprocessing, 'get_context'):
+    mp = multiprocessing.get_context('fork')
+else:  # Python 2 always forks
+    mp = multiprocessing
+
+
+def consume(name, index, delay, ready, done, results):
+    ring = SpectrumRing.attach(name)
+    consumer = ring.consumer(index)
+    ready.set()
+    count = bad = 0
+    last = -1
+    while True:
+        spectrum = consumer.read(timeout=0.2)
+        if spectrum is None:
+            if done.is_set():
+                break
+            continue
+        # every sample of a slot is its acc_cnt: a torn copy mixes two
+        if not (spectrum.data == spectrum.acc_cnt).all() or spectrum.acc_cnt <= last:
+            bad += 1
+        last = spectrum.acc_cnt
+        count += 1
+        if delay:
+            time.sleep(delay)
+    results.put((index, count, consumer.overruns, bad, last))
+    consumer.close()
+    ring.close()
+
+
+def test_two_consumers_read_whole_spectra():
+    name = 'bingo-test-ring-%i' % os.getpid()
+    ring = SpectrumRing.create(name, NCHAN, nslots=NSLOTS, consumers=2)
+    ready = [mp.Event(), mp.Event()]
+    done = mp.Event()
+    results = mp.Queue()
+    # consumer 0 keeps up, consumer 1 is slow and gets lapped
+    workers = [mp.Process(target=consume, args=(name, i, delay, ready[i], done, results))
+               for i, delay in enumerate((0.0, 0.002))]
+    try:
+        for worker in workers:
+            worker.start()
+        for event in ready:
+            assert event.wait(10)
+        data = np.empty(NCHAN)
+        for acc_cnt in range(COUNT):
+            data[:] = acc_cnt
+            ring.write(data, acc_cnt, 1000.0 + acc_cnt)
+            if acc_cnt % 16 == 0:
+                time.sleep(0.001)
+        done.set()
+        got = dict((r[0], r[1:]) for r in (results.get(timeout=30) for _ in workers))
+    finally:
+        done.set()
+        for worker in workers:
+            worker.join(10)
+        ring.close()
+    for index in (0, 1):
+        count, overruns, bad, last = got[index]
+        assert bad == 0
+        assert count + overruns == COUNT
+        assert last == COUNT - 1
+    assert got[1][1] > 0    # the slow consumer was lapped and skipped ahead
+
+
+def test_ring_sink_creates_the_ring_on_open():
+    name = 'bingo-test-sink-%i' % os.getpid()
+    sink = RingSink(name, NCHAN, nslots=NSLOTS)
+    with pytest.raises((OSError, IOError)):
+        SpectrumRing.attach(name)
+    sink.open()
+    try:
+        ring = SpectrumRing.attach(name)
+        consumer = ring.consumer(0)
+        sink.write(Spectrum(7, np.full(NCHAN, 7.0), 1000.0))
+        assert consumer.read(timeout=1).acc_cnt == 7
+        consumer.close()
+        ring.close()
+    finally:
+        sink.close()
+    with pytest.raises((OSError, IOError)):
+        SpectrumRing.attach(name)
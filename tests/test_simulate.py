@@ -0,0 +1,61 @@
+"""
+The 32k script runs end to end against a simulated board (-S), without
+casperfpga.
+
+The script is Python 2; the test runs it with the interpreter named by
+BINGO_PYTHON2 (default python2) and is skipped when that interpreter is
+missing or lacks numpy and matplotlib.
+"""
+
+from __future__ import division, print_function
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from bingo_backend.archive import SpectrumArchive
+
+SCRIPT = os.path.join(ROOT, 'bingo_dec16_32k_', 'bingo_dec16_32k.py')
+PYTHON2 = os.environ.get('BINGO_PYTHON2', 'python2')
+
+
+def python2_ready():
+    try:
+        return subprocess.call([PYTHON2, '-c', 'import numpy, matplotlib'],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+    except OSError:
+        return False
+
+
+@pytest.mark.skipif(not python2_ready(), reason='no Python 2 with numpy and matplotlib')
+def test_headless_simulated_run(tmpdir):
+    # any import of casperfpga fails the run
+    blocker = tmpdir.mkdir('block').mkdir('casperfpga')
+    blocker.join('__init__.py').write("raise ImportError('casperfpga imported with -S')\n")
+    env = dict(os.environ, PYTHONPATH=str(tmpdir.join('block')), MPLBACKEND='Agg')
+    base = str(tmpdir.join('tod'))
+    with open(str(tmpdir.join('out.txt')), 'w') as out:
+        proc = subprocess.Popen([PYTHON2, '-u', SCRIPT, '-S', 'sim0', '-H', '-l', '200',
+                                 '-a', base], cwd=str(tmpdir), env=env,
+                                stdout=out, stderr=subprocess.STDOUT)
+        deadline = time.time() + 60
+        while proc.poll() is None and not os.path.exists(base + '.json'):
+            assert time.time() < deadline, 'the acquisition did not start'
+            time.sleep(0.2)
+        time.sleep(2.0)
+        proc.send_signal(signal.SIGINT)
+        while proc.poll() is None:
+            assert time.time() < deadline, 'Ctrl-C did not stop the run'
+            time.sleep(0.2)
+    output = tmpdir.join('out.txt').read()
+    assert 'Traceback' not in output, output
+    archive = SpectrumArchive(base)
+    assert len(archive) > 10
+    acc_cnt = archive.index['acc_cnt'].astype(int)
+    assert (acc_cnt[1:] > acc_cnt[:-1]).all()
@@ -0,0 +1,114 @@
+"""
+SPEAD heap assembly over loopback.
+"""
+
+from __future__ import division, print_function
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from bingo_backend.sinks import LatestSink
+from bingo_backend.spead import SpeadReceiver, SpeadSender
+
+NCHAN = 1024
+
+
+def test_duplicate_packets_do_not_complete_a_heap():
+    latest = LatestSink()
+    receiver = SpeadReceiver(0, NCHAN, bind='127.0.0.1')
+    receiver.publish = lambda spectrum: latest.write(spectrum)
+    sender = SpeadSender('127.0.0.1', receiver.port, payload_bytes=1024)
+    data = np.arange(NCHAN, dtype='>u4')
+    packets = list(sender.packets(1, data))
+    # the first half of the heap twice over, the second half missing
+    for packet in packets[:2] * 2:
+        sender.sock.sendto(packet, sender.address)
+    receiver.poll_once(1.0)
+    assert receiver.duplicates == 2
+    assert receiver.heaps == 0
+    for packet in packets[2:]:
+        sender.sock.sendto(packet, sender.address)
+    receiver.poll_once(1.0)
+    assert receiver.heaps == 1
+    assert np.array_equal(latest.get().data, data)
+    sender.close()
+    receiver.sock.close()
+
+
+class Collect(object):
+    def __init__(self):
+        self.spectra = []
+
+    def write(self, spectrum):
+        self.spectra.append(spectrum)
+
+
+def loopback(**kwargs):
+    collect = Collect()
+    receiver = SpeadReceiver(0, NCHAN, bind='127.0.0.1', **kwargs)
+    receiver.publish = collect.write
+    sender = SpeadSender('127.0.0.1', receiver.port, payload_bytes=1024)
+    return receiver, sender, collect
+
+
+def send(sender, receiver, packets):
+    for packet in packets:
+        sender.sock.sendto(packet, sender.address)
+    receiver.poll_once(1.0)
+
+
+def test_heaps_are_published_in_order():
+    receiver, sender, collect = loopback()
+    data = np.arange(NCHAN, dtype='>u4')
+    heaps = dict((i, list(sender.packets(i, data))) for i in (1, 2, 3))
+    send(sender, receiver, heaps[1] + heaps[2][:2] + heaps[3])
+    assert [s.acc_cnt for s in collect.spectra] == [1]
+    send(sender, receiver, heaps[2][2:])
+    assert [s.acc_cnt for s in collect.spectra] == [1, 2, 3]
+    assert receiver.lost == 0 and receiver.late == 0
+    sender.close()
+    receiver.sock.close()
+
+
+def test_lost_counts_heaps_passed_over():
+    receiver, sender, collect = loopback(ring_heaps=2)
+    data = np.arange(NCHAN, dtype='>u4')
+    heaps = dict((i, list(sender.packets(i, data))) for i in range(1, 7))
+    # heap 2 never arrives, heap 4 only in part: it is given up when the
+    # ring is full, which releases heap 5 held back behind it
+    send(sender, receiver, heaps[1] + heaps[3] + heaps[4][:2] + heaps[5] + heaps[6])
+    assert [s.acc_cnt for s in collect.spectra] == [1, 3, 5, 6]
+    assert receiver.incomplete == 1
+    assert receiver.lost == 2
+    send(sender, receiver, heaps[4][2:])
+    assert receiver.late == 2
+    sender.close()
+    receiver.sock.close()
+
+
+def test_only_oversized_datagrams_are_truncated():
+    data = np.arange(NCHAN, dtype='>u4')
+    probe = SpeadSender(payload_bytes=1024)
+    size = len(next(probe.packets(1, data)))
+    probe.close()
+    receiver, sender, collect = loopback(max_packet=size)
+    send(sender, receiver, sender.packets(1, data))
+    assert receiver.truncated == 0 and receiver.heaps == 1
+    sender.sock.sendto(b'\0' * (size + 1), sender.address)
+    receiver.poll_once(1.0)
+    assert receiver.truncated == 1
+    sender.close()
+    receiver.sock.close()
+
+
+def test_runs_as_a_module_without_warnings():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-W', 'error::RuntimeWarning', '-m', 'bingo_backend.spead', '-h'],
+        stderr=subprocess.STDOUT, env=env)
+    assert b'Warning' not in output